@@ -1,5 +1,8 @@
-import argparse, csv, sys
-from typing import Dict, List, Tuple
+import argparse, csv, glob, os, sys
+from bisect import bisect_right
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from itertools import accumulate
+from typing import Dict, List, Optional, Tuple
 
 
 def read_bad_file(path: str) -> Tuple[Dict[str, List[Tuple[int, int, str, str, str]]], bool]:
@@ -61,6 +64,30 @@ def read_bed_file(path: str) -> Tuple[List[str], List[List[str]]]:
     return header, bed_rows
 
 
+def build_bad_index(
+    bad_intervals: Dict[str, List[Tuple[int, int, str, str, str]]],
+) -> Dict[str, Tuple[List[int], List[int], List[Tuple[int, int, str, str, str]]]]:
+    # Starts and running maximum of ends are both sorted, so the first interval containing
+    # a SNP is the first one whose running end passes it, if it also starts at or before the SNP
+    bad_index = {}
+    for chrom, intervals in bad_intervals.items():
+        starts = [interval[0] for interval in intervals]
+        max_ends = list(accumulate((interval[1] for interval in intervals), max))
+        bad_index[chrom] = (starts, max_ends, intervals)
+    return bad_index
+
+
+def find_bad_interval(
+    chrom_index: Tuple[List[int], List[int], List[Tuple[int, int, str, str, str]]],
+    snp_start: int,
+) -> Optional[Tuple[int, int, str, str, str]]:
+    starts, max_ends, intervals = chrom_index
+    i = bisect_right(max_ends, snp_start)
+    if i < bisect_right(starts, snp_start):
+        return intervals[i]
+    return None
+
+
 def merge_bed_and_bad(
     bed_header: List[str],
     bed_rows: List[List[str]],
@@ -68,6 +95,7 @@ def merge_bed_and_bad(
     has_bad_data: bool,
 ) -> List[List[str]]:
     output_rows: List[List[str]] = []
+    bad_index = build_bad_index(bad_intervals)
 
     for row in bed_rows:
         if len(row) < 9:
@@ -88,16 +116,11 @@ def merge_bed_and_bad(
         snp_ct = '1'
 
         if has_bad_data:
-            intervals = bad_intervals.get(chrom)
-            if intervals:
-                matching_interval = None
-                for interval_start, interval_end, interval_bad, interval_snp_ct, sum_cov in intervals:
-                    if interval_start <= snp_start < interval_end:
-                        matching_interval = (interval_bad, interval_snp_ct)
-                        break
-
+            chrom_index = bad_index.get(chrom)
+            if chrom_index:
+                matching_interval = find_bad_interval(chrom_index, snp_start)
                 if matching_interval is not None:
-                    bad_val, snp_ct = matching_interval
+                    bad_val, snp_ct = matching_interval[2:4]
 
         try:
             ref_count = int(row[6])
@@ -119,59 +142,132 @@ def merge_bed_and_bad(
     return output_rows
 
 
-def main():
-    parser = argparse.ArgumentParser(
-        description = 'Merge BED and BAD files into one BED file with additional columns.'
-    )
-    parser.add_argument('--bed', required = True, help = 'Input BED file')
-    parser.add_argument('--bad', required = True, help = 'Input BAD file with BAD calculations')
-    parser.add_argument(
-        '-o', '--output', required = True, help = 'Output file to write the merged table'
-    )
-    args = parser.parse_args()
-
-    bad_intervals, has_bad_data = read_bad_file(args.bad)
-    bed_header, bed_rows = read_bed_file(args.bed)
+OUTPUT_HEADER = [
+    '#chr',
+    'start',
+    'end',
+    'id',
+    'ref',
+    'alt',
+    'ref_count',
+    'alt_count',
+    'bad',
+    'SNP_per_segment',
+    'total_cover',
+    'sample_id',
+]
+
+
+def annotate(bed_path: str, bad_path: str, output_path: str) -> str:
+    bad_intervals, has_bad_data = read_bad_file(bad_path)
+    bed_header, bed_rows = read_bed_file(bed_path)
     output_rows = merge_bed_and_bad(bed_header, bed_rows, bad_intervals, has_bad_data)
 
     try:
-        with open(args.output, 'w', newline = '') as out_file:
+        with open(output_path, 'w', newline = '') as out_file:
             writer = csv.writer(out_file, delimiter = '\t')
-            writer.writerow(
-                [
-                    '#chr',
-                    'start',
-                    'end',
-                    'id',
-                    'ref',
-                    'alt',
-                    'ref_count',
-                    'alt_count',
-                    'bad',
-                    'SNP_per_segment',
-                    'total_cover',
-                    'sample_id',
-                ]
-            )
+            writer.writerow(OUTPUT_HEADER)
             writer.writerows(output_rows)
     except Exception as e:
-        raise Exception(f'WriteError: Could not write to output file {args.output}. {str(e)}')
+        raise Exception(f'WriteError: Could not write to output file {output_path}. {str(e)}')
 
     total_bed = len(bed_rows)
     total_out = len(output_rows)
     if total_out == 0:
-        print(
-            f'[WARN] Output file {args.output} has only header: no SNPs passed filters or merging.',
-            file = sys.stderr,
-        )
-    else:
-        print(
-            f'[INFO] {args.bed}: {total_bed} input SNPs, {total_out} written to {args.output} '
-            f'(BAD {"present" if has_bad_data else "absent, treated as BAD=1"}).',
-            file = sys.stderr,
-        )
+        return f'[WARN] Output file {output_path} has only header: no SNPs passed filters or merging.'
+    return (
+        f'[INFO] {bed_path}: {total_bed} input SNPs, {total_out} written to {output_path} '
+        f'(BAD {"present" if has_bad_data else "absent, treated as BAD=1"}).'
+    )
+
+
+def read_manifest(path: str) -> List[Tuple[str, str, str]]:
+    jobs: List[Tuple[str, str, str]] = []
+
+    try:
+        with open(path, 'r') as manifest:
+            for row in csv.reader(manifest, delimiter = '\t'):
+                if not row or row[0].startswith('#') or row[:3] == ['bed', 'bad', 'output']:
+                    continue
+                if len(row) < 3:
+                    raise Exception(f'FormatError: manifest row needs bed, bad and output columns: {row}')
+                jobs.append((row[0], row[1], row[2]))
+    except FileNotFoundError:
+        raise Exception(f'FileError: manifest {path} not found.')
+
+    return jobs
+
+
+def find_directory_jobs(bed_dir: str, bad_dir: str, output_dir: str, pattern: str) -> List[Tuple[str, str, str]]:
+    jobs: List[Tuple[str, str, str]] = []
+
+    for bed_path in sorted(glob.glob(os.path.join(bed_dir, pattern))):
+        name = os.path.splitext(os.path.basename(bed_path))[0]
+        if name.endswith('.with_bad'):
+            continue
+        bad_path = os.path.join(bad_dir, f'{name}.badmap.bed')
+        if not os.path.exists(bad_path):
+            print(f'[WARN] {bed_path}: no BAD file {bad_path}, skipped.', file = sys.stderr)
+            continue
+        jobs.append((bed_path, bad_path, os.path.join(output_dir, f'{name}.with_bad.bed')))
+
+    return jobs
+
+
+def annotate_many(jobs: List[Tuple[str, str, str]], n_jobs: int) -> int:
+    failed = 0
+
+    with ProcessPoolExecutor(max_workers = n_jobs) as pool:
+        futures = {pool.submit(annotate, *job): job for job in jobs}
+        for future in as_completed(futures):
+            try:
+                print(future.result(), file = sys.stderr)
+            except Exception as e:
+                failed += 1
+                print(f'[ERROR] {futures[future][0]}: {e}', file = sys.stderr)
+
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description = 'Merge BED and BAD files into one BED file with additional columns.'
+    )
+    parser.add_argument('--bed', help = 'Input BED file')
+    parser.add_argument('--bad', help = 'Input BAD file with BAD calculations')
+    parser.add_argument(
+        '-o', '--output', help = 'Output file to write the merged table'
+    )
+    parser.add_argument(
+        '--manifest', help = 'TSV with bed, bad and output paths, one triple per line, annotated in batch'
+    )
+    parser.add_argument('--bed-dir', help = 'Annotate every BED in this directory that has a BAD file')
+    parser.add_argument('--bad-dir', help = 'Directory with <name>.badmap.bed files for --bed-dir')
+    parser.add_argument(
+        '--output-dir', help = 'Directory for <name>.with_bad.bed outputs of --bed-dir (default: --bed-dir)'
+    )
+    parser.add_argument(
+        '--pattern', default = 'INDIV_*.bed', help = 'Glob for BED files in --bed-dir (default: INDIV_*.bed)'
+    )
+    parser.add_argument(
+        '-j', '--jobs', type = int, default = 1, help = 'Number of files annotated in parallel (default: 1)'
+    )
+    args = parser.parse_args()
+
+    if args.manifest or args.bed_dir:
+        if args.bed_dir and not args.bad_dir:
+            parser.error('--bed-dir requires --bad-dir')
+        jobs = read_manifest(args.manifest) if args.manifest else []
+        if args.bed_dir:
+            jobs += find_directory_jobs(args.bed_dir, args.bad_dir, args.output_dir or args.bed_dir, args.pattern)
+        if annotate_many(jobs, max(1, args.jobs)):
+            sys.exit(1)
+        return
+
+    if not (args.bed and args.bad and args.output):
+        parser.error('--bed, --bad and --output are required unless --manifest or --bed-dir is given')
+    print(annotate(args.bed, args.bad, args.output), file = sys.stderr)
 
 
 if __name__ == '__main__':
     main()
-
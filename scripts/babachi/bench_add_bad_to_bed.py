@@ -0,0 +1,90 @@
+import argparse, random, sys, time
+from typing import Dict, List, Tuple
+
+from add_bad_to_bed import merge_bed_and_bad
+
+
+def linear_merge_bed_and_bad(
+    bed_rows: List[List[str]],
+    bad_intervals: Dict[str, List[Tuple[int, int, str, str, str]]],
+) -> List[List[str]]:
+    # The join as it was before the interval index, kept as the reference for the benchmark
+    output_rows: List[List[str]] = []
+    for row in bed_rows:
+        if row[3] == '.':
+            continue
+        snp_start = int(row[1])
+        bad_val = '1'
+        snp_ct = '1'
+        for interval_start, interval_end, interval_bad, interval_snp_ct, sum_cov in bad_intervals.get(row[0], []):
+            if interval_start <= snp_start < interval_end:
+                bad_val, snp_ct = interval_bad, interval_snp_ct
+                break
+        total_cover = int(row[6]) + int(row[7])
+        output_rows.append(row[0:8] + [bad_val, snp_ct, str(total_cover), row[8]])
+    return output_rows
+
+
+def make_inputs(
+    n_snps: int, n_segments: int, n_chroms: int, seed: int,
+) -> Tuple[List[List[str]], Dict[str, List[Tuple[int, int, str, str, str]]]]:
+    rng = random.Random(seed)
+    chrom_len = 250_000_000
+    bad_intervals: Dict[str, List[Tuple[int, int, str, str, str]]] = {}
+    bed_rows: List[List[str]] = []
+
+    for c in range(1, n_chroms + 1):
+        chrom = f'chr{c}'
+        # Segments tile the chromosome with gaps, a few of them overlap their neighbour
+        bounds = sorted(rng.sample(range(chrom_len), 2 * (n_segments // n_chroms)))
+        intervals = []
+        for start, end in zip(bounds[::2], bounds[1::2]):
+            if rng.random() < 0.05:
+                end += rng.randint(1, 1_000_000)
+            intervals.append((start, end, rng.choice(['1', '2', '3', '4/3', '5']), str(rng.randint(1, 500)), '0'))
+        bad_intervals[chrom] = intervals
+
+        for pos in sorted(rng.randrange(chrom_len) for _ in range(n_snps // n_chroms)):
+            var_id = f'rs{pos}' if rng.random() > 0.01 else '.'
+            bed_rows.append([
+                chrom, str(pos), str(pos + 1), var_id, 'A', 'G',
+                str(rng.randint(0, 60)), str(rng.randint(0, 60)), 'SAMPLE',
+            ])
+    return bed_rows, bad_intervals
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description = 'Compare the linear BAD lookup with the interval index of add_bad_to_bed.py on synthetic data.'
+    )
+    parser.add_argument('--snps', type = int, default = 1_000_000, help = 'Number of synthetic SNPs')
+    parser.add_argument('--segments', type = int, default = 10_000, help = 'Number of synthetic BAD segments')
+    parser.add_argument('--chroms', type = int, default = 22, help = 'Number of chromosomes')
+    parser.add_argument('--seed', type = int, default = 0, help = 'Random seed')
+    parser.add_argument('--skip-linear', action = 'store_true', help = 'Only time the indexed join')
+    args = parser.parse_args()
+
+    bed_rows, bad_intervals = make_inputs(args.snps, args.segments, args.chroms, args.seed)
+    print(f'{len(bed_rows)} SNPs, {sum(map(len, bad_intervals.values()))} BAD segments', file = sys.stderr)
+
+    t = time.perf_counter()
+    indexed = merge_bed_and_bad([], bed_rows, bad_intervals, True)
+    indexed_time = time.perf_counter() - t
+    print(f'indexed: {indexed_time:.2f} s', file = sys.stderr)
+
+    if args.skip_linear:
+        return
+
+    t = time.perf_counter()
+    linear = linear_merge_bed_and_bad(bed_rows, bad_intervals)
+    linear_time = time.perf_counter() - t
+    print(f'linear:  {linear_time:.2f} s ({linear_time / indexed_time:.0f}x slower)', file = sys.stderr)
+
+    if indexed != linear:
+        print('[ERROR] Indexed and linear joins differ', file = sys.stderr)
+        sys.exit(1)
+    print('Outputs are identical', file = sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,165 @@
+import argparse, glob, math, os, subprocess, sys, time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from typing import List, Tuple
+
+from add_bad_to_bed import annotate
+
+BABACHI_ARGS = ['-p', 'geometric', '-g', '0.99', '-s', '1,4/3,3/2,2,5/2,3,4,5,6']
+TIMING_HEADER = ['indiv_id', 'snps', 'jobs', 'babachi_s', 'visualize_s', 'add_bad_s', 'total_s', 'status']
+
+
+def count_lines(path: str) -> int:
+    n = 0
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            n += chunk.count(b'\n')
+    return n
+
+
+def jobs_for(n_snps: int, snps_per_job: int, max_jobs: int) -> int:
+    return max(1, min(max_jobs, math.ceil(n_snps / snps_per_job)))
+
+
+def find_individuals(bed_dir: str, pattern: str, skip_existing: bool) -> List[Tuple[str, str, int]]:
+    individuals: List[Tuple[str, str, int]] = []
+
+    for bed_path in sorted(glob.glob(os.path.join(bed_dir, pattern))):
+        name = os.path.splitext(os.path.basename(bed_path))[0]
+        if name.endswith('.with_bad'):
+            continue
+        out_path = os.path.join(bed_dir, f'{name}.with_bad.bed')
+        if skip_existing and os.path.exists(out_path) and os.path.getmtime(out_path) >= os.path.getmtime(bed_path):
+            continue
+        individuals.append((name, bed_path, count_lines(bed_path) - 1))
+
+    return individuals
+
+
+def run_step(cmd: List[str]) -> float:
+    t = time.perf_counter()
+    result = subprocess.run(cmd, stdout = subprocess.DEVNULL, stderr = subprocess.PIPE)
+    if result.returncode != 0:
+        tail = result.stderr.decode(errors = 'replace').strip().splitlines()[-5:]
+        raise Exception(f'{cmd[0]} {cmd[1]} exited with code {result.returncode}: ' + ' | '.join(tail))
+    return time.perf_counter() - t
+
+
+def process_individual(name: str, bed_path: str, bad_dir: str, output_dir: str, n_jobs: int, visualize: bool) -> List[float]:
+    # BAD calling, optional visualization and the BED/BAD merge for one individual, in one worker
+    bad_path = os.path.join(bad_dir, f'{name}.badmap.bed')
+
+    babachi_time = run_step(['babachi', bed_path, '-j', str(n_jobs)] + BABACHI_ARGS + ['-O', bad_dir + os.sep])
+
+    visualize_time = 0.0
+    if visualize and count_lines(bad_path) > 1:
+        visualize_time = run_step(['babachi', 'visualize', bed_path, '-O', bad_dir + os.sep, '-b', bad_path])
+
+    t = time.perf_counter()
+    annotate(bed_path, bad_path, os.path.join(output_dir, f'{name}.with_bad.bed'))
+    add_bad_time = time.perf_counter() - t
+
+    return [babachi_time, visualize_time, add_bad_time]
+
+
+def schedule(individuals: List[Tuple[str, str, int]], args, timing) -> int:
+    '''
+    Starts the biggest individuals first and fills the remaining cores with whatever still fits,
+    so small individuals run on single cores next to the large ones. A job needing more cores
+    than are free waits, unless nothing is running.
+    '''
+    pending = sorted(
+        ((name, bed, n, jobs_for(n, args.snps_per_job, args.max_jobs)) for name, bed, n in individuals),
+        key = lambda x: x[2], reverse = True,
+    )
+    running = {}
+    free = args.cores
+    failed = 0
+
+    with ProcessPoolExecutor(max_workers = args.cores) as pool:
+        while pending or running:
+            i = 0
+            while i < len(pending):
+                name, bed, n, n_jobs = pending[i]
+                if n_jobs <= free or not running:
+                    del pending[i]
+                    n_jobs = min(n_jobs, args.cores)
+                    future = pool.submit(
+                        process_individual, name, bed, args.bad_dir, args.output_dir, n_jobs, not args.no_visualize,
+                    )
+                    running[future] = (name, n, n_jobs, time.perf_counter())
+                    free -= n_jobs
+                else:
+                    i += 1
+
+            finished, _ = wait(running, return_when = FIRST_COMPLETED)
+            for future in finished:
+                name, n, n_jobs, start = running.pop(future)
+                free += n_jobs
+                total = time.perf_counter() - start
+                try:
+                    steps = future.result()
+                    status = 'ok'
+                    print(f'[INFO] {name}: {n} SNPs, {n_jobs} jobs, {total:.1f} s', file = sys.stderr)
+                except Exception as e:
+                    steps = [float('nan')] * 3
+                    status = 'failed'
+                    failed += 1
+                    print(f'[ERROR] {name}: {e}', file = sys.stderr)
+                timing.write('\t'.join(
+                    [name, str(n), str(n_jobs)] + [f'{s:.2f}' for s in steps] + [f'{total:.2f}', status]
+                ) + '\n')
+                timing.flush()
+
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description = 'Run BABACHI, its visualization and add_bad_to_bed.py for every individual BED, '
+                      'with jobs per individual sized by SNP count under a total core budget.'
+    )
+    parser.add_argument('--bed-dir', required = True, help = 'Directory with INDIV_*.bed files')
+    parser.add_argument('--bad-dir', required = True, help = 'Directory for <name>.badmap.bed files')
+    parser.add_argument(
+        '--output-dir', help = 'Directory for <name>.with_bad.bed outputs (default: --bed-dir)'
+    )
+    parser.add_argument(
+        '--pattern', default = 'INDIV_*.bed', help = 'Glob for BED files in --bed-dir (default: INDIV_*.bed)'
+    )
+    parser.add_argument('--cores', type = int, default = 1, help = 'Total cores used by all BABACHI jobs (default: 1)')
+    parser.add_argument(
+        '--max-jobs', type = int, default = 25, help = 'Most BABACHI jobs (-j) given to one individual (default: 25)'
+    )
+    parser.add_argument(
+        '--snps-per-job', type = int, default = 100_000,
+        help = 'SNPs per BABACHI job: an individual gets ceil(SNPs / this) jobs, up to --max-jobs (default: 100000)'
+    )
+    parser.add_argument('--no-visualize', action = 'store_true', help = 'Skip babachi visualize')
+    parser.add_argument(
+        '--skip-existing', action = 'store_true', help = 'Skip individuals whose .with_bad.bed is newer than the BED'
+    )
+    parser.add_argument(
+        '--timing', help = 'TSV with per-individual step times (default: <bad-dir>/babachi_timing.tsv)'
+    )
+    args = parser.parse_args()
+
+    args.cores = max(1, args.cores)
+    args.max_jobs = max(1, args.max_jobs)
+    args.output_dir = args.output_dir or args.bed_dir
+    os.makedirs(args.bad_dir, exist_ok = True)
+    os.makedirs(args.output_dir, exist_ok = True)
+
+    individuals = find_individuals(args.bed_dir, args.pattern, args.skip_existing)
+    print(f'[INFO] {len(individuals)} individuals, {args.cores} cores', file = sys.stderr)
+
+    with open(args.timing or os.path.join(args.bad_dir, 'babachi_timing.tsv'), 'w') as timing:
+        timing.write('\t'.join(TIMING_HEADER) + '\n')
+        failed = schedule(individuals, args, timing) if individuals else 0
+
+    if failed:
+        print(f'[ERROR] {failed} individuals failed', file = sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
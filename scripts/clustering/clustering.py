@@ -1,13 +1,17 @@
 from __future__ import annotations
 
 import argparse
+import hashlib
 import re
 from pathlib import Path
 
 import numpy as np
 import pandas as pd
 from scipy.cluster import hierarchy
-from scipy.spatial.distance import squareform
+
+BLOCK_ROWS = 2048
+STORE_IDS = "ids.txt"
+STORE_MATRIX = "kin.npy"
 
 
 def read_king_ids(path: Path) -> list[str]:
@@ -24,22 +28,67 @@ def read_king_ids(path: Path) -> list[str]:
 
 
 def read_king_matrix_square(path: Path, n: int) -> np.ndarray:
-    rows = []
+    mat = np.empty((n, n), dtype=np.float32)
+    i = 0
     with open(path, "rt") as f:
         for line in f:
             s = line.strip()
             if not s or s.startswith("#"):
                 continue
-            rows.append(np.fromstring(s, sep=" ", dtype=np.float32))
-    if len(rows) != n:
-        raise ValueError(f"KING rows mismatch: {len(rows)} != {n}")
-    mat = np.vstack(rows)
-    if mat.shape != (n, n):
-        raise ValueError(f"KING shape mismatch: {mat.shape} != {(n, n)}")
-    mat = (mat + mat.T) / 2.0
+            if i >= n:
+                raise ValueError(f"KING rows mismatch: more than {n} rows")
+            row = np.fromstring(s, sep=" ", dtype=np.float32)
+            if row.shape != (n,):
+                raise ValueError(f"KING shape mismatch: row {i} has {row.size} values, expected {n}")
+            mat[i] = row
+            i += 1
+    if i != n:
+        raise ValueError(f"KING rows mismatch: {i} != {n}")
+    return mat
+
+
+def read_king_matrix_bin(path: Path, n: int) -> np.ndarray:
+    # plink2 --make-king square bin writes float64, bin4 writes float32, both row-major n x n
+    size = path.stat().st_size
+    if size == n * n * 4:
+        return np.memmap(path, dtype=np.float32, mode="c", shape=(n, n))
+    if size == n * n * 8:
+        src = np.memmap(path, dtype=np.float64, mode="r", shape=(n, n))
+        mat = np.empty((n, n), dtype=np.float32)
+        for i in range(0, n, BLOCK_ROWS):
+            mat[i:i + BLOCK_ROWS] = src[i:i + BLOCK_ROWS]
+        return mat
+    raise ValueError(f"KING binary size {size} does not match a square {n}x{n} float32 or float64 matrix: {path}")
+
+
+def load_king_matrix(path: Path, n: int, cache: Path | None = None) -> np.ndarray:
+    if path.suffix == ".bin":
+        return read_king_matrix_bin(path, n)
+
+    if cache is not None and cache.exists() and cache.stat().st_mtime >= path.stat().st_mtime:
+        mat = np.load(cache, mmap_mode="c")
+        if mat.shape == (n, n) and mat.dtype == np.float32:
+            return mat
+
+    mat = read_king_matrix_square(path, n)
+    if cache is not None:
+        cache.parent.mkdir(parents=True, exist_ok=True)
+        tmp = cache.with_name(cache.name + ".tmp")
+        with open(tmp, "wb") as f:
+            np.save(f, mat)
+        tmp.replace(cache)
     return mat
 
 
+def load_kinship_store(store: Path) -> tuple[list[str], np.ndarray]:
+    # Directory written by kinship_store.py: sample ids and the square float32 KING matrix
+    ids = read_king_ids(store / STORE_IDS)
+    kin = np.load(store / STORE_MATRIX, mmap_mode="r")
+    if kin.shape != (len(ids), len(ids)):
+        raise ValueError(f"Kinship store shape mismatch: {kin.shape} != {(len(ids), len(ids))}")
+    return ids, kin
+
+
 def load_meta(meta_path: Path) -> pd.DataFrame:
     m = pd.read_csv(meta_path, sep="\t", dtype=str).fillna("NA")
     need = ["indiv_id", "tf", "cell", "algn_id", "gse", "path"]
@@ -50,7 +99,7 @@ def load_meta(meta_path: Path) -> pd.DataFrame:
     return m
 
 
-def intersect(ids: list[str], kin: np.ndarray, meta: pd.DataFrame) -> tuple[list[str], np.ndarray, pd.DataFrame]:
+def intersect(ids: list[str], meta: pd.DataFrame) -> tuple[list[str], np.ndarray, pd.DataFrame]:
     meta_ids = set(meta.index.astype(str).tolist())
     keep = np.array([i in meta_ids for i in ids], dtype=bool)
     keep_n = int(keep.sum())
@@ -60,30 +109,52 @@ def intersect(ids: list[str], kin: np.ndarray, meta: pd.DataFrame) -> tuple[list
         meta2 = meta.reindex(ids)
         if int(meta2["indiv_id"].isna().sum()) > 0:
             raise ValueError("Metadata missing for some KING IDs")
-        return ids, kin, meta2
+        return ids, np.arange(len(ids)), meta2
 
     idx = np.where(keep)[0]
     ids2 = [ids[i] for i in idx.tolist()]
-    kin2 = kin[np.ix_(idx, idx)]
     meta2 = meta.reindex(ids2)
     if int(meta2["indiv_id"].isna().sum()) > 0:
         raise ValueError("Metadata missing for some kept samples")
-    return ids2, kin2, meta2
+    return ids2, idx, meta2
 
 
 def apply_floor(kin: np.ndarray, floor: float) -> np.ndarray:
-    kin = kin.copy()
     kin[kin < floor] = 0.0
-    kin = (kin + kin.T) / 2.0
     return kin
 
 
 def kinship_to_distance(kin: np.ndarray) -> np.ndarray:
-    dist = 1.0 - 2.0 * kin
-    dist = (dist + dist.T) / 2.0
-    np.fill_diagonal(dist, 0.0)
-    dist[dist < 0] = 0.0
-    return dist.astype(np.float32, copy=False)
+    # In place 1 - 2 * kin, clipped at zero
+    kin *= -2.0
+    kin += 1.0
+    kin[kin < 0] = 0.0
+    return kin
+
+
+def take_block(kin: np.ndarray, rows: np.ndarray, cols: np.ndarray, full: bool) -> np.ndarray:
+    if full:
+        return np.array(kin[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1])
+    return kin[np.ix_(rows, cols)]
+
+
+def condensed_distance(kin: np.ndarray, idx: np.ndarray, floor: float) -> np.ndarray:
+    # Same vector as squareform of the symmetrized, floored distance matrix over idx,
+    # built BLOCK_ROWS rows at a time so the square matrix is never materialized
+    m = len(idx)
+    full = m == kin.shape[0]
+    cond = np.empty(m * (m - 1) // 2, dtype=np.float64)
+    offset = 0
+    for i in range(0, m, BLOCK_ROWS):
+        rows = idx[i:i + BLOCK_ROWS]
+        upper = take_block(kin, rows, idx[i:], full)
+        lower = take_block(kin, idx[i:], rows, full)
+        block = kinship_to_distance(apply_floor((upper + lower.T) / 2.0, floor))
+        for a in range(len(rows)):
+            n_right = m - i - a - 1
+            cond[offset:offset + n_right] = block[a, a + 1:]
+            offset += n_right
+    return cond
 
 
 def labels_to_indiv_ids(ids: list[str], labels: np.ndarray) -> pd.Series:
@@ -100,6 +171,32 @@ def labels_to_indiv_ids(ids: list[str], labels: np.ndarray) -> pd.Series:
     return pd.Series(indiv, index=ids, name="indiv_id")
 
 
+def read_previous_clusters(path: Path) -> dict[frozenset[str], str]:
+    prev = pd.read_csv(path, sep="\t", dtype=str)
+    base = prev["indiv_id"].str.split("__CELL_").str[0]
+    members = prev.groupby(base)["old_indiv_id"].agg(frozenset)
+    return {m: indiv for indiv, m in members.items()}
+
+
+def labels_to_stable_indiv_ids(ids: list[str], labels: np.ndarray, previous: dict[frozenset[str], str]) -> pd.Series:
+    # Clusters with exactly the same samples as in the previous run keep their INDIV id,
+    # the others get new numbers above every previous one, ordered as in labels_to_indiv_ids
+    df = pd.DataFrame({"old_indiv_id": ids, "lab": labels})
+    members = df.groupby("lab")["old_indiv_id"].agg(frozenset)
+    lab_to_indiv = {lab: previous[m] for lab, m in members.items() if m in previous}
+
+    numbers = [int(m.group(1)) for m in (re.fullmatch(r"INDIV_(\d+)", i) for i in previous.values()) if m]
+    next_number = max(numbers, default=0) + 1
+    keys = df.groupby("lab")["old_indiv_id"].min().sort_values(kind="mergesort").index.to_list()
+    for lab in keys:
+        if lab not in lab_to_indiv:
+            lab_to_indiv[lab] = f"INDIV_{next_number:04d}"
+            next_number += 1
+
+    indiv = df["lab"].map(lab_to_indiv).to_numpy(dtype=object)
+    return pd.Series(indiv, index=ids, name="indiv_id")
+
+
 def split_multicell_clusters(
     out: pd.DataFrame,
     *,
@@ -128,41 +225,173 @@ def split_multicell_clusters(
     return out2
 
 
+def cluster_fingerprints(out: pd.DataFrame, cluster_col: str = "indiv_id", algn_col: str = "algn_id") -> pd.Series:
+    # Membership hash per cluster: equal fingerprints mean the same set of alignments
+    def fingerprint(algn_ids: pd.Series) -> str:
+        return hashlib.sha1("\n".join(sorted(algn_ids.astype(str))).encode()).hexdigest()[:16]
+    return out.groupby(cluster_col)[algn_col].agg(fingerprint).rename("fingerprint")
+
+
+def diff_clusters(out: pd.DataFrame, previous: pd.DataFrame) -> pd.DataFrame:
+    cur = pd.DataFrame({"fingerprint": cluster_fingerprints(out), "n_algn": out.groupby("indiv_id").size()})
+    prev = pd.DataFrame({"fingerprint": cluster_fingerprints(previous), "n_algn": previous.groupby("indiv_id").size()})
+    diff = cur.join(prev, how="outer", rsuffix="_previous")
+
+    status = np.where(diff["fingerprint"] == diff["fingerprint_previous"], "unchanged", "changed")
+    status = np.where(diff["fingerprint_previous"].isna(), "new", status)
+    status = np.where(diff["fingerprint"].isna(), "gone", status)
+    diff.insert(0, "status", status)
+    diff = diff.rename_axis("indiv_id").reset_index()
+    for c in ["n_algn", "n_algn_previous"]:
+        diff[c] = diff[c].astype("Int64")
+
+    # A new cluster may hold exactly the alignments of a gone one, e.g. after a per-cell split
+    gone = diff[diff["status"] == "gone"].drop_duplicates("fingerprint_previous")
+    gone_by_fingerprint = dict(zip(gone["fingerprint_previous"], gone["indiv_id"]))
+    same_as = diff["fingerprint"].map(gone_by_fingerprint)
+    diff["same_as"] = same_as.where(diff["status"] == "new")
+    return diff[["indiv_id", "status", "same_as", "n_algn", "n_algn_previous", "fingerprint", "fingerprint_previous"]]
+
+
+def parse_values(spec: str) -> list[float]:
+    # Comma-separated values and inclusive "start:stop:step" ranges
+    values = []
+    for part in spec.split(","):
+        if ":" in part:
+            start, stop, step = (float(x) for x in part.split(":"))
+            values.extend(round(float(v), 10) for v in np.arange(start, stop + step / 2, step))
+        elif part:
+            values.append(float(part))
+    return values
+
+
+def sweep_stats(labels: np.ndarray, cell_codes: np.ndarray, split: bool) -> dict[str, int]:
+    _, lab = np.unique(labels, return_inverse=True)
+    n_cells = int(cell_codes.max()) + 1
+    pairs, pair_sizes = np.unique(lab * n_cells + cell_codes, return_counts=True)
+    cells_per_cluster = np.bincount(pairs // n_cells)
+    sizes = pair_sizes if split else np.bincount(lab)
+    return {
+        "clusters": int(lab.max()) + 1,
+        "multicell_clusters": int((cells_per_cluster > 1).sum()),
+        "split_clusters": int(len(pairs)),
+        "singletons": int((sizes == 1).sum()),
+    }
+
+
+def run_sweep(
+    kin: np.ndarray,
+    idx: np.ndarray,
+    meta: pd.DataFrame,
+    ids: list[str],
+    floors: list[float],
+    thrs: list[float],
+    method: str,
+    split: bool,
+) -> pd.DataFrame:
+    cell_codes, _ = pd.factorize(meta.loc[ids, "cell"])
+    rows = []
+    for floor in floors:
+        z = hierarchy.linkage(condensed_distance(kin, idx, floor=floor), method=method)
+        for thr in thrs:
+            labels = hierarchy.fcluster(z, t=thr, criterion="distance")
+            rows.append({"floor": floor, "thr": thr, **sweep_stats(labels, cell_codes, split)})
+    return pd.DataFrame(rows)
+
+
 def main() -> None:
     p = argparse.ArgumentParser()
-    p.add_argument("--king", type=Path, required=True)
-    p.add_argument("--king-id", type=Path, required=True)
+    p.add_argument("--king", type=Path, default=None, help="plink2 --make-king square matrix, text or .king.bin")
+    p.add_argument("--king-id", type=Path, default=None)
+    p.add_argument("--store", type=Path, default=None, help="Kinship store directory from kinship_store.py, instead of --king")
     p.add_argument("--meta", type=Path, required=True)
-    p.add_argument("--out", type=Path, required=True)
+    p.add_argument("--out", type=Path, default=None)
+    p.add_argument(
+        "--king-cache",
+        type = Path,
+        default = None,
+        help = "Save the parsed text KING matrix as .npy here and memory-map it on later runs"
+    )
 
     p.add_argument("--floor", type=float, default=0.1)
     p.add_argument("--thr", type=float, default=0.8)
     p.add_argument("--method", type=str, default="average")
 
+    p.add_argument(
+        "--previous",
+        type = Path,
+        default = None,
+        help = "Clustered table of a previous run; clusters with unchanged membership keep their INDIV ids"
+    )
+
+    p.add_argument(
+        "--diff",
+        type = Path,
+        default = None,
+        help = "With --previous, write a TSV marking every cluster as unchanged, changed, new or gone"
+    )
+
     p.add_argument(
         "--with-multicell-clusters",
         action = "store_true",
         help = "Do not split clusters that contain multiple cell lines; keep multicell clusters as-is"
     )
 
-    args = p.parse_args()
+    p.add_argument(
+        "--sweep",
+        type = Path,
+        default = None,
+        help = "Write cluster counts for every (floor, thr) pair of --sweep-floors x --sweep-thrs to this TSV "
+               "instead of the clustered table; one linkage per floor"
+    )
+    p.add_argument(
+        "--sweep-floors",
+        type = str,
+        default = None,
+        help = "Floors for --sweep: values and start:stop:step ranges, comma-separated (default: --floor)"
+    )
+    p.add_argument(
+        "--sweep-thrs",
+        type = str,
+        default = "0.5:1.0:0.01",
+        help = "Dendrogram cut heights for --sweep: values and start:stop:step ranges, comma-separated"
+    )
 
-    ids = read_king_ids(args.king_id)
-    n = len(ids)
+    args = p.parse_args()
+    if args.out is None and args.sweep is None:
+        p.error("one of --out or --sweep is required")
+    if args.diff is not None and args.previous is None:
+        p.error("--diff requires --previous")
+    if args.store is None and (args.king is None or args.king_id is None):
+        p.error("either --store or both --king and --king-id are required")
 
     meta = load_meta(args.meta)
-    kin = read_king_matrix_square(args.king, n=n)
-
-    ids, kin, meta = intersect(ids, kin, meta)
-
-    kin = apply_floor(kin, floor=float(args.floor))
-    dist = kinship_to_distance(kin)
-
-    cond = squareform(dist, checks=False)
+    if args.store is not None:
+        ids, kin = load_kinship_store(args.store)
+    else:
+        ids = read_king_ids(args.king_id)
+        kin = load_king_matrix(args.king, n=len(ids), cache=args.king_cache)
+
+    ids, idx, meta = intersect(ids, meta)
+
+    if args.sweep is not None:
+        floors = parse_values(args.sweep_floors) if args.sweep_floors else [float(args.floor)]
+        sweep = run_sweep(
+            kin, idx, meta, ids, floors, parse_values(args.sweep_thrs),
+            method=str(args.method), split=not args.with_multicell_clusters,
+        )
+        args.sweep.parent.mkdir(parents=True, exist_ok=True)
+        sweep.to_csv(args.sweep, sep="\t", index=False)
+        return
+
+    cond = condensed_distance(kin, idx, floor=float(args.floor))
     z = hierarchy.linkage(cond, method=str(args.method))
 
     labels = hierarchy.fcluster(z, t=float(args.thr), criterion="distance")
-    indiv = labels_to_indiv_ids(ids, labels)
+    if args.previous is not None:
+        indiv = labels_to_stable_indiv_ids(ids, labels, read_previous_clusters(args.previous))
+    else:
+        indiv = labels_to_indiv_ids(ids, labels)
 
     out = meta.loc[ids, ["indiv_id", "tf", "cell", "algn_id", "gse", "path"]].copy()
     out = out.rename(columns={"indiv_id": "old_indiv_id"})
@@ -175,7 +404,15 @@ def main() -> None:
         out = split_multicell_clusters(out, cluster_col = "indiv_id", cell_col = "cell")
 
     out = out.sort_values(['indiv_id', 'algn_id'], kind = 'mergesort').reset_index(drop = True)
+    out["fingerprint"] = out["indiv_id"].map(cluster_fingerprints(out))
     args.out.parent.mkdir(parents=True, exist_ok=True)
+
+    if args.diff is not None:
+        previous = pd.read_csv(args.previous, sep="\t", dtype=str)
+        diff = diff_clusters(out, previous)
+        args.diff.parent.mkdir(parents=True, exist_ok=True)
+        diff.to_csv(args.diff, sep="\t", index=False)
+
     out.to_csv(args.out, sep="\t", index=False)
 
 
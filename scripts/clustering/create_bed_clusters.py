@@ -1,7 +1,14 @@
-import sys, os, gzip, argparse, csv
+import sys, os, heapq, argparse, csv, tempfile
 from collections import defaultdict
+from functools import lru_cache
+from itertools import count
+from operator import itemgetter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
 from tqdm.auto import tqdm
 
+from vcf_columns import open_vcf, read_sample_ids, iter_vcf_blocks, format_bed_block
+
 BED_HEADER = [
     '#chr',
     'start',
@@ -38,15 +45,28 @@ def parse_args():
         default='path',
         help='Column name with VCF path (default: path).'
     )
+    parser.add_argument(
+        '-j', '--jobs',
+        type=int,
+        default=1,
+        help='Number of clusters built concurrently in a process pool (default: 1).'
+    )
+    parser.add_argument(
+        '--max-open',
+        type=int,
+        default=256,
+        help='Maximum number of VCFs merged at once by one worker; larger clusters '
+             'are merged in several passes through temporary BED files (default: 256).'
+    )
+    parser.add_argument(
+        '--skip-unchanged',
+        default=None,
+        help='Cluster diff TSV from clustering.py --diff; clusters marked unchanged '
+             'keep their existing BED and are not rebuilt.'
+    )
     return parser.parse_args()
 
 
-def open_vcf(file_path):
-    if file_path.endswith('.gz'):
-        return gzip.open(file_path, 'rt')
-    return open(file_path, 'r')
-
-
 def make_vcf_path(path_from_metadata, work_dir):
     name = os.path.basename(path_from_metadata)
     if name.endswith('.without_MAF.vcf.gz'):
@@ -56,90 +76,47 @@ def make_vcf_path(path_from_metadata, work_dir):
     return os.path.join(work_dir, 'VCFs', name)
 
 
-def extract_variants_from_vcf(vcf_path):
-    records = []
+def iter_bed_blocks(vcf_path, check_sorted=True):
+    '''
+    Yields (chrom, pos, BED text) for each block of BED records of vcf_path in file order.
+    With check_sorted, raises ValueError if the records are not sorted by chrom_sort_key and position.
+    '''
     try:
         vcf = open_vcf(vcf_path)
     except OSError as e:
         print(f'Warning: cannot open VCF {vcf_path}: {e}', file=sys.stderr)
-        return records
+        return
 
     with vcf:
-        sample_ids = []
-        for line in vcf:
-            line = line.strip()
-            if not line:
-                continue
-            if line.startswith('##'):
-                continue
-            if line.startswith('#CHROM'):
-                headers = line.split('\t')
-                sample_ids = headers[9:]
-                continue
-            if not sample_ids:
-                print(f'Error: No sample columns found in VCF {vcf_path}.', file=sys.stderr)
-                return records
+        sample_ids = read_sample_ids(vcf)
+        if not sample_ids:
+            print(f'Error: No sample columns found in VCF {vcf_path}.', file=sys.stderr)
+            return
 
-            fields = line.split('\t')
-            if len(fields) < 8:
-                continue
+        last = None
+        for block in iter_vcf_blocks(vcf, sample_ids):
+            run_start = np.flatnonzero(np.concatenate([[True], block.chrom[1:] != block.chrom[:-1]]))
+            run_chrom = [c.decode() for c in block.chrom[run_start].tolist()]
+            chrom = np.repeat(np.array(run_chrom, dtype=object), np.diff(np.append(run_start, len(block))))
+
+            if check_sorted:
+                within_run = np.ones(len(block), dtype=bool)
+                within_run[run_start] = False
+                run_end = np.append(run_start[1:], len(block)) - 1
+                keys = [] if last is None else [last]
+                for c, first, final in zip(run_chrom, block.pos[run_start].tolist(), block.pos[run_end].tolist()):
+                    keys.extend([(*chrom_sort_key(c), first), (*chrom_sort_key(c), final)])
+                if keys != sorted(keys) or np.any((np.diff(block.pos) < 0) & within_run[1:]):
+                    raise ValueError(f'{vcf_path} is not sorted by chromosome and position')
+                last = keys[-1]
 
-            chrom = fields[0]
-            pos = int(fields[1])
-            var_id = fields[2]
-            ref = fields[3]
-            alt = fields[4]
-            format_field = fields[8]
-            sample_fields = fields[9:]
-
-            start = pos - 1
-            end = pos
-
-            format_keys = format_field.split(':')
-            try:
-                ad_index = format_keys.index('AD')
-            except ValueError:
-                ad_index = None
-
-            for sample_id, sample in zip(sample_ids, sample_fields):
-                if ad_index is not None:
-                    sample_values = sample.split(':')
-                    if ad_index < len(sample_values):
-                        ad = sample_values[ad_index]
-                        if ad != '.' and ad != './.':
-                            ad_counts = ad.split(',')
-                            if len(ad_counts) >= 2:
-                                ref_count = ad_counts[0]
-                                alt_count = ad_counts[1]
-                            elif len(ad_counts) == 1:
-                                ref_count = ad_counts[0]
-                                alt_count = '0'
-                            else:
-                                ref_count = alt_count = '0'
-                        else:
-                            ref_count = alt_count = '0'
-                    else:
-                        ref_count = alt_count = '0'
-                else:
-                    ref_count = alt_count = '0'
-
-                bed_id = var_id if var_id != '.' else '.'
-                if bed_id == '.':
-                    continue
-
-                bed_fields = [
-                    chrom,
-                    str(start),
-                    str(end),
-                    bed_id,
-                    ref,
-                    alt,
-                    ref_count,
-                    alt_count,
-                    sample_id,
-                ]
-                records.append(bed_fields)
-    return records
+            yield chrom, block.pos, format_bed_block(block)
+
+
+def iter_variants_from_vcf(vcf_path, check_sorted=True):
+    for chroms, positions, lines in iter_bed_blocks(vcf_path, check_sorted):
+        for chrom, pos, line in zip(chroms, positions.tolist(), lines.split(b'\n')):
+            yield (*chrom_sort_key(chrom), pos), line
 
 
 def load_clusters(metadata_path, indiv_col, path_col, work_dir):
@@ -174,6 +151,7 @@ def load_clusters(metadata_path, indiv_col, path_col, work_dir):
     return clusters
 
 
+@lru_cache(maxsize=None)
 def chrom_sort_key(chrom):
     c = chrom
     if c.lower().startswith('chr'):
@@ -188,6 +166,95 @@ def chrom_sort_key(chrom):
         return (2, c)
 
 
+def iter_bed_records(bed_path):
+    with open(bed_path, 'rb') as bed:
+        for line in bed:
+            line = line.rstrip(b'\n')
+            chrom, start, _ = line.split(b'\t', 2)
+            yield (*chrom_sort_key(chrom.decode()), int(start) + 1), line
+
+
+def write_bed_header(bed):
+    bed.write(('\t'.join(BED_HEADER) + '\n').encode())
+
+
+def merge_streams(streams, out_bed_path, header=True):
+    with open(out_bed_path, 'wb') as bed:
+        if header:
+            write_bed_header(bed)
+        for _, line in heapq.merge(*streams, key=itemgetter(0)):
+            bed.write(line + b'\n')
+
+
+def merge_vcfs_to_bed(vcf_paths, out_bed_path, max_open):
+    # Ties between files are resolved by the order of vcf_paths, exactly as the stable in-memory sort did
+    if len(vcf_paths) == 1:
+        with open(out_bed_path, 'wb') as bed:
+            write_bed_header(bed)
+            for _, _, lines in iter_bed_blocks(vcf_paths[0]):
+                bed.write(lines)
+        return
+
+    if len(vcf_paths) <= max_open:
+        merge_streams([iter_variants_from_vcf(p) for p in vcf_paths], out_bed_path)
+        return
+
+    tmp_dir = tempfile.mkdtemp(prefix='bed_merge_', dir=os.path.dirname(out_bed_path))
+    part_ids = count()
+    try:
+        parts = []
+        for i in range(0, len(vcf_paths), max_open):
+            part_path = os.path.join(tmp_dir, f'part_{next(part_ids):05d}.bed')
+            chunk = vcf_paths[i:i + max_open]
+            merge_streams([iter_variants_from_vcf(p) for p in chunk], part_path, header=False)
+            parts.append(part_path)
+
+        while len(parts) > max_open:
+            merged = []
+            for i in range(0, len(parts), max_open):
+                part_path = os.path.join(tmp_dir, f'part_{next(part_ids):05d}.bed')
+                merge_streams([iter_bed_records(p) for p in parts[i:i + max_open]], part_path, header=False)
+                merged.append(part_path)
+            parts = merged
+
+        merge_streams([iter_bed_records(p) for p in parts], out_bed_path)
+    finally:
+        for name in os.listdir(tmp_dir):
+            os.remove(os.path.join(tmp_dir, name))
+        os.rmdir(tmp_dir)
+
+
+def sort_vcfs_to_bed(vcf_paths, out_bed_path):
+    all_records = []
+    for vcf_path in vcf_paths:
+        all_records.extend(iter_variants_from_vcf(vcf_path, check_sorted=False))
+
+    all_records.sort(key=itemgetter(0))
+
+    with open(out_bed_path, 'wb') as bed:
+        write_bed_header(bed)
+        for _, line in all_records:
+            bed.write(line + b'\n')
+
+
+def load_unchanged_clusters(diff_path):
+    with open(diff_path, 'r') as f:
+        reader = csv.DictReader(f, delimiter='\t')
+        return {row['indiv_id'] for row in reader if row['status'] == 'unchanged'}
+
+
+def build_cluster_bed(indiv_id, vcf_paths, outdir, max_open):
+    out_bed_path = os.path.join(outdir, f'{indiv_id}.bed')
+    tmp_bed_path = out_bed_path + '.tmp'
+    try:
+        merge_vcfs_to_bed(vcf_paths, tmp_bed_path, max_open)
+    except ValueError as e:
+        print(f'Warning: {e}; sorting cluster {indiv_id} in memory.', file=sys.stderr)
+        sort_vcfs_to_bed(vcf_paths, tmp_bed_path)
+    os.replace(tmp_bed_path, out_bed_path)
+    return indiv_id
+
+
 def main():
     args = parse_args()
 
@@ -206,22 +273,32 @@ def main():
         print('No clusters found (check metadata / paths).', file=sys.stderr)
         sys.exit(1)
 
-    for indiv_id, vcf_paths in tqdm(clusters.items(), desc='Clusters'):
-        if not vcf_paths:
-            continue
-
-        out_bed_path = os.path.join(outdir, f'{indiv_id}.bed')
-
-        all_records = []
-        for vcf_path in vcf_paths:
-            all_records.extend(extract_variants_from_vcf(vcf_path))
-
-        all_records.sort(key=lambda row: (*chrom_sort_key(row[0]), int(row[1])))
-
-        with open(out_bed_path, 'w') as bed:
-            bed.write('\t'.join(BED_HEADER) + '\n')
-            for rec in all_records:
-                bed.write('\t'.join(rec) + '\n')
+    max_open = max(2, args.max_open)
+    tasks = [(indiv_id, vcf_paths) for indiv_id, vcf_paths in clusters.items() if vcf_paths]
+
+    if args.skip_unchanged:
+        unchanged = load_unchanged_clusters(args.skip_unchanged)
+        n_tasks = len(tasks)
+        tasks = [
+            (indiv_id, vcf_paths) for indiv_id, vcf_paths in tasks
+            if not (indiv_id in unchanged and os.path.exists(os.path.join(outdir, f'{indiv_id}.bed')))
+        ]
+        print(f'Skipping {n_tasks - len(tasks)} unchanged clusters with existing BEDs.', file=sys.stderr)
+
+    if args.jobs <= 1:
+        for indiv_id, vcf_paths in tqdm(tasks, desc='Clusters'):
+            build_cluster_bed(indiv_id, vcf_paths, outdir, max_open)
+        return
+
+    # Biggest clusters first, so that a long one does not start last and hold up the whole pool
+    tasks.sort(key=lambda t: len(t[1]), reverse=True)
+    with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        futures = [
+            executor.submit(build_cluster_bed, indiv_id, vcf_paths, outdir, max_open)
+            for indiv_id, vcf_paths in tasks
+        ]
+        for future in tqdm(as_completed(futures), total=len(futures), desc='Clusters'):
+            future.result()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,147 @@
+from __future__ import annotations
+
+import argparse
+import os
+import shutil
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from clustering import BLOCK_ROWS, STORE_IDS, STORE_MATRIX, load_king_matrix, load_kinship_store, read_king_ids
+
+# Square plink2 KING matrices have 0.5 on the diagonal
+SELF_KINSHIP = 0.5
+
+
+def write_ids(path: Path, ids: list[str]) -> None:
+    with open(path, "wt") as f:
+        f.write("#IID\n")
+        for i in ids:
+            f.write(f"{i}\n")
+
+
+def new_store(store: Path) -> Path:
+    # The next version of the store is written into <store>.tmp and swapped in by commit_store
+    tmp = store.with_name(store.name + ".tmp")
+    shutil.rmtree(tmp, ignore_errors=True)
+    tmp.mkdir(parents=True)
+    return tmp
+
+
+def commit_store(store: Path, tmp: Path) -> None:
+    # ids.txt and kin.npy are swapped in together: a reader sees the old store or the new one, never a mix
+    old = store.with_name(store.name + ".old")
+    if store.exists():
+        os.replace(store, old)
+    os.replace(tmp, store)
+    shutil.rmtree(old, ignore_errors=True)
+
+
+def init_store(store: Path, king: Path, king_id: Path) -> None:
+    ids = read_king_ids(king_id)
+    kin = load_king_matrix(king, n=len(ids))
+    tmp = new_store(store)
+
+    out = np.lib.format.open_memmap(tmp / STORE_MATRIX, mode="w+", dtype=np.float32, shape=kin.shape)
+    for i in range(0, len(ids), BLOCK_ROWS):
+        out[i:i + BLOCK_ROWS] = kin[i:i + BLOCK_ROWS]
+    out.flush()
+    del out
+
+    write_ids(tmp / STORE_IDS, ids)
+    commit_store(store, tmp)
+
+
+def read_kin0(path: Path) -> pd.DataFrame:
+    # plink2 --make-king-table output, with or without FID columns
+    table = pd.read_csv(path, sep=r"\s+", dtype=str)
+    table.columns = [c.lstrip("#") for c in table.columns]
+    for c in ["IID1", "IID2", "KINSHIP"]:
+        if c not in table.columns:
+            raise ValueError(f"KING table must contain column: {c}")
+    table = table[["IID1", "IID2", "KINSHIP"]]
+    table["KINSHIP"] = pd.to_numeric(table["KINSHIP"], errors="coerce").astype(np.float32)
+    return table
+
+
+def append_to_store(store: Path, kin0: Path, new_ids_path: Path, missing: float) -> int:
+    ids, kin = load_kinship_store(store)
+    new_ids = read_king_ids(new_ids_path)
+    known = set(ids)
+    dup = [i for i in new_ids if i in known]
+    if dup:
+        raise ValueError(f"{len(dup)} new samples are already in the store, e.g. {dup[0]}")
+    if len(set(new_ids)) != len(new_ids):
+        raise ValueError(f"Duplicate sample ids in {new_ids_path}")
+
+    n_old = len(ids)
+    all_ids = ids + new_ids
+    n = len(all_ids)
+    pos = {i: k for k, i in enumerate(all_ids)}
+
+    table = read_kin0(kin0)
+    a = table["IID1"].map(pos)
+    b = table["IID2"].map(pos)
+    unknown = a.isna() | b.isna()
+    if unknown.any():
+        row = table[unknown].iloc[0]
+        raise ValueError(f"KING table pair {row['IID1']} {row['IID2']} has samples missing from store and new ids")
+    a = a.to_numpy(dtype=np.int64)
+    b = b.to_numpy(dtype=np.int64)
+    values = table["KINSHIP"].to_numpy()
+    new_pair = (a >= n_old) | (b >= n_old)
+
+    tmp = new_store(store)
+    out = np.lib.format.open_memmap(tmp / STORE_MATRIX, mode="w+", dtype=np.float32, shape=(n, n))
+    for i in range(0, n_old, BLOCK_ROWS):
+        end = min(i + BLOCK_ROWS, n_old)
+        out[i:end, :n_old] = kin[i:end]
+        out[i:end, n_old:] = missing
+    out[n_old:] = missing
+    out[np.arange(n_old, n), np.arange(n_old, n)] = SELF_KINSHIP
+    out[a[new_pair], b[new_pair]] = values[new_pair]
+    out[b[new_pair], a[new_pair]] = values[new_pair]
+    out.flush()
+    del out, kin
+
+    write_ids(tmp / STORE_IDS, all_ids)
+    commit_store(store, tmp)
+    return int(new_pair.sum())
+
+
+def main() -> None:
+    p = argparse.ArgumentParser(description="Persisted square KING kinship matrix that grows with new samples")
+    sub = p.add_subparsers(dest="command", required=True)
+
+    init = sub.add_parser("init", help="Create a store from a plink2 --make-king square matrix")
+    init.add_argument("--store", type=Path, required=True)
+    init.add_argument("--king", type=Path, required=True, help="plink2 --make-king square matrix, text or .king.bin")
+    init.add_argument("--king-id", type=Path, required=True)
+
+    append = sub.add_parser(
+        "append",
+        help="Add new samples from a plink2 --make-king-table --king-table-require <new ids> table"
+    )
+    append.add_argument("--store", type=Path, required=True)
+    append.add_argument("--kin0", type=Path, required=True, help="plink2 .kin0 table with all pairs involving a new sample")
+    append.add_argument("--new-ids", type=Path, required=True, help="New sample ids, one per line, as in .king.id")
+    append.add_argument(
+        "--missing",
+        type = float,
+        default = 0.0,
+        help = "Kinship for pairs absent from the table, e.g. dropped by --king-table-filter"
+    )
+
+    args = p.parse_args()
+
+    if args.command == "init":
+        init_store(args.store, args.king, args.king_id)
+        return
+
+    n_pairs = append_to_store(args.store, args.kin0, args.new_ids, args.missing)
+    print(f"[INFO] {args.store}: {n_pairs} kinship pairs added")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,29 +1,173 @@
 import argparse
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import shared_memory
 from pathlib import Path
 
 import numpy as np
 import matplotlib.pyplot as plt
+from scipy import sparse
 from scipy.cluster import hierarchy
-from scipy.spatial.distance import pdist
 
+BLOCK_ROWS = 1024
+# Largest share of the matrix entries a worker keeps as a sparse correction of the shared Gram matrix
+SPARSE_FRACTION = 1 / 16
 
-def compute_clusters_for_cutoff(args):
-    mat, zero_cutoff, cluster_cutoff = args
-    x = mat.copy()
+
+def zeroed_rows(mat, start, stop, zero_cutoff, cols = None):
+    x = (mat[start:stop] if cols is None else mat[start:stop, cols]).astype(np.float64)
     x[x < zero_cutoff] = 0.0
-    x = np.nan_to_num(x, nan = 0.0, posinf = 0.0, neginf = 0.0)
-    d = pdist(x, metric = 'correlation')
-    d = np.nan_to_num(d, nan = 1.0, posinf = 1.0, neginf = 1.0)
-    z = hierarchy.linkage(d, method = 'complete')
-    cl = hierarchy.fcluster(z, cluster_cutoff, criterion = 'distance')
-    return float(zero_cutoff), int(np.unique(cl).size)
+    return x
+
+
+def compute_base_gram(mat, zero_cutoff, out):
+    # x @ x.T of the matrix zeroed below the cutoff, written into out one pair of row blocks at a time
+    n = mat.shape[0]
+    for i in range(0, n, BLOCK_ROWS):
+        xi = zeroed_rows(mat, i, i + BLOCK_ROWS, zero_cutoff)
+        for k in range(i, n, BLOCK_ROWS):
+            block = xi @ zeroed_rows(mat, k, k + BLOCK_ROWS, zero_cutoff).T
+            out[i:i + BLOCK_ROWS, k:k + BLOCK_ROWS] = block
+            out[k:k + BLOCK_ROWS, i:i + BLOCK_ROWS] = block.T
+    return out
+
+
+class CorrelationState:
+    '''
+    Correlation distances between the rows of a matrix x zeroed below a cutoff, from the Gram matrix x @ x.T
+    and row sums, without pdist. The float32 matrix and the Gram matrix at the lowest cutoff are read-only and
+    shared by all workers; rows are cast to float64 one block at a time. For a higher cutoff a worker keeps
+    only the entries that crossed it, as a sparse matrix d, and corrects Gram blocks with it as they are needed.
+    Once d would hold more than SPARSE_FRACTION of the entries, Gram blocks are computed from the zeroed rows
+    instead. A worker thus needs about 12 * SPARSE_FRACTION * n^2 bytes for d and a few BLOCK_ROWS x n
+    float64 blocks, on top of the shared 4 * n^2 + 8 * n^2 bytes.
+    '''
+
+    def __init__(self, mat, base_cutoff, base_gram):
+        self.mat = mat
+        self.base_cutoff = base_cutoff
+        self.base_gram = base_gram
+
+    def set_cutoff(self, zero_cutoff):
+        n = self.mat.shape[0]
+        limit = int(SPARSE_FRACTION * n * n)
+        self.cutoff = zero_cutoff
+        self.sums = np.empty(n)
+        self.squares = np.empty(n)
+        self.constant = np.empty(n, dtype = bool)
+        rows, cols, values = [], [], []
+        nnz = 0
+        for i in range(0, n, BLOCK_ROWS):
+            x = zeroed_rows(self.mat, i, i + BLOCK_ROWS, self.base_cutoff)
+            removed = (x < zero_cutoff) & (x != 0.0)
+            if rows is not None:
+                r, c = np.nonzero(removed)
+                nnz += r.size
+                if nnz > limit:
+                    rows = None
+                else:
+                    rows.append(r + i)
+                    cols.append(c)
+                    values.append(x[r, c])
+            x[removed] = 0.0
+            self.sums[i:i + BLOCK_ROWS] = x.sum(axis = 1)
+            self.squares[i:i + BLOCK_ROWS] = np.einsum('ij,ij->i', x, x)
+            self.constant[i:i + BLOCK_ROWS] = np.ptp(x, axis = 1) == 0
+        if rows is None:
+            self.d = None
+        else:
+            self.d = sparse.csr_matrix(
+                (np.concatenate(values), (np.concatenate(rows), np.concatenate(cols))), shape = self.mat.shape
+            )
+
+    def gram_rows(self, start, stop, first):
+        # Gram matrix entries of rows start:stop and columns first: at the current cutoff
+        n = self.mat.shape[0]
+        if self.d is None:
+            x = zeroed_rows(self.mat, start, stop, self.cutoff)
+            g = np.empty((x.shape[0], n - first))
+            for k in range(first, n, BLOCK_ROWS):
+                g[:, k - first:k - first + BLOCK_ROWS] = x @ zeroed_rows(self.mat, k, k + BLOCK_ROWS, self.cutoff).T
+            return g
+
+        g = np.array(self.base_gram[start:stop, first:], dtype = np.float64)
+        if self.d.nnz == 0:
+            return g
+        # With d the removed entries, (x - d)(x - d).T = x x.T - d x.T - x d.T + d d.T
+        d_rows = self.d[start:stop]
+        d_cols = self.d[first:]
+        g -= (d_cols @ zeroed_rows(self.mat, start, stop, self.base_cutoff).T).T
+        used = np.unique(d_rows.indices)
+        if used.size:
+            d_used = d_rows[:, used]
+            for k in range(first, n, BLOCK_ROWS):
+                g[:, k - first:k - first + BLOCK_ROWS] -= d_used @ zeroed_rows(self.mat, k, k + BLOCK_ROWS, self.base_cutoff, used).T
+        g += (d_rows @ d_cols.T).toarray()
+        return g
+
+    def condensed_distance(self):
+        # Same values as pdist(x, metric = 'correlation') with NaN distances set to 1.0
+        n = self.mat.shape[0]
+        mean = self.sums / n
+        norm = np.sqrt(np.maximum(self.squares - self.sums * mean, 0.0))
+        constant = self.constant
+
+        cond = np.empty(n * (n - 1) // 2, dtype = np.float64)
+        offset = 0
+        for i in range(0, n, BLOCK_ROWS):
+            block = self.gram_rows(i, i + BLOCK_ROWS, i) - np.outer(self.sums[i:i + BLOCK_ROWS], mean[i:])
+            with np.errstate(divide = 'ignore', invalid = 'ignore'):
+                block = 1.0 - block / np.outer(norm[i:i + BLOCK_ROWS], norm[i:])
+            np.clip(block, 0.0, 2.0, out = block)
+            block[constant[i:i + BLOCK_ROWS]] = 1.0
+            block[:, constant[i:]] = 1.0
+            for a in range(block.shape[0]):
+                n_right = n - i - a - 1
+                cond[offset:offset + n_right] = block[a, a + 1:]
+                offset += n_right
+        return np.nan_to_num(cond, nan = 1.0, posinf = 1.0, neginf = 1.0)
+
+
+def compute_clusters_for_cutoffs(mat, base_cutoff, base_gram, zero_cutoffs, cluster_cutoff):
+    results = []
+    state = CorrelationState(mat, base_cutoff, base_gram)
+    for zero_cutoff in sorted(zero_cutoffs):
+        state.set_cutoff(zero_cutoff)
+        z = hierarchy.linkage(state.condensed_distance(), method = 'complete')
+        cl = hierarchy.fcluster(z, cluster_cutoff, criterion = 'distance')
+        results.append((float(zero_cutoff), int(np.unique(cl).size)))
+    return results
+
+
+def shared_array(shape, dtype):
+    shm = shared_memory.SharedMemory(create = True, size = int(np.prod(shape)) * np.dtype(dtype).itemsize)
+    return shm, np.ndarray(shape, dtype = dtype, buffer = shm.buf)
+
+
+def compute_clusters_in_shared_memory(mat_name, gram_name, shape, dtype, base_cutoff, zero_cutoffs, cluster_cutoff):
+    # Both blocks are attached read-only: workers never copy them
+    mat_shm = shared_memory.SharedMemory(name = mat_name)
+    gram_shm = shared_memory.SharedMemory(name = gram_name)
+    try:
+        mat = np.ndarray(shape, dtype = dtype, buffer = mat_shm.buf)
+        gram = np.ndarray(shape, dtype = np.float64, buffer = gram_shm.buf)
+        mat.flags.writeable = False
+        gram.flags.writeable = False
+        results = compute_clusters_for_cutoffs(mat, base_cutoff, gram, zero_cutoffs, cluster_cutoff)
+        del mat, gram
+        return results
+    finally:
+        mat_shm.close()
+        gram_shm.close()
 
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('--matrix', type = str, default = 'king_matrix.king')
     parser.add_argument('--threads', type = int, default = 1)
+    parser.add_argument(
+        '--backend', choices = ['process', 'thread'], default = 'process',
+        help = 'Workers for --threads > 1: processes sharing the matrix through shared memory, or threads'
+    )
     parser.add_argument('--outpath', type = str, default = './clustering')
     parser.add_argument('--cutoff-min', type = float, default = 0.0)
     parser.add_argument('--cutoff-max', type = float, default = 0.8)
@@ -40,13 +184,41 @@ def main():
 
     cutoffs = np.arange(args.cutoff_min, args.cutoff_max + args.cutoff_step / 2, args.cutoff_step, dtype = np.float32)
 
-    tasks = [(mat, c, args.cluster_cutoff) for c in cutoffs]
+    # The Gram matrix is built once at the lowest cutoff; each worker walks a contiguous run of cutoffs
+    # and only corrects it for the entries that crossed the cutoff
+    n_workers = max(1, min(args.threads, len(cutoffs)))
+    chunks = [c for c in np.array_split(cutoffs, n_workers) if len(c)]
+    base_cutoff = cutoffs.min()
 
-    if args.threads <= 1:
-        results = [compute_clusters_for_cutoff(t) for t in tasks]
+    if n_workers == 1 or args.backend == 'thread':
+        gram = compute_base_gram(mat, base_cutoff, np.empty(mat.shape, dtype = np.float64))
+        with ThreadPoolExecutor(max_workers = n_workers) as ex:
+            parts = ex.map(
+                compute_clusters_for_cutoffs, [mat] * len(chunks), [base_cutoff] * len(chunks), [gram] * len(chunks),
+                chunks, [args.cluster_cutoff] * len(chunks),
+            )
+            results = [r for part in parts for r in part]
     else:
-        with ThreadPoolExecutor(max_workers = args.threads) as ex:
-            results = list(ex.map(compute_clusters_for_cutoff, tasks))
+        mat_shm, shared_mat = shared_array(mat.shape, mat.dtype)
+        gram_shm, gram = shared_array(mat.shape, np.float64)
+        try:
+            shared_mat[...] = mat
+            del mat
+            compute_base_gram(shared_mat, base_cutoff, gram)
+            with ProcessPoolExecutor(max_workers = n_workers) as ex:
+                futures = [
+                    ex.submit(
+                        compute_clusters_in_shared_memory, mat_shm.name, gram_shm.name, shared_mat.shape,
+                        shared_mat.dtype, base_cutoff, c, args.cluster_cutoff,
+                    )
+                    for c in chunks
+                ]
+                results = [r for f in futures for r in f.result()]
+        finally:
+            del shared_mat, gram
+            for shm in (mat_shm, gram_shm):
+                shm.close()
+                shm.unlink()
 
     results = sorted(results, key = lambda x: x[0])
     xs = np.array([r[0] for r in results], dtype = float)
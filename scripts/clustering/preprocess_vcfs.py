@@ -0,0 +1,149 @@
+import sys, os, argparse, subprocess
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from tqdm.auto import tqdm
+
+from vcf_columns import open_vcf, read_sample_ids
+
+SUFFIX = '.vcf.gz'
+OUT_SUFFIX = '.without_MAF.vcf.gz'
+META_HEADER = ['indiv_id', 'tf', 'cell', 'algn_id', 'gse', 'path']
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Strip INFO/MAF from every VCF, index the result and write the merge lists and '
+                    'samples.meta.tsv, one bcftools call per file in a worker pool.'
+    )
+    parser.add_argument(
+        '--work',
+        required=True,
+        help='Working directory containing VCFs and clustering.'
+    )
+    parser.add_argument(
+        '-j', '--jobs',
+        type=int,
+        default=1,
+        help='Number of files processed concurrently (default: 1).'
+    )
+    parser.add_argument(
+        '--cutoff',
+        type=int,
+        default=100,
+        help='Minimum number of SNPs for a file to go to merged.min100.list (default: 100).'
+    )
+    parser.add_argument(
+        '--skip-existing',
+        action='store_true',
+        help='Do not rerun bcftools for files whose output and index are newer than the input.'
+    )
+    return parser.parse_args()
+
+
+def is_snp(ref, alt):
+    # bcftools view -v snps: a one-base REF with at least one one-base ALT allele
+    return len(ref) == 1 and any(len(a) == 1 and a not in ('.', '*') for a in alt.split(','))
+
+
+def read_head(vcf_path, cutoff):
+    '''
+    Sample id and the number of SNPs among the first records, counting stops at cutoff.
+    Only the header and a few records are decompressed, not the whole file.
+    '''
+    with open_vcf(vcf_path) as vcf:
+        samples = read_sample_ids(vcf)
+        if samples is None:
+            raise ValueError(f'{vcf_path}: no #CHROM header line')
+        n_snps = 0
+        for line in vcf:
+            if n_snps >= cutoff:
+                break
+            fields = line.split(b'\t', 5)
+            if len(fields) > 4 and is_snp(fields[3].decode(), fields[4].decode()):
+                n_snps += 1
+    if len(samples) != 1:
+        print(f'[WARN] {vcf_path}: {len(samples)} samples, the first one is used.', file=sys.stderr)
+    return (samples[0] if samples else ''), n_snps
+
+
+def is_fresh(vcf_path, out_path):
+    index = out_path + '.csi'
+    if not (os.path.exists(out_path) and os.path.exists(index)):
+        return False
+    src = os.path.getmtime(vcf_path)
+    return os.path.getmtime(out_path) >= src and os.path.getmtime(index) >= src
+
+
+def preprocess_vcf(vcf_path, cutoff, skip_existing):
+    out_path = vcf_path[:-len(SUFFIX)] + OUT_SUFFIX
+    if not (skip_existing and is_fresh(vcf_path, out_path)):
+        # Annotating, compressing and indexing in one bcftools process, the input is read once
+        subprocess.run(
+            ['bcftools', 'annotate', '-x', 'INFO/MAF', '-Oz', '-o', out_path, '--write-index', vcf_path],
+            check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+        )
+    sample_id, n_snps = read_head(out_path, cutoff)
+    return out_path, sample_id, n_snps
+
+
+def find_vcfs(vcf_dir):
+    return sorted(
+        os.path.join(vcf_dir, name) for name in os.listdir(vcf_dir)
+        if name.endswith(SUFFIX) and not name.endswith(OUT_SUFFIX) and not name.startswith('merged')
+    )
+
+
+def meta_row(out_path, sample_id):
+    base = os.path.basename(out_path)[:-len(OUT_SUFFIX)]
+    tf, cell, fileid, gse = (base.split('_', 3) + [''] * 4)[:4]
+    return [sample_id, tf, cell, fileid, gse, out_path]
+
+
+def main():
+    args = parse_args()
+
+    work_dir = os.path.abspath(args.work)
+    vcf_dir = os.path.join(work_dir, 'VCFs')
+    clustering_dir = os.path.join(work_dir, 'clustering')
+    os.makedirs(clustering_dir, exist_ok=True)
+
+    vcfs = find_vcfs(vcf_dir)
+    if not vcfs:
+        print(f'No VCFs found in {vcf_dir}.', file=sys.stderr)
+        sys.exit(1)
+
+    results = {}
+    failed = 0
+    with ThreadPoolExecutor(max_workers=max(1, args.jobs)) as executor:
+        futures = {executor.submit(preprocess_vcf, path, args.cutoff, args.skip_existing): path for path in vcfs}
+        for future in tqdm(as_completed(futures), total=len(futures), desc='VCFs'):
+            try:
+                out_path, sample_id, n_snps = future.result()
+            except subprocess.CalledProcessError as e:
+                failed += 1
+                print(f'[ERROR] {futures[future]}: {e.stderr.decode().strip()}', file=sys.stderr)
+                continue
+            except Exception as e:
+                failed += 1
+                print(f'[ERROR] {futures[future]}: {e}', file=sys.stderr)
+                continue
+            results[out_path] = (sample_id, n_snps)
+
+    out_paths = sorted(results)
+    with open(os.path.join(clustering_dir, 'merged.list'), 'w') as f:
+        f.writelines(f'{p}\n' for p in out_paths)
+    with open(os.path.join(clustering_dir, 'samples.meta.tsv'), 'w') as f:
+        f.write('\t'.join(META_HEADER) + '\n')
+        for p in out_paths:
+            f.write('\t'.join(meta_row(p, results[p][0])) + '\n')
+    with open(os.path.join(clustering_dir, 'merged.min100.list'), 'w') as f:
+        f.writelines(f'{p}\n' for p in out_paths if results[p][1] >= args.cutoff)
+
+    n_kept = sum(results[p][1] >= args.cutoff for p in out_paths)
+    print(f'{len(out_paths)} VCFs preprocessed, {n_kept} with at least {args.cutoff} SNPs.', file=sys.stderr)
+    if failed:
+        print(f'[ERROR] {failed} VCFs failed.', file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,299 @@
+import gzip
+from typing import Iterator, List, NamedTuple, Optional
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+BLOCK_BYTES = 1 << 24
+PAD = 1 << 12
+
+TAB, NEWLINE, COLON, COMMA, DOT, SLASH, CR, HASH, ZERO = (ord(c) for c in '\t\n:,./\r#0')
+
+
+class VariantBlock(NamedTuple):
+    '''One block of BED records as fixed-width bytes columns, one element per (VCF record, sample) pair.'''
+    chrom: np.ndarray
+    pos: np.ndarray
+    var_id: np.ndarray
+    ref: np.ndarray
+    alt: np.ndarray
+    ref_count: np.ndarray
+    alt_count: np.ndarray
+    sample_id: np.ndarray
+
+    def __len__(self):
+        return len(self.pos)
+
+
+def open_vcf(file_path):
+    if file_path.endswith('.gz'):
+        return gzip.open(file_path, 'rb')
+    return open(file_path, 'rb')
+
+
+def read_sample_ids(vcf) -> Optional[List[str]]:
+    '''Skips the meta lines of a VCF opened by open_vcf and returns sample ids from the #CHROM line, or None if data comes first.'''
+    for line in vcf:
+        line = line.decode().strip()
+        if not line or line.startswith('##'):
+            continue
+        if line.startswith('#CHROM'):
+            return line.split('\t')[9:]
+        return None
+    return None
+
+
+def take_bytes(buf: np.ndarray, start: np.ndarray, end: np.ndarray) -> np.ndarray:
+    '''buf[start:end] for every row as a NUL-padded uint8 matrix; buf must end with PAD zero bytes.'''
+    length = end - start
+    width = max(int(length.max(initial=0)), 1)
+    if width <= PAD:
+        field = sliding_window_view(buf, width)[start]
+    else:
+        field = buf[np.minimum(start[:, None] + np.arange(width), len(buf) - 1)]
+    field[np.arange(width) >= length[:, None]] = 0
+    return field
+
+
+def take_field(buf: np.ndarray, start: np.ndarray, end: np.ndarray) -> np.ndarray:
+    '''Gathers buf[start:end] for every row into a fixed-width bytes array.'''
+    field = take_bytes(buf, start, end)
+    return field.view(f'S{field.shape[1]}').ravel()
+
+
+def parse_int_field(buf: np.ndarray, start: np.ndarray, end: np.ndarray) -> np.ndarray:
+    length = end - start
+    digits = take_bytes(buf, start, end).astype(np.int64) - ZERO
+    inside = np.arange(digits.shape[1]) < length[:, None]
+    if np.any(inside & ((digits < 0) | (digits > 9))) or np.any(length <= 0):
+        raise ValueError('Could not convert VCF POS to integer')
+    value = np.zeros(len(start), dtype=np.int64)
+    for j in range(digits.shape[1]):
+        value = np.where(inside[:, j], value * 10 + digits[:, j], value)
+    return value
+
+
+def next_after(marks: np.ndarray, start: np.ndarray, k) -> np.ndarray:
+    '''Position of the k-th (0-based) mark at or after start; a sentinel past the buffer when there is none.'''
+    return marks[np.searchsorted(marks, start) + k]
+
+
+def split_ad(buf, colons, commas, sample_start, sample_end, ad_index):
+    '''Returns ref and alt counts as bytes, with the same fallbacks to '0' as the line parser had.'''
+    k = np.maximum(ad_index, 0)
+    prev_colon = next_after(colons, sample_start, k - 1)
+    found = (ad_index >= 0) & ((k == 0) | (prev_colon < sample_end))
+    ad_start = np.where(found, np.where(k == 0, sample_start, prev_colon + 1), sample_end)
+    ad_end = np.minimum(next_after(colons, sample_start, k), sample_end)
+    ad_len = ad_end - ad_start
+
+    missing = (
+        ~found
+        | ((ad_len == 1) & (buf[ad_start] == DOT))
+        | ((ad_len == 3) & (buf[ad_start] == DOT) & (buf[ad_start + 1] == SLASH) & (buf[ad_start + 2] == DOT))
+    )
+
+    first_comma = next_after(commas, ad_start, 0)
+    has_alt = first_comma < ad_end
+    ref_end = np.where(has_alt, first_comma, ad_end)
+    alt_start = np.where(has_alt, first_comma + 1, ad_end)
+    alt_end = np.where(has_alt, np.minimum(next_after(commas, ad_start, 1), ad_end), ad_end)
+
+    ref_count = take_field(buf, ad_start, ref_end)
+    alt_count = take_field(buf, alt_start, alt_end)
+    ref_count = np.where(missing, b'0', ref_count)
+    alt_count = np.where(missing | ~has_alt, b'0', alt_count)
+    return ref_count, alt_count
+
+
+def ad_indices(buf, format_start, format_end, format_cache) -> np.ndarray:
+    '''Index of AD in FORMAT for every row, -1 when absent; each distinct FORMAT is split once per file.'''
+    formats = take_field(buf, format_start, format_end)
+    if np.all(formats == formats[0]):
+        distinct, code = formats[:1], np.zeros(len(formats), dtype=np.int64)
+    else:
+        distinct, code = np.unique(formats, return_inverse=True)
+
+    index = []
+    for fmt in distinct.tolist():
+        if fmt not in format_cache:
+            keys = fmt.decode().split(':')
+            format_cache[fmt] = keys.index('AD') if 'AD' in keys else -1
+        index.append(format_cache[fmt])
+    return np.array(index, dtype=np.int64)[code.ravel()]
+
+
+def parse_lines(buf, tabs, line_start, line_end, sample_ids, format_cache, drop_missing_id) -> Optional[VariantBlock]:
+    '''Vectorized parser for lines that all have exactly one field per header column.'''
+    n_samples = len(sample_ids)
+    first_tab = np.searchsorted(tabs, line_start)
+    field_end = tabs[first_tab[:, None] + np.arange(8 + n_samples)]
+    field_end = np.concatenate([field_end, line_end[:, None]], axis=1)
+    field_start = np.concatenate([line_start[:, None], field_end[:, :-1] + 1], axis=1)
+
+    if drop_missing_id:
+        keep = ~((field_end[:, 2] - field_start[:, 2] == 1) & (buf[field_start[:, 2]] == DOT))
+        field_start, field_end = field_start[keep], field_end[keep]
+    n_lines = len(field_start)
+    if not n_lines:
+        return None
+
+    ad_index = ad_indices(buf, field_start[:, 8], field_end[:, 8], format_cache)
+
+    # Sentinels past the end of the data make "no further mark" lookups safe
+    sentinel = np.full(int(ad_index.max(initial=0)) + 2, len(buf))
+    colons = np.concatenate([np.flatnonzero(buf == COLON), sentinel])
+    commas = np.concatenate([np.flatnonzero(buf == COMMA), sentinel[:2]])
+
+    counts = [
+        split_ad(buf, colons, commas, field_start[:, 9 + i], field_end[:, 9 + i], ad_index)
+        for i in range(n_samples)
+    ]
+
+    def per_record(column):
+        return column if n_samples == 1 else np.repeat(column, n_samples)
+
+    def field(i):
+        return per_record(take_field(buf, field_start[:, i], field_end[:, i]))
+
+    return VariantBlock(
+        chrom=field(0),
+        pos=per_record(parse_int_field(buf, field_start[:, 1], field_end[:, 1])),
+        var_id=field(2),
+        ref=field(3),
+        alt=field(4),
+        ref_count=np.stack([c[0] for c in counts], axis=1).ravel(),
+        alt_count=np.stack([c[1] for c in counts], axis=1).ravel(),
+        sample_id=np.tile(np.array([s.encode() for s in sample_ids]), n_lines),
+    )
+
+
+def parse_irregular_line(line: str, sample_ids, drop_missing_id) -> Optional[VariantBlock]:
+    '''Line-by-line parser for records with missing or extra fields, kept from the original extractor.'''
+    line = line.strip()
+    if not line or line.startswith('#'):
+        return None
+    fields = line.split('\t')
+    if len(fields) < 9 or (drop_missing_id and fields[2] == '.'):
+        return None
+
+    format_keys = fields[8].split(':')
+    ad_index = format_keys.index('AD') if 'AD' in format_keys else None
+    records = []
+    for sample_id, sample in zip(sample_ids, fields[9:]):
+        ref_count = alt_count = '0'
+        values = sample.split(':')
+        if ad_index is not None and ad_index < len(values) and values[ad_index] not in ('.', './.'):
+            ad_counts = values[ad_index].split(',')
+            ref_count = ad_counts[0]
+            alt_count = ad_counts[1] if len(ad_counts) >= 2 else '0'
+        records.append((fields[0], int(fields[1]), fields[2], fields[3], fields[4], ref_count, alt_count, sample_id))
+    if not records:
+        return None
+
+    columns = list(zip(*records))
+    return VariantBlock(*(
+        np.array(col, dtype=np.int64) if name == 'pos' else np.array([v.encode() for v in col])
+        for name, col in zip(VariantBlock._fields, columns)
+    ))
+
+
+def concat_blocks(blocks: List[VariantBlock]) -> VariantBlock:
+    return VariantBlock(*(np.concatenate(cols) for cols in zip(*blocks)))
+
+
+def parse_buffer(data: bytes, sample_ids, format_cache, drop_missing_id) -> Optional[VariantBlock]:
+    buf = np.frombuffer(data + bytes(PAD), dtype=np.uint8)
+    line_end = np.flatnonzero(buf == NEWLINE)
+    line_start = np.concatenate([[0], line_end[:-1] + 1])
+    crlf = (line_end > line_start) & (buf[line_end - 1] == CR)
+    line_end = line_end - crlf
+
+    tabs = np.flatnonzero(buf == TAB)
+    n_tabs = np.searchsorted(tabs, line_end) - np.searchsorted(tabs, line_start)
+    regular = (n_tabs == 8 + len(sample_ids)) & (line_end > line_start) & (buf[line_start] != HASH)
+
+    if regular.all():
+        return parse_lines(buf, tabs, line_start, line_end, sample_ids, format_cache, drop_missing_id)
+
+    # Runs of regular lines stay vectorized, the odd lines in between go through the line parser
+    blocks = []
+    irregular = np.flatnonzero(~regular)
+    bounds = np.concatenate([[-1], irregular, [len(line_start)]])
+    for lo, hi in zip(bounds[:-1] + 1, bounds[1:]):
+        if hi > lo:
+            blocks.append(parse_lines(buf, tabs, line_start[lo:hi], line_end[lo:hi], sample_ids, format_cache, drop_missing_id))
+        if hi < len(line_start):
+            line = data[line_start[hi]:line_end[hi]].decode()
+            blocks.append(parse_irregular_line(line, sample_ids, drop_missing_id))
+    blocks = [b for b in blocks if b is not None]
+    return concat_blocks(blocks) if blocks else None
+
+
+def iter_vcf_blocks(vcf, sample_ids: List[str], drop_missing_id: bool = True, block_bytes: int = BLOCK_BYTES) -> Iterator[VariantBlock]:
+    '''
+    Reads the records of a VCF opened by open_vcf (positioned right after the #CHROM line)
+    in blocks of about block_bytes and yields them as NumPy columns: records in file order,
+    samples of one record in header order. Records with ID "." are dropped when drop_missing_id.
+    '''
+    format_cache = {}
+    tail = b''
+    while True:
+        data = vcf.read(block_bytes)
+        if not data:
+            break
+        data = tail + data
+        cut = data.rfind(b'\n') + 1
+        data, tail = data[:cut], data[cut:]
+        if data:
+            block = parse_buffer(data, sample_ids, format_cache, drop_missing_id)
+            if block is not None:
+                yield block
+    if tail:
+        block = parse_buffer(tail + b'\n', sample_ids, format_cache, drop_missing_id)
+        if block is not None:
+            yield block
+
+
+def int_bytes(values: np.ndarray) -> np.ndarray:
+    '''Decimal digits of integers as a uint8 matrix, right-aligned and NUL-padded, like str(int).'''
+    if values.min(initial=0) < 0:
+        return column_bytes(np.array([str(v).encode() for v in values.tolist()]))
+    width = len(str(int(values.max(initial=0))))
+    digits = np.empty((len(values), width), dtype=np.uint8)
+    rest = values.copy()
+    for j in range(width - 1, -1, -1):
+        digits[:, j] = rest % 10 + ZERO
+        rest //= 10
+    for j in range(width - 1):
+        digits[values < 10 ** (width - 1 - j), j] = 0
+    return digits
+
+
+def column_bytes(column: np.ndarray) -> np.ndarray:
+    column = np.ascontiguousarray(column)
+    return column.view(np.uint8).reshape(len(column), column.itemsize)
+
+
+def join_columns(columns: List[np.ndarray]) -> bytes:
+    '''Tab-separated, newline-terminated rows from NUL-padded uint8 matrices with one row per record.'''
+    n_rows = len(columns[0])
+    tab = np.full((n_rows, 1), TAB, dtype=np.uint8)
+    newline = np.full((n_rows, 1), NEWLINE, dtype=np.uint8)
+    parts = []
+    for column in columns:
+        parts.extend([column, tab])
+    parts[-1] = newline
+    # Dropping the NUL padding of every cell leaves exactly the joined text
+    text = np.concatenate(parts, axis=1).ravel()
+    return text[text != 0].tobytes()
+
+
+def format_bed_block(block: VariantBlock) -> bytes:
+    '''BED text of the block, one newline-terminated line per record in the column order of BED_HEADER.'''
+    return join_columns([
+        column_bytes(block.chrom), int_bytes(block.pos - 1), int_bytes(block.pos),
+        *(column_bytes(column) for column in (
+            block.var_id, block.ref, block.alt, block.ref_count, block.alt_count, block.sample_id,
+        )),
+    ])
@@ -1,9 +1,12 @@
-import argparse, sys
+import argparse, os, sys
 import numpy as np
 import pandas as pd
 import seaborn as sns
 import matplotlib.pyplot as plt
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'create_tables'))
+from tf_table_io import read_table
+
 def parse_size(size_str):
     try:
         width, height = size_str.split(':')
@@ -16,8 +19,8 @@ def parse_size(size_str):
 def main(old_path, new_path, style, size):
     plt.style.use(style)
     
-    df_old = pd.read_csv(old_path, sep='\t')
-    df_new = pd.read_csv(new_path, sep='\t')
+    df_old = read_table(old_path)
+    df_new = read_table(new_path)
     
     df_old.columns = [col.strip() for col in df_old.columns]
     df_new.columns = [col.strip() for col in df_new.columns]
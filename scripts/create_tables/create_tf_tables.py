@@ -1,26 +1,101 @@
 #!/usr/bin/env python3
 
+import os
 import sys
 import glob
 import argparse
 import warnings
 import numpy as np
 import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from snp_store import SnpStore, indiv_id_of, make_keys
+import tf_table_io
 warnings.filterwarnings('ignore')
 
-def main():
-    # Argument Parsing
-    parser = argparse.ArgumentParser(description = 'Script to merge MixALiME output and multiple BED files into one final TSV table.')
-    parser.add_argument('--mixalime', required = True, help = 'TSV file with MixALiME output.')
-    parser.add_argument('--bed', required = True, help = 'Glob pattern to find non-archived BED files.')
-    parser.add_argument('--output', required = True, help = 'Name of the final TSV table.')
-    args = parser.parse_args()
+KEY_COLUMNS = ['id', 'ref', 'alt']
+BED_COLUMNS = KEY_COLUMNS + ['SNP_per_segment', 'total_cover']
+CHUNK_ROWS = 1_000_000
+
+# Set once per worker process by init_worker, so the MixALiME keys are not pickled for every file
+KEYS = None
+
+
+class KeyIndex:
+    '''
+    Categorical codes for the (id, ref, alt) keys of the MixALiME table. A BED row is mapped
+    to its key through hash lookups of its three columns, so no per-row string key is ever
+    built; rows whose key is not in the table get -1.
+    '''
+
+    def __init__(self, ids, refs, alts):
+        self.levels = [pd.Index(pd.unique(v)) for v in (ids, refs, alts)]
+        self.sizes = [len(level) for level in self.levels]
+        combined = self.combine([level.get_indexer(v) for level, v in zip(self.levels, (ids, refs, alts))])
+        self.keys, self.inverse = np.unique(combined, return_inverse = True)
+
+    def combine(self, codes):
+        id_code, ref_code, alt_code = (np.asarray(c, dtype = np.int64) for c in codes)
+        combined = (id_code * self.sizes[1] + ref_code) * self.sizes[2] + alt_code
+        combined[(id_code < 0) | (ref_code < 0) | (alt_code < 0)] = -1
+        return combined
+
+    def lookup(self, chunk):
+        # Missing values are matched as the string 'nan', as in the MixALiME keys
+        codes = [level.get_indexer(chunk[col].fillna('nan')) for level, col in zip(self.levels, KEY_COLUMNS)]
+        combined = self.combine(codes)
+        pos = np.searchsorted(self.keys, combined)
+        pos[pos == len(self.keys)] = 0
+        return np.where((combined >= 0) & (self.keys[pos] == combined), pos, -1)
+
+
+def init_worker(keys):
+    global KEYS
+    KEYS = keys
+
 
+def aggregate_beds(bed_files, chunk_rows):
+    '''Per-key sums of total_cover and SNP_per_segment over BED files, read in chunks of the needed columns.'''
+    n = len(KEYS.keys)
+    cover = np.zeros(n, dtype = np.float64)
+    segment_sum = np.zeros(n, dtype = np.float64)
+    segment_count = np.zeros(n, dtype = np.int64)
+    cover_is_int = True
+
+    for bf in bed_files:
+        try:
+            header = pd.read_csv(bf, sep = r'\s+', nrows = 0).columns
+            for col in ['#chr'] + BED_COLUMNS:
+                if col not in header:
+                    raise KeyError(col)
+            reader = pd.read_csv(
+                bf, sep = r'\s+', usecols = BED_COLUMNS, chunksize = chunk_rows,
+                dtype = {'id': str, 'ref': str, 'alt': str, 'SNP_per_segment': np.float64},
+            )
+            for chunk in reader:
+                key = KEYS.lookup(chunk)
+                found = key >= 0
+                cover_is_int &= pd.api.types.is_integer_dtype(chunk['total_cover'])
+                tc = chunk['total_cover'].to_numpy(dtype = np.float64)
+                ok = found & ~np.isnan(tc)
+                cover += np.bincount(key[ok], weights = tc[ok], minlength = n)
+                sps = chunk['SNP_per_segment'].to_numpy()
+                ok = found & ~np.isnan(sps)
+                segment_sum += np.bincount(key[ok], weights = sps[ok], minlength = n)
+                segment_count += np.bincount(key[ok], minlength = n)
+        except KeyError as err:
+            raise ValueError('BED files missing column ' + str(err).strip("'") + '.')
+        except Exception as e:
+            raise ValueError('Error reading BED file ' + bf + ': ' + str(e))
+
+    return cover, segment_sum, segment_count, cover_is_int
+
+
+def read_mixalime(path):
     # Reading MixALiME TSV File
     try:
-        df_mix = pd.read_csv(args.mixalime, sep = '\t')
+        df_mix = pd.read_csv(path, sep = '\t')
     except Exception as e:
-        sys.exit('Error reading MixALiME file: ' + str(e))
+        raise ValueError('Error reading MixALiME file: ' + str(e))
 
     # Creating final DataFrame with selected columns from MixALiME file
     try:
@@ -39,57 +114,79 @@ def main():
             'fdrp_bh_alt': df_mix['alt_fdr_comb_pval']
         })
     except KeyError as err:
-        sys.exit('Required column not found in MixALiME file: ' + str(err))
+        raise ValueError('Required column not found in MixALiME file: ' + str(err))
 
     # Adding empty columns for placeholders
     empty_cols = ['repeat_type', 'motif_log_pref', 'motif_log_palt', 'motif_fc', 'motif_pos', 'motif_orient', 'motif_conc', 'motif_index']
     for col in empty_cols:
         df_final[col] = ''
+    return df_final
 
-    # Creating temporary key column 'id_ref_alt' in final DataFrame
-    df_final['id_ref_alt'] = df_final['ID'].astype(str) + '_' + df_final['ref'].astype(str) + '_' + df_final['alt'].astype(str)
 
-    # Reading and combining BED files
-    bed_files = glob.glob(args.bed)
-    if not bed_files:
-        sys.exit('No BED files found with pattern: ' + args.bed)
+def aggregate(keys, bed_files, jobs, chunk_rows):
+    # Aggregating BED data: sum of total_cover and mean of SNP_per_segment, partial sums per group of files
+    n_jobs = max(1, min(jobs, len(bed_files)))
+    if n_jobs == 1:
+        init_worker(keys)
+        parts = [aggregate_beds(bed_files, chunk_rows)]
+    else:
+        groups = [bed_files[i::n_jobs] for i in range(n_jobs)]
+        with ProcessPoolExecutor(max_workers = n_jobs, initializer = init_worker, initargs = (keys,)) as ex:
+            parts = list(ex.map(aggregate_beds, groups, [chunk_rows] * n_jobs))
 
-    bed_dfs = []
-    for bf in bed_files:
-        try:
-            df_bed = pd.read_csv(bf, delim_whitespace = True)
-            bed_dfs.append(df_bed)
-        except Exception as e:
-            sys.exit('Error reading BED file ' + bf + ': ' + str(e))
-    df_bed_all = pd.concat(bed_dfs, ignore_index = True)
-
-    # Sorting BED data and creating temporary key column 'id_ref_alt'
-    if '#chr' not in df_bed_all.columns:
-        sys.exit('BED files missing column "#chr".')
-    df_bed_all.sort_values(by = ['#chr', 'start'], inplace = True)
-    for col in ['id', 'ref', 'alt']:
-        if col not in df_bed_all.columns:
-            sys.exit('BED files missing column ' + col + '.')
-    df_bed_all['id_ref_alt'] = df_bed_all['id'].astype(str) + '_' + df_bed_all['ref'].astype(str) + '_' + df_bed_all['alt'].astype(str)
-
-    # Aggregating BED data: sum of total_cover and mean of SNP_per_segment
-    for col in ['total_cover', 'SNP_per_segment']:
-        if col not in df_bed_all.columns:
-            sys.exit('BED files missing column ' + col + '.')
-    bed_agg = df_bed_all.groupby('id_ref_alt').agg({'total_cover': 'sum', 'SNP_per_segment': 'mean'}).reset_index()
-
-    # Merging aggregated BED data with final DataFrame
-    df_final = df_final.merge(bed_agg, on = 'id_ref_alt', how = 'left')
+    cover = sum(p[0] for p in parts)
+    segment_sum = sum(p[1] for p in parts)
+    segment_count = sum(p[2] for p in parts)
+    return cover, segment_sum, segment_count, all(p[3] for p in parts)
+
+
+def aggregate_store(keys, key_cols, bed_files, store_path):
+    '''The sums of aggregate, looked up in a SNP store built by snp_store.py instead of parsing the BED files.'''
+    store = SnpStore(store_path)
+    missing = [p for p in bed_files if indiv_id_of(p) not in store.indiv_code]
+    if missing:
+        raise ValueError(f'{len(missing)} BED files are not in the SNP store {store_path}, e.g. {missing[0]}: run snp_store.py append')
+
+    # Store key code -> aggregation key code, through the MixALiME rows holding each key
+    mix_keys = make_keys(*(np.concatenate([cols[i].to_numpy() for cols in key_cols]) for i in range(3)))
+    codes = store.key_codes(mix_keys)
+    to_key = np.full(len(store.keys), -1, dtype = np.int64)
+    to_key[codes[codes >= 0]] = keys.inverse[codes >= 0]
+
+    n = len(keys.keys)
+    cover = np.zeros(n, dtype = np.float64)
+    segment_sum = np.zeros(n, dtype = np.float64)
+    segment_count = np.zeros(n, dtype = np.int64)
+    cover_is_int = True
+    for path in bed_files:
+        i = store.indiv_code[indiv_id_of(path)]
+        recs = store.records(i)
+        key = to_key[store.rec_key[recs]]
+        found = key >= 0
+        cover_is_int &= bool(store.int_cover[i])
+        tc = store.rec_cover[recs]
+        ok = found & ~np.isnan(tc)
+        cover += np.bincount(key[ok], weights = tc[ok], minlength = n)
+        sps = store.rec_segment[recs]
+        ok = found & ~np.isnan(sps)
+        segment_sum += np.bincount(key[ok], weights = sps[ok], minlength = n)
+        segment_count += np.bincount(key[ok], minlength = n)
+    return cover, segment_sum, segment_count, cover_is_int
+
+
+def write_table(df_final, key_cols, inverse, sums, output, binary = None):
+    cover, segment_sum, segment_count, cover_is_int = sums
 
     # Checking for missing aggregated data
-    missing = df_final['total_cover'].isnull() | df_final['SNP_per_segment'].isnull()
+    missing = segment_count[inverse] == 0
     if missing.any():
-        missing_ids = df_final.loc[missing, 'id_ref_alt'].unique()
-        sys.exit('No matching BED entries found for id_ref_alt: ' + ', '.join(missing_ids))
+        key_str = key_cols[0] + '_' + key_cols[1] + '_' + key_cols[2]
+        missing_ids = key_str[missing].unique()
+        raise ValueError('No matching BED entries found for id_ref_alt: ' + ', '.join(missing_ids))
 
-    # Renaming aggregated column and cleaning up temporary columns
-    df_final.rename(columns = {'SNP_per_segment': 'mean_SNP_per_segment'}, inplace = True)
-    df_final.drop(columns = ['id_ref_alt'], inplace = True)
+    total_cover = cover[inverse]
+    df_final['total_cover'] = total_cover.astype(np.int64) if cover_is_int else total_cover
+    df_final['mean_SNP_per_segment'] = segment_sum[inverse] / segment_count[inverse]
 
     # Reordering final DataFrame columns
     final_order = ['chr', 'start', 'end', 'ID', 'ref', 'alt', 'repeat_type', 'mean_BAD', 'mean_SNP_per_segment', 'n_aggregated', 'total_cover', 'es_mean_ref', 'es_mean_alt', 'fdrp_bh_ref', 'fdrp_bh_alt', 'motif_log_pref', 'motif_log_palt', 'motif_fc', 'motif_pos', 'motif_orient', 'motif_conc', 'motif_index']
@@ -103,9 +200,123 @@ def main():
 
     # Saving final TSV file
     try:
-        df_final.to_csv(args.output, sep = '\t', index = False)
+        tf_table_io.write_table(df_final, output, binary)
     except Exception as e:
-        sys.exit('Error saving final file: ' + str(e))
+        raise ValueError('Error saving final file: ' + str(e))
+
+
+def build_tables(pairs, bed_pattern, jobs, chunk_rows, store = None, binary = None):
+    '''
+    Writes one table per (MixALiME file, output) pair from a single pass over the BED files,
+    or over their records in the SNP store, aggregated on the union of their keys.
+    Returns error messages, one per table that failed.
+    '''
+    errors = []
+    tables = []
+    for mixalime, output in pairs:
+        try:
+            tables.append((read_mixalime(mixalime), output))
+        except ValueError as e:
+            errors.append(f'{mixalime}: {e}' if len(pairs) > 1 else str(e))
+    if not tables:
+        return errors
+
+    # Codes of the (ID, ref, alt) keys that BED rows are aggregated into
+    key_cols = [[df_final[col].fillna('nan').astype(str) for col in ['ID', 'ref', 'alt']] for df_final, _ in tables]
+    keys = KeyIndex(*(np.concatenate([cols[i].to_numpy() for cols in key_cols]) for i in range(3)))
+
+    bed_files = glob.glob(bed_pattern)
+    if not bed_files:
+        return errors + ['No BED files found with pattern: ' + bed_pattern]
+    try:
+        sums = aggregate_store(keys, key_cols, bed_files, store) if store else aggregate(keys, bed_files, jobs, chunk_rows)
+    except ValueError as e:
+        return errors + [str(e)]
+
+    offset = 0
+    for (df_final, output), cols in zip(tables, key_cols):
+        inverse = keys.inverse[offset:offset + len(df_final)]
+        offset += len(df_final)
+        try:
+            write_table(df_final, cols, inverse, sums, output, binary)
+        except ValueError as e:
+            errors.append(f'{output}: {e}' if len(pairs) > 1 else str(e))
+    return errors
+
+
+def find_tf_jobs(mixalime_dir, models, output_dir, tfs):
+    # results_<model>/pvalues/<TF>.tsv for every model, grouped by TF
+    jobs = {}
+    for model in models:
+        pvalues_dir = os.path.join(mixalime_dir, f'results_{model}', 'pvalues')
+        names = [f'{tf}.tsv' for tf in tfs] if tfs else sorted(os.listdir(pvalues_dir)) if os.path.isdir(pvalues_dir) else []
+        for name in names:
+            path = os.path.join(pvalues_dir, name)
+            if name.endswith('.tsv') and os.path.exists(path):
+                tf = name[:-len('.tsv')]
+                jobs.setdefault(tf, []).append((path, os.path.join(output_dir, f'{tf}_HUMAN_{model}.tsv')))
+    return jobs
+
+
+def build_tf(tf, pairs, bed_pattern, chunk_rows, store, binary):
+    return build_tables(pairs, bed_pattern.replace('{tf}', tf), 1, chunk_rows, store, binary)
+
+
+def main():
+    # Argument Parsing
+    parser = argparse.ArgumentParser(description = 'Script to merge MixALiME output and multiple BED files into one final TSV table.')
+    parser.add_argument('--mixalime', action = 'append', help = 'TSV file with MixALiME output; repeat together with --output for several tables over the same BEDs.')
+    parser.add_argument('--bed', help = 'Glob pattern to find non-archived BED files.')
+    parser.add_argument('--output', action = 'append', help = 'Name of the final TSV table, one per --mixalime.')
+    parser.add_argument('--mixalime-dir', help = 'Directory mode: MixALiME directory with results_<model>/pvalues/<TF>.tsv.')
+    parser.add_argument('--bed-pattern', help = 'Directory mode: BED glob pattern where {tf} stands for the TF name.')
+    parser.add_argument('--output-dir', help = 'Directory mode: directory for <TF>_HUMAN_<model>.tsv tables.')
+    parser.add_argument('--models', nargs = '+', default = ['MCNB', 'NB', 'BetaNB'], help = 'Directory mode: models to build tables for.')
+    parser.add_argument('--tfs', help = 'Directory mode: file with TF names, one per line (default: every TF with MixALiME output).')
+    parser.add_argument('--jobs', type = int, default = 1, help = 'Number of processes reading BED files, or building TFs in directory mode.')
+    parser.add_argument('--chunk-rows', type = int, default = CHUNK_ROWS, help = 'BED rows read at once.')
+    parser.add_argument('--store', help = 'SNP store from snp_store.py: take the BED values from it instead of reading the BED files.')
+    parser.add_argument('--binary', choices = list(tf_table_io.BINARY_FORMATS), help = 'Also write every table as <name>.parquet or <name>.feather, which readers take instead of the TSV.')
+    args = parser.parse_args()
+
+    if not args.mixalime_dir:
+        if not (args.mixalime and args.output and args.bed):
+            parser.error('--mixalime, --bed and --output are required unless --mixalime-dir is given')
+        if len(args.mixalime) != len(args.output):
+            parser.error('every --mixalime needs its own --output')
+        errors = build_tables(list(zip(args.mixalime, args.output)), args.bed, args.jobs, args.chunk_rows, args.store, args.binary)
+        if errors:
+            sys.exit('\n'.join(errors))
+        return
+
+    if not (args.bed_pattern and args.output_dir):
+        parser.error('--mixalime-dir requires --bed-pattern and --output-dir')
+    tfs = None
+    if args.tfs:
+        with open(args.tfs) as f:
+            tfs = [line.strip() for line in f if line.strip()]
+    os.makedirs(args.output_dir, exist_ok = True)
+    jobs = find_tf_jobs(args.mixalime_dir, args.models, args.output_dir, tfs)
+
+    failed = 0
+    with ProcessPoolExecutor(max_workers = max(1, args.jobs)) as ex:
+        futures = {
+            ex.submit(build_tf, tf, pairs, args.bed_pattern, args.chunk_rows, args.store, args.binary): tf for tf, pairs in sorted(jobs.items())
+        }
+        for future in as_completed(futures):
+            tf = futures[future]
+            try:
+                errors = future.result()
+            except Exception as e:
+                errors = [str(e)]
+            if errors:
+                failed += 1
+                for e in errors:
+                    print(f'[ERROR] {tf}: {e}', file = sys.stderr)
+            else:
+                print(f'[INFO] {tf}: {len(jobs[tf])} tables', file = sys.stderr)
+    if failed:
+        sys.exit(f'{failed} of {len(jobs)} TFs failed')
 
 if __name__=='__main__':
     main()
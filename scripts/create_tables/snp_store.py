@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import glob
+import shutil
+import argparse
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+
+BED_SUFFIX = '.with_bad.bed'
+BED_COLUMNS = ['id', 'ref', 'alt', 'SNP_per_segment', 'total_cover']
+KEY_SEP = b'\t'
+BLOCK_ROWS = 1 << 24
+
+INDIVIDUALS = 'individuals.txt'
+KEYS = 'keys.npy'
+INDIV_OFFSETS = 'indiv_offsets.npy'
+REC_KEY = 'rec_key.npy'
+REC_COVER = 'rec_cover.npy'
+REC_SEGMENT = 'rec_segment.npy'
+INDIV_INT_COVER = 'indiv_int_cover.npy'
+KEY_OFFSETS = 'key_offsets.npy'
+KEY_RECORDS = 'key_records.npy'
+
+
+def make_keys(ids, refs, alts):
+    # 'id<TAB>ref<TAB>alt' as bytes: sorting these sorts by (id, ref, alt), since TAB is below every printable byte
+    ids, refs, alts = (pd.Series(v).fillna('nan').astype(str) for v in (ids, refs, alts))
+    return (ids + '\t' + refs + '\t' + alts).str.encode('utf-8').to_numpy().astype(bytes)
+
+
+def read_bed(path):
+    '''Keys, total_cover and SNP_per_segment of one annotated BED.'''
+    try:
+        table = pd.read_csv(
+            path, sep = r'\s+', usecols = BED_COLUMNS,
+            dtype = {'id': str, 'ref': str, 'alt': str, 'SNP_per_segment': np.float64},
+        )
+    except Exception as e:
+        raise ValueError('Error reading BED file ' + path + ': ' + str(e))
+    # create_tf_tables.py writes integer coverage unless a BED has missing total_cover
+    int_cover = pd.api.types.is_integer_dtype(table['total_cover'])
+    keys = make_keys(table['id'], table['ref'], table['alt'])
+    return keys, table['total_cover'].to_numpy(dtype = np.float64), table['SNP_per_segment'].to_numpy(), int_cover
+
+
+def indiv_id_of(path):
+    name = os.path.basename(path)
+    return name[:-len(BED_SUFFIX)] if name.endswith(BED_SUFFIX) else os.path.splitext(name)[0]
+
+
+class SnpStore:
+    '''
+    Per-(individual, SNP) total_cover and SNP_per_segment of every annotated BED, as memmapped arrays.
+    Records are grouped by individual (indiv_offsets), and keys.npy holds the sorted
+    'id<TAB>ref<TAB>alt' keys the records point to. key_records lists the records of every key,
+    so the individuals covering a SNP are found without a scan.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, INDIVIDUALS)) as f:
+            self.individuals = [line.strip() for line in f if line.strip()]
+        self.indiv_code = {indiv_id: i for i, indiv_id in enumerate(self.individuals)}
+        load = lambda name: np.load(os.path.join(path, name), mmap_mode = 'r')
+        self.keys = load(KEYS)
+        self.indiv_offsets = load(INDIV_OFFSETS)
+        self.rec_key = load(REC_KEY)
+        self.rec_cover = load(REC_COVER)
+        self.rec_segment = load(REC_SEGMENT)
+        self.int_cover = load(INDIV_INT_COVER)
+        self.key_offsets = load(KEY_OFFSETS)
+        self.key_records = load(KEY_RECORDS)
+        if len(self.indiv_offsets) != len(self.individuals) + 1 or len(self.key_offsets) != len(self.keys) + 1:
+            raise ValueError(f'SNP store {path} is inconsistent: rebuild it')
+
+    def records(self, i):
+        return slice(int(self.indiv_offsets[i]), int(self.indiv_offsets[i + 1]))
+
+    def key_codes(self, keys):
+        '''Codes of keys made by make_keys, -1 for keys absent from the store.'''
+        pos = np.searchsorted(self.keys, keys)
+        pos[pos == len(self.keys)] = 0
+        return np.where(self.keys[pos] == keys, pos, -1)
+
+    def covering(self, snp_id):
+        # Keys of one id are contiguous: they share the 'id<TAB>' prefix
+        prefix = snp_id.encode('utf-8') + KEY_SEP
+        lo, hi = np.searchsorted(self.keys, [prefix, prefix + b'\xff'])
+        recs = np.asarray(self.key_records[self.key_offsets[lo]:self.key_offsets[hi]])
+        key = np.repeat(np.arange(lo, hi), np.diff(self.key_offsets[lo:hi + 1]))
+        indiv = np.searchsorted(self.indiv_offsets, recs, side = 'right') - 1
+        alleles = [self.keys[k].decode().split('\t')[1:] for k in key]
+        return pd.DataFrame({
+            'id': snp_id,
+            'ref': [a[0] for a in alleles],
+            'alt': [a[1] for a in alleles],
+            'indiv_id': [self.individuals[i] for i in indiv],
+            'total_cover': pd.array(self.rec_cover[recs]).astype('Int64' if self.int_cover[indiv].all() else 'Float64'),
+            'SNP_per_segment': self.rec_segment[recs],
+        })
+
+
+def write_store(path, individuals, keys, sizes, int_cover, parts):
+    '''
+    Writes a store next to path and swaps it in. sizes and int_cover hold the record count and
+    integer cover flag of every individual; parts yields their (key codes, cover, segment) in the
+    order of individuals and is consumed one individual at a time into the memmapped arrays.
+    '''
+    tmp = path + '.tmp'
+    shutil.rmtree(tmp, ignore_errors = True)
+    os.makedirs(tmp)
+    if len(keys) >= np.iinfo(np.int32).max:
+        raise ValueError('Too many SNP keys for int32 record codes')
+
+    offsets = np.concatenate([[0], np.cumsum(sizes, dtype = np.int64)])
+    n = int(offsets[-1])
+
+    rec_key = np.lib.format.open_memmap(os.path.join(tmp, REC_KEY), mode = 'w+', dtype = np.int32, shape = (n,))
+    rec_cover = np.lib.format.open_memmap(os.path.join(tmp, REC_COVER), mode = 'w+', dtype = np.float64, shape = (n,))
+    rec_segment = np.lib.format.open_memmap(os.path.join(tmp, REC_SEGMENT), mode = 'w+', dtype = np.float64, shape = (n,))
+    for (codes, cover, segment), start, end in zip(parts, offsets[:-1], offsets[1:]):
+        rec_key[start:end] = codes
+        rec_cover[start:end] = cover
+        rec_segment[start:end] = segment
+
+    # Records of every key: a stable counting sort of record numbers by key, BLOCK_ROWS records at a time
+    counts = np.zeros(len(keys), dtype = np.int64)
+    for i in range(0, n, BLOCK_ROWS):
+        counts += np.bincount(rec_key[i:i + BLOCK_ROWS], minlength = len(keys))
+    key_offsets = np.concatenate([[0], np.cumsum(counts)])
+    key_records = np.lib.format.open_memmap(os.path.join(tmp, KEY_RECORDS), mode = 'w+', dtype = np.int64, shape = (n,))
+    next_slot = key_offsets[:-1].copy()
+    for i in range(0, n, BLOCK_ROWS):
+        block = np.asarray(rec_key[i:i + BLOCK_ROWS])
+        order = np.argsort(block, kind = 'stable')
+        codes = block[order]
+        # Rank of every record among the records of its key in this block
+        rank = np.arange(len(codes)) - np.searchsorted(codes, codes)
+        key_records[next_slot[codes] + rank] = i + order
+        next_slot += np.bincount(block, minlength = len(keys))
+    del next_slot
+
+    for arr in (rec_key, rec_cover, rec_segment, key_records):
+        arr.flush()
+    del rec_key, rec_cover, rec_segment, key_records
+    np.save(os.path.join(tmp, KEYS), keys)
+    np.save(os.path.join(tmp, INDIV_OFFSETS), offsets)
+    np.save(os.path.join(tmp, KEY_OFFSETS), key_offsets)
+    np.save(os.path.join(tmp, INDIV_INT_COVER), np.asarray(int_cover, dtype = bool))
+    with open(os.path.join(tmp, INDIVIDUALS), 'w') as f:
+        f.writelines(f'{indiv_id}\n' for indiv_id in individuals)
+
+    old = path + '.old'
+    if os.path.exists(path):
+        os.replace(path, old)
+    os.replace(tmp, path)
+    shutil.rmtree(old, ignore_errors = True)
+    return n
+
+
+def read_beds(bed_files, jobs):
+    with ProcessPoolExecutor(max_workers = max(1, jobs)) as ex:
+        return list(ex.map(read_bed, bed_files, chunksize = 4))
+
+
+def union_keys(keys, key_arrays):
+    # Sorted union, merging about BLOCK_ROWS new keys at a time instead of one array of all of them
+    pending, rows = [], 0
+    for k in key_arrays:
+        pending.append(k)
+        rows += len(k)
+        if rows >= BLOCK_ROWS:
+            keys = np.unique(np.concatenate([keys] + pending))
+            pending, rows = [], 0
+    if pending:
+        keys = np.unique(np.concatenate([keys] + pending))
+    return keys
+
+
+def build_store(path, bed_files, jobs):
+    beds = read_beds(bed_files, jobs)
+    keys = union_keys(np.array([], dtype = bytes), (b[0] for b in beds))
+    parts = ((np.searchsorted(keys, k), cover, segment) for k, cover, segment, _ in beds)
+    sizes = [len(b[0]) for b in beds]
+    int_cover = [b[3] for b in beds]
+    return write_store(path, [indiv_id_of(p) for p in bed_files], keys, sizes, int_cover, parts)
+
+
+def append_store(path, bed_files, jobs):
+    store = SnpStore(path)
+    new_ids = [indiv_id_of(p) for p in bed_files]
+    dup = [i for i in new_ids if i in store.indiv_code]
+    if dup:
+        raise ValueError(f'{len(dup)} individuals are already in the store, e.g. {dup[0]}')
+
+    beds = read_beds(bed_files, jobs)
+    keys = union_keys(np.asarray(store.keys), (b[0] for b in beds))
+    remap = np.searchsorted(keys, store.keys)
+
+    def parts():
+        for i in range(len(store.individuals)):
+            recs = store.records(i)
+            yield remap[store.rec_key[recs]], store.rec_cover[recs], store.rec_segment[recs]
+        for k, cover, segment, _ in beds:
+            yield np.searchsorted(keys, k), cover, segment
+
+    sizes = np.concatenate([np.diff(store.indiv_offsets), [len(b[0]) for b in beds]])
+    int_cover = np.concatenate([store.int_cover, [b[3] for b in beds]])
+    return write_store(path, store.individuals + new_ids, keys, sizes, int_cover, parts())
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Store of per-(individual, SNP) coverage and BAD segment sizes from annotated BED files.')
+    sub = parser.add_subparsers(dest = 'command', required = True)
+
+    build = sub.add_parser('build', help = 'Create the store from every BED matching --bed')
+    append = sub.add_parser('append', help = 'Add individuals that are not in the store yet')
+    for p in (build, append):
+        p.add_argument('--store', required = True, help = 'Store directory.')
+        p.add_argument('--bed', required = True, help = 'Glob pattern of *.with_bad.bed files, one per individual.')
+        p.add_argument('--jobs', type = int, default = 1, help = 'Number of processes reading BED files.')
+
+    query = sub.add_parser('query', help = 'Individuals that cover a SNP id, with their total_cover and SNP_per_segment')
+    query.add_argument('--store', required = True, help = 'Store directory.')
+    query.add_argument('--id', required = True, nargs = '+', help = 'SNP ids, e.g. rs123.')
+    args = parser.parse_args()
+
+    try:
+        if args.command == 'query':
+            store = SnpStore(args.store)
+            pd.concat([store.covering(i) for i in args.id]).to_csv(sys.stdout, sep = '\t', index = False)
+            return
+
+        bed_files = sorted(glob.glob(args.bed))
+        if args.command == 'build':
+            if not bed_files:
+                sys.exit('No BED files found with pattern: ' + args.bed)
+            n = build_store(args.store, bed_files, args.jobs)
+        else:
+            n = append_store(args.store, bed_files, args.jobs)
+    except ValueError as e:
+        sys.exit(str(e))
+    print(f'[INFO] {args.store}: {n} records', file = sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
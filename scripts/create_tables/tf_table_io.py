@@ -0,0 +1,59 @@
+import os
+import numpy as np
+import pandas as pd
+
+# A <name>.tsv table can have a binary copy next to it, <name>.parquet or <name>.feather, with the column dtypes
+# stored and categorical chr, ref and alt. Readers take the copy while it is at least as new as the TSV, which
+# stays the published table. Both formats need pyarrow.
+BINARY_FORMATS = {'parquet': '.parquet', 'feather': '.feather'}
+CATEGORICAL_COLUMNS = ['chr', 'ref', 'alt', 'repeat_type', 'motif_orient', 'motif_conc']
+
+
+def binary_paths(path):
+    stem = path[:-len('.tsv')] if path.endswith('.tsv') else path
+    return {fmt: stem + ext for fmt, ext in BINARY_FORMATS.items()}
+
+
+def as_read_from_tsv(df):
+    # The values a TSV round-trip gives: empty strings are missing and columns without any value are float
+    df = df.copy()
+    for col in df.columns:
+        if df[col].isna().all():
+            df[col] = df[col].astype(np.float64)
+        elif pd.api.types.is_string_dtype(df[col].dtype):
+            df[col] = df[col].replace('', np.nan)
+    return df
+
+
+def read_table(path):
+    for fmt, binary_path in binary_paths(path).items():
+        if os.path.exists(binary_path) and (not os.path.exists(path) or os.path.getmtime(binary_path) >= os.path.getmtime(path)):
+            df = pd.read_parquet(binary_path) if fmt == 'parquet' else pd.read_feather(binary_path)
+            for col in df.columns:
+                if isinstance(df[col].dtype, pd.CategoricalDtype):
+                    df[col] = df[col].astype(df[col].cat.categories.dtype)
+            return df
+    return pd.read_csv(path, sep = '\t')
+
+
+def write_table(df, path, binary = None):
+    '''
+    Writes the TSV table and, with binary set to 'parquet' or 'feather', its binary copy, each through
+    a temporary file. Copies in another format are removed, so a reader never takes an outdated one.
+    '''
+    df.to_csv(path + '.tmp', sep = '\t', index = False)
+    os.replace(path + '.tmp', path)
+
+    for fmt, binary_path in binary_paths(path).items():
+        if fmt == binary:
+            table = as_read_from_tsv(df).reset_index(drop = True)
+            for col in CATEGORICAL_COLUMNS:
+                if col in table.columns and not table[col].isna().all():
+                    table[col] = table[col].astype('category')
+            if fmt == 'parquet':
+                table.to_parquet(binary_path + '.tmp', index = False)
+            else:
+                table.to_feather(binary_path + '.tmp')
+            os.replace(binary_path + '.tmp', binary_path)
+        elif os.path.exists(binary_path):
+            os.remove(binary_path)
@@ -0,0 +1,242 @@
+import argparse, csv, os, sqlite3, sys
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Set, Tuple
+
+import pandas as pd
+
+BED_SUFFIX = '.with_bad.bed'
+HALF_MILLION = 500_000
+REST_PROJECT = 'less_than_500K_SNPs'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS beds (
+    indiv_id TEXT PRIMARY KEY,
+    path TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    snps INTEGER NOT NULL,
+    total_cover INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS members (indiv_id TEXT NOT NULL, tf TEXT NOT NULL, cell TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS indiv_cells (indiv_id TEXT PRIMARY KEY, cell TEXT NOT NULL);
+'''
+
+
+def base_id(indiv_id: str) -> str:
+    return indiv_id.split('__CELL', 1)[0]
+
+
+def is_missing(value: Optional[str]) -> bool:
+    return value is None or value == '' or value == 'NA'
+
+
+def to_float(value: Optional[str]) -> Optional[float]:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def read_bed_stats(path: str) -> Tuple[int, int]:
+    # SNP count and summed coverage of one annotated BED, in a single read
+    table = pd.read_csv(path, sep = '\t', usecols = ['total_cover'], dtype = {'total_cover': 'int64'})
+    return len(table), int(table['total_cover'].sum())
+
+
+def update_beds(db: sqlite3.Connection, bed_dir: str, jobs: int) -> Tuple[int, int]:
+    '''Adds new and changed *.with_bad.bed files to the index and drops vanished ones; returns (scanned, total).'''
+    known = {row[0]: (row[1], row[2]) for row in db.execute('SELECT indiv_id, size, mtime_ns FROM beds')}
+    found: Dict[str, Tuple[str, int, int]] = {}
+    for entry in os.scandir(bed_dir):
+        if entry.name.startswith('INDIV_') and entry.name.endswith(BED_SUFFIX):
+            st = entry.stat()
+            found[entry.name[:-len(BED_SUFFIX)]] = (entry.path, st.st_size, st.st_mtime_ns)
+
+    stale = sorted(i for i, (path, size, mtime) in found.items() if known.get(i) != (size, mtime))
+    with ProcessPoolExecutor(max_workers = max(1, jobs)) as pool:
+        stats = list(pool.map(read_bed_stats, [found[i][0] for i in stale], chunksize = 16))
+
+    db.executemany('DELETE FROM beds WHERE indiv_id = ?', [(i,) for i in known if i not in found])
+    db.executemany(
+        'INSERT OR REPLACE INTO beds VALUES (?, ?, ?, ?, ?, ?)',
+        [(i, *found[i], snps, cover) for i, (snps, cover) in zip(stale, stats)],
+    )
+    return len(stale), len(found)
+
+
+def update_members(db: sqlite3.Connection, clustered_path: str, meta_path: str) -> None:
+    db.execute('DELETE FROM members')
+    with open(clustered_path) as f:
+        reader = csv.DictReader(f, delimiter = '\t')
+        db.executemany(
+            'INSERT INTO members VALUES (?, ?, ?)',
+            ((row['indiv_id'], row['tf'], row['cell']) for row in reader),
+        )
+
+    # Cell of every individual as join_meta.py reports it: cell_id, or cell when cell_id is missing
+    db.execute('DELETE FROM indiv_cells')
+    cells: Dict[str, str] = {}
+    with open(meta_path) as f:
+        for row in csv.DictReader(f, delimiter = '\t'):
+            indiv_id = row.get('indiv_id')
+            cell = row.get('cell_id')
+            if is_missing(cell):
+                cell = row.get('cell')
+            if not is_missing(cell) and indiv_id not in cells:
+                cells[indiv_id] = cell
+    db.executemany('INSERT INTO indiv_cells VALUES (?, ?)', cells.items())
+
+
+def read_filtered_out(meta_path: str) -> Set[str]:
+    # Pooled samples and low-complexity libraries, as base individual ids
+    filtered: Set[str] = set()
+    with open(meta_path) as f:
+        for row in csv.DictReader(f, delimiter = '\t'):
+            indiv_id = row.get('indiv_id')
+            if is_missing(indiv_id):
+                continue
+            pooled = (row.get('pooled') or '').lower() == 'true'
+            nrf = to_float(row.get('NRF'))
+            reads = to_float(row.get('reads_num'))
+            if pooled or (nrf is not None and nrf < 0.05) or (
+                nrf is not None and reads is not None and nrf < 0.4 and reads > 0.75e9
+            ):
+                filtered.add(base_id(indiv_id))
+    return filtered
+
+
+def write_lines(path: str, lines) -> None:
+    with open(path, 'w') as f:
+        f.writelines(f'{line}\n' for line in lines)
+
+
+def write_file_lists(db: sqlite3.Connection, lists_dir: str, filtered: Set[str]) -> Tuple[List[str], List[str]]:
+    snps = dict(db.execute('SELECT indiv_id, snps FROM beds'))
+    cells = dict(db.execute('SELECT indiv_id, cell FROM indiv_cells'))
+
+    ids = sorted(snps)
+    halfmillions = [i for i in ids if snps[i] > HALF_MILLION]
+    not_halfmillions = [i for i in ids if snps[i] <= HALF_MILLION]
+    halfmillions_filtered = [i for i in halfmillions if base_id(i) not in filtered]
+    not_halfmillions_filtered = [i for i in not_halfmillions if base_id(i) not in filtered]
+
+    write_lines(os.path.join(lists_dir, 'filtered_list.txt'), sorted(filtered))
+    write_lines(os.path.join(lists_dir, 'indiv_snps.tsv'), (f'{i}\t{snps[i]}' for i in ids))
+    write_lines(os.path.join(lists_dir, 'halfmillions.txt'), halfmillions)
+    write_lines(os.path.join(lists_dir, 'not_halfmillions.txt'), not_halfmillions)
+    write_lines(os.path.join(lists_dir, 'halfmillions.filtered.txt'), halfmillions_filtered)
+    write_lines(os.path.join(lists_dir, 'not_halfmillions.filtered.txt'), not_halfmillions_filtered)
+
+    with_cell = [i for i in not_halfmillions_filtered if i in cells]
+    write_lines(os.path.join(lists_dir, 'not_halfmillions.indiv_cell.tsv'), (f'{i}\t{cells[i]}' for i in with_cell))
+    write_lines(
+        os.path.join(lists_dir, 'not_halfmillions.indiv_cell_snps.tsv'),
+        (f'{i}\t{cells[i]}\t{snps[i]}' for i in with_cell),
+    )
+
+    # Cell types whose small individuals add up to half a million SNPs get a project of their own
+    cell_snps: Dict[str, int] = defaultdict(int)
+    for i in with_cell:
+        cell_snps[cells[i]] += snps[i]
+    big_cells = sorted(c for c, n in cell_snps.items() if n > HALF_MILLION)
+    write_lines(os.path.join(lists_dir, 'cells_500K.list'), big_cells)
+
+    cells_dir = os.path.join(lists_dir, 'cells_500K')
+    os.makedirs(cells_dir, exist_ok = True)
+    for name in os.listdir(cells_dir):
+        if name.startswith('CELL_') and name.endswith('.txt'):
+            os.remove(os.path.join(cells_dir, name))
+    by_cell: Dict[str, List[str]] = defaultdict(list)
+    rest: List[str] = []
+    for i in with_cell:
+        (by_cell[cells[i]] if cells[i] in cell_snps and cell_snps[cells[i]] > HALF_MILLION else rest).append(i)
+    for cell, members in by_cell.items():
+        write_lines(os.path.join(cells_dir, f'CELL_{cell}.txt'), members)
+    write_lines(os.path.join(lists_dir, 'less_than_500K.after_cells.txt'), rest)
+
+    return halfmillions_filtered, not_halfmillions_filtered
+
+
+def write_groups(
+    db: sqlite3.Connection, groups_dir: str, home: str, filtered: Set[str],
+    halfmillions: List[str], not_halfmillions: List[str],
+) -> int:
+    '''factors/cell lists with per-group BED lists, and the mixalime projects holding each TF; returns unknown count.'''
+    groups = {'factors': defaultdict(set), 'cell': defaultdict(set)}
+    for indiv_id, tf, cell in db.execute('SELECT indiv_id, tf, cell FROM members'):
+        groups['factors'][tf].add(indiv_id)
+        groups['cell'][cell].add(indiv_id)
+
+    project_of = {i: os.path.join(home, 'mixalime', i, i) for i in halfmillions}
+    project_of.update((i, os.path.join(home, 'mixalime', REST_PROJECT, REST_PROJECT)) for i in not_halfmillions)
+    unknown = 0
+
+    for kind, members in groups.items():
+        names = sorted(n for n in members if n != '')
+        write_lines(os.path.join(groups_dir, f'{kind}.list'), names)
+        for name in names:
+            kept = [i for i in sorted(members[name]) if base_id(i) not in filtered]
+            write_lines(
+                os.path.join(groups_dir, f'{kind}_{name}.list'),
+                (os.path.join(home, 'BEDs', i + BED_SUFFIX) for i in kept),
+            )
+            if kind != 'factors':
+                continue
+            projects = set()
+            for i in kept:
+                if i in project_of:
+                    projects.add(project_of[i])
+                else:
+                    unknown += 1
+                    print(f'[WARNING] {name} UNKNOWN_PROJECT {i}', file = sys.stderr)
+            write_lines(os.path.join(groups_dir, f'projects_{name}.list'), sorted(projects))
+    return unknown
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description = 'Index annotated INDIV BED files in SQLite (SNPs, coverage, TF and cell membership) '
+                      'and write the MixALiME file lists, cells_500K partitions and group lists from it.'
+    )
+    parser.add_argument('--home', required = True, help = 'Working directory with BEDs, clustering and mixalime')
+    parser.add_argument('--meta', help = 'Joined metadata from join_meta.py (default: <home>/meta.tsv)')
+    parser.add_argument(
+        '--clustered', help = 'Clustering output (default: <home>/clustering/metadata.clustered.tsv)'
+    )
+    parser.add_argument('--index', help = 'SQLite index file (default: <home>/mixalime/file_lists/beds.sqlite)')
+    parser.add_argument(
+        '-j', '--jobs', type = int, default = 1, help = 'Number of BED files scanned in parallel (default: 1)'
+    )
+    args = parser.parse_args()
+
+    home = os.path.abspath(args.home)
+    lists_dir = os.path.join(home, 'mixalime', 'file_lists')
+    groups_dir = os.path.join(home, 'mixalime', 'groups')
+    os.makedirs(lists_dir, exist_ok = True)
+    os.makedirs(groups_dir, exist_ok = True)
+    meta_path = args.meta or os.path.join(home, 'meta.tsv')
+
+    db = sqlite3.connect(args.index or os.path.join(lists_dir, 'beds.sqlite'))
+    try:
+        db.executescript(SCHEMA)
+        with db:
+            scanned, total = update_beds(db, os.path.join(home, 'BEDs'), args.jobs)
+            update_members(db, args.clustered or os.path.join(home, 'clustering', 'metadata.clustered.tsv'), meta_path)
+        print(f'[INFO] {total} BED files indexed, {scanned} of them scanned', file = sys.stderr)
+
+        filtered = read_filtered_out(meta_path)
+        halfmillions, not_halfmillions = write_file_lists(db, lists_dir, filtered)
+        unknown = write_groups(db, groups_dir, home, filtered, halfmillions, not_halfmillions)
+    finally:
+        db.close()
+
+    print(
+        f'[INFO] {len(halfmillions)} individuals above {HALF_MILLION} SNPs, {len(not_halfmillions)} below, '
+        f'{unknown} TF group members without a project',
+        file = sys.stderr,
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,258 @@
+import argparse, math, os, shutil, subprocess, sys, threading, time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime
+from typing import Dict, List, NamedTuple
+
+SCRIPTS = os.path.dirname(os.path.abspath(__file__))
+BED_SUFFIX = '.with_bad.bed'
+REST_PROJECT = 'less_than_500K_SNPs'
+LIMITER_STAGES = [
+    ('create', ['--no-snp-bad-check', '--max-cover', '10000']),
+    ('fit', ['NB']),
+    ('test', []),
+    ('combine', []),
+    ('export', ['all']),
+    ('plot', ['all']),
+]
+
+
+class Project(NamedTuple):
+    name: str
+    project: str
+    beds: List[str]
+    snps: int
+    projects: List[str] = []
+    group: str = ''
+
+
+def read_list(path: str) -> List[str]:
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def read_snps(lists_dir: str) -> Dict[str, int]:
+    snps: Dict[str, int] = {}
+    for line in read_list(os.path.join(lists_dir, 'indiv_snps.tsv')):
+        indiv_id, n = line.split('\t')
+        snps[indiv_id] = int(n)
+    return snps
+
+
+def limiter_projects(home: str, kinds: List[str]) -> List[Project]:
+    lists_dir = os.path.join(home, 'mixalime', 'file_lists')
+    snps = read_snps(lists_dir)
+    bed = lambda indiv_id: os.path.join(home, 'BEDs', indiv_id + BED_SUFFIX)
+    projects: List[Project] = []
+
+    def add(name: str, indiv_ids: List[str]) -> None:
+        if indiv_ids:
+            project = os.path.join(home, 'mixalime', name, name)
+            projects.append(Project(name, project, [bed(i) for i in indiv_ids], sum(snps.get(i, 0) for i in indiv_ids)))
+
+    if 'indiv' in kinds:
+        for indiv_id in read_list(os.path.join(lists_dir, 'halfmillions.filtered.txt')):
+            add(indiv_id, [indiv_id])
+    if 'cell' in kinds:
+        for cell_id in read_list(os.path.join(lists_dir, 'cells_500K.list')):
+            add(f'CELL_{cell_id}', read_list(os.path.join(lists_dir, 'cells_500K', f'CELL_{cell_id}.txt')))
+    if 'rest' in kinds:
+        add(REST_PROJECT, read_list(os.path.join(lists_dir, 'less_than_500K.after_cells.txt')))
+    return projects
+
+
+def combine_projects(home: str, log) -> List[Project]:
+    groups_dir = os.path.join(home, 'mixalime', 'groups')
+    snps = read_snps(os.path.join(home, 'mixalime', 'file_lists'))
+    projects: List[Project] = []
+
+    for tf in read_list(os.path.join(groups_dir, 'factors.list')):
+        group = os.path.join(groups_dir, f'factors_{tf}.list')
+        members = read_list(group)
+        sources = read_list(os.path.join(groups_dir, f'projects_{tf}.list'))
+        if not sources:
+            log('WARNING', f'SKIP_EMPTY {tf}')
+            continue
+        n = sum(snps.get(os.path.basename(p)[:-len(BED_SUFFIX)], 0) for p in members)
+        project = os.path.join(home, 'mixalime', 'multiple_combine', f'TF_{tf}', f'TF_{tf}')
+        projects.append(Project(tf, project, members, n, sources, group))
+    return projects
+
+
+def threads_for(snps: int, snps_per_thread: int, budget: int) -> int:
+    return max(1, min(budget, math.ceil(snps / snps_per_thread)))
+
+
+def marker(project: Project, stage: str) -> str:
+    return os.path.join(os.path.dirname(project.project), f'.{stage}.done')
+
+
+def file_state(path: str) -> str:
+    if not os.path.exists(path):
+        return '-'
+    st = os.stat(path)
+    return f'{st.st_size}\t{st.st_mtime_ns}'
+
+
+def signature(project: Project) -> str:
+    '''
+    What the project was built from; a change makes its finished stages stale. BEDs are rebuilt under the
+    same names when INDIV ids are renumbered, so every BED is recorded with its size and mtime, and every
+    source project with the times of its stage markers, so that a source that ran again makes a combine stale.
+    '''
+    lines = [f'{bed}\t{file_state(bed)}' for bed in sorted(project.beds)]
+    for source in sorted(project.projects):
+        markers = [file_state(os.path.join(os.path.dirname(source), f'.{stage}.done')) for stage, _ in LIMITER_STAGES]
+        lines.append('\t'.join([source] + markers))
+    return '\n'.join(lines) + '\n'
+
+
+def is_done(project: Project, stage: str) -> bool:
+    path = marker(project, stage)
+    if not os.path.exists(path):
+        return False
+    with open(path) as f:
+        return f.read() == signature(project)
+
+
+def run_stages(project: Project, stages, threads: int, log_path: str) -> List[str]:
+    '''Runs the stages not finished yet, one command each; returns the stages that ran.'''
+    project_dir = os.path.dirname(project.project)
+    if not is_done(project, stages[0][0]):
+        shutil.rmtree(project_dir, ignore_errors = True)
+    os.makedirs(project_dir, exist_ok = True)
+
+    ran: List[str] = []
+    with open(log_path, 'a') as log:
+        for stage, cmd in stages:
+            if is_done(project, stage):
+                continue
+            log.write(f'[INFO] {datetime.now():%Y-%m-%d %H:%M:%S} {stage}: {" ".join(cmd(threads))}\n')
+            log.flush()
+            result = subprocess.run(cmd(threads), stdout = log, stderr = subprocess.STDOUT)
+            if result.returncode != 0:
+                raise Exception(f'{stage} exited with code {result.returncode}, see {log_path}')
+            with open(marker(project, stage), 'w') as f:
+                f.write(signature(project))
+            ran.append(stage)
+    return ran
+
+
+def limiter_stages(project: Project):
+    limiter = [sys.executable, os.path.join(SCRIPTS, 'limiter.py')]
+    stages = []
+    for stage, extra in LIMITER_STAGES:
+        if stage == 'create':
+            args = [project.project] + project.beds + extra
+        elif stage in ('export', 'plot'):
+            args = extra + [project.project, project.project]
+        else:
+            args = [project.project] + extra
+        stages.append((stage, lambda threads, stage = stage, args = args: limiter + ['--threads', str(threads), stage] + args))
+    return stages
+
+
+def combine_stages(project: Project):
+    name = os.path.basename(project.project)
+    return [(
+        'multiple_combine',
+        lambda threads: ['mixalime', 'multiple_combine', '--n-jobs', str(threads), '--subname', name,
+                         '--group', project.group, project.project] + project.projects,
+    )]
+
+
+def schedule(projects: List[Project], make_stages, args, log) -> int:
+    '''
+    Starts the biggest projects first and fills the remaining threads with whatever still fits,
+    so small projects run next to large ones instead of waiting behind them.
+    '''
+    pending = sorted(projects, key = lambda p: p.snps, reverse = True)
+    running = {}
+    free = args.threads
+    failed = 0
+    log_dir = os.path.join(args.home, 'logs', 'mixalime')
+    os.makedirs(log_dir, exist_ok = True)
+
+    with ThreadPoolExecutor(max_workers = args.threads) as pool:
+        while pending or running:
+            i = 0
+            while i < len(pending):
+                project = pending[i]
+                n_threads = threads_for(project.snps, args.snps_per_thread, args.threads)
+                if n_threads <= free or not running:
+                    del pending[i]
+                    log('INFO', f'START {project.name} ({project.snps} SNPs, {n_threads} threads)')
+                    future = pool.submit(
+                        run_stages, project, make_stages(project), n_threads,
+                        os.path.join(log_dir, f'{os.path.basename(project.project)}.log'),
+                    )
+                    running[future] = (project, n_threads, time.perf_counter())
+                    free -= n_threads
+                else:
+                    i += 1
+
+            finished, _ = wait(running, return_when = FIRST_COMPLETED)
+            for future in finished:
+                project, n_threads, start = running.pop(future)
+                free += n_threads
+                try:
+                    ran = future.result()
+                    state = f'DONE {project.name} in {time.perf_counter() - start:.0f} s' if ran else f'SKIP_DONE {project.name}'
+                    log('INFO', state)
+                except Exception as e:
+                    failed += 1
+                    log('ERROR', f'FAILED {project.name}: {e}')
+
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description = 'Run independent MixALiME projects concurrently, splitting the thread budget by SNP count '
+                      'and skipping stages that already finished.'
+    )
+    parser.add_argument('mode', choices = ['limiter', 'combine'], help = 'limiter projects or TF multiple_combine')
+    parser.add_argument('--home', required = True, help = 'Working directory with BEDs and mixalime')
+    parser.add_argument('--threads', type = int, default = 1, help = 'Total threads shared by running projects')
+    parser.add_argument(
+        '--kinds', nargs = '+', choices = ['indiv', 'cell', 'rest'], default = ['indiv', 'cell', 'rest'],
+        help = 'limiter projects to run: individuals above 500K SNPs, cells_500K groups, the rest (default: all)'
+    )
+    parser.add_argument(
+        '--snps-per-thread', type = int, default = 100_000,
+        help = 'SNPs per thread: a project gets ceil(SNPs / this) threads, up to --threads (default: 100000)'
+    )
+    args = parser.parse_args()
+    args.home = os.path.abspath(args.home)
+    args.threads = max(1, args.threads)
+
+    status_path = os.path.join(args.home, 'logs', f'status_{"multiple_combine_factors" if args.mode == "combine" else "limiter"}.txt')
+    os.makedirs(os.path.dirname(status_path), exist_ok = True)
+    status = open(status_path, 'a')
+    lock = threading.Lock()
+
+    def log(level: str, message: str) -> None:
+        line = f'[{level}] {datetime.now():%Y-%m-%d %H:%M:%S} {message}'
+        with lock:
+            status.write(line + '\n')
+            status.flush()
+            print(line, file = sys.stderr)
+
+    with status:
+        if args.mode == 'combine':
+            log('INFO', 'START MIXALIME MULTIPLE_COMBINE FOR TFs')
+            projects = combine_projects(args.home, log)
+            failed = schedule(projects, combine_stages, args, log)
+        else:
+            log('INFO', f'START MIXALIME LIMITER FOR {", ".join(args.kinds).upper()}')
+            projects = limiter_projects(args.home, args.kinds)
+            failed = schedule(projects, limiter_stages, args, log)
+
+    if failed:
+        print(f'[ERROR] {failed} projects failed', file = sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,24 +1,24 @@
 #!/usr/bin/env python3
 
 import argparse
+import os
+import sys
 import pandas as pd
 
-def main():
-    parser = argparse.ArgumentParser(description="Transfers raw p-values into ADASTRA table from MixALiME output table.")
-    parser.add_argument('--adastra', required=True, help='Path to ADASTRA file')
-    parser.add_argument('--mixalime', required=True, help='Path to MixALiME file')
-    args = parser.parse_args()
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'create_tables'))
+from tf_table_io import BINARY_FORMATS, read_table, write_table
 
-    adastra = pd.read_csv(args.adastra, sep='\t')
-    mixalime = pd.read_csv(args.mixalime, sep='\t')
-    
+RAW_PVALUE_COLUMNS = {'ref_comb_pval': 'pval_mean_ref', 'alt_comb_pval': 'pval_mean_alt'}
+
+def add_raw_pvalues(adastra, mixalime):
+    # Earlier raw p-values are replaced, so the table can be annotated again
+    adastra = adastra.drop(columns=[c for c in RAW_PVALUE_COLUMNS.values() if c in adastra.columns])
     adastra['key'] = adastra['ID'].astype(str) + "_" + adastra['alt'].astype(str)
     mixalime['key'] = mixalime['id'].astype(str) + "_" + mixalime['alt'].astype(str)
     
     merged = pd.merge(adastra, mixalime[['key', 'ref_comb_pval', 'alt_comb_pval']], on='key', how='left')
     
-    merged.rename(columns={'ref_comb_pval': 'pval_mean_ref',
-                           'alt_comb_pval': 'pval_mean_alt'}, inplace=True)
+    merged.rename(columns=RAW_PVALUE_COLUMNS, inplace=True)
     
     ordered_columns = [
         'chr', 'start', 'end', 'ID', 'ref', 'alt', 'repeat_type', 
@@ -28,9 +28,21 @@ def main():
         'motif_fc', 'motif_pos', 'motif_orient', 'motif_conc', 'motif_index'
     ]
     
-    result = merged[ordered_columns]
+    return merged[ordered_columns]
+
+def main():
+    parser = argparse.ArgumentParser(description="Transfers raw p-values into ADASTRA table from MixALiME output table.")
+    parser.add_argument('--adastra', required=True, help='Path to ADASTRA file')
+    parser.add_argument('--mixalime', required=True, help='Path to MixALiME file')
+    parser.add_argument('--binary', choices=list(BINARY_FORMATS), help='Also write the ADASTRA table as <name>.parquet or <name>.feather')
+    args = parser.parse_args()
+
+    adastra = read_table(args.adastra)
+    mixalime = pd.read_csv(args.mixalime, sep='\t')
+    
+    result = add_raw_pvalues(adastra, mixalime)
     
-    result.to_csv(args.adastra, sep='\t', index=False)
+    write_table(result, args.adastra, args.binary)
 
 if __name__ == '__main__':
     main()
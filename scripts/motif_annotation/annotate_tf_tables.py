@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+import os
+import sys
+import glob
+import argparse
+import time
+import warnings
+import pandas as pd
+
+from merge_snpscan_results import merge_hits
+from update_tf_tables import annotate_motifs, estimate_memory, physical_memory, run_budgeted
+from add_raw_pvalue import add_raw_pvalues
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'create_tables'))
+from tf_table_io import BINARY_FORMATS, binary_paths, read_table, write_table
+
+warnings.simplefilter(action = 'ignore', category = Warning)
+
+def find_tfs(tables_dir, tfs_path, model):
+    # TFs of factors.list, or of every <TF>_HUMAN_<model>.tsv table
+    if tfs_path:
+        with open(tfs_path) as f:
+            return sorted({line.strip() for line in f if line.strip()})
+    suffix = f'_HUMAN_{model}.tsv'
+    return sorted(os.path.basename(path)[:-len(suffix)] for path in glob.glob(os.path.join(tables_dir, '*' + suffix)))
+
+def annotate_tf(tf, table_path, hit_paths, mixalime_path, output_path, binary = None):
+    '''
+    Motif and raw p-value columns of a <TF>_HUMAN_<model>.tsv table in one pass: the SNPScan hits of all subtypes
+    are merged in memory and the table is written once, through a temporary file, so a crash never leaves it half
+    updated. A missing table is an error; a TF without hits or MixALiME p-values is skipped.
+    '''
+    if not os.path.exists(table_path):
+        raise FileNotFoundError(f'no {table_path}')
+    if not hit_paths:
+        skipped = 'no SNPScan results'
+    elif not os.path.exists(mixalime_path):
+        skipped = f'no {mixalime_path}'
+    else:
+        skipped = None
+    if skipped:
+        # An annotated table left from an earlier run no longer matches the raw one
+        if output_path != table_path:
+            for path in [output_path] + list(binary_paths(output_path).values()):
+                if os.path.exists(path):
+                    os.remove(path)
+        return None, skipped
+
+    table = read_table(table_path)
+    n_rows = len(table)
+    table = annotate_motifs(table, merge_hits(hit_paths))
+    table = add_raw_pvalues(table, pd.read_csv(mixalime_path, sep = '\t'))
+
+    write_table(table, output_path, binary)
+    return (n_rows, len(table)), None
+
+def main():
+    parser = argparse.ArgumentParser(
+        description = 'Add motif columns from the SNPScan results of all PWM subtypes and raw p-values from MixALiME '
+                      'to every <TF>_HUMAN_<model>.tsv table, writing each annotated table once.'
+    )
+    parser.add_argument('--tables-dir', required = True, help = 'Directory with <TF>_HUMAN_<model>.tsv tables from create_tf_tables.py')
+    parser.add_argument('--output-dir', help = 'Directory for the annotated <TF>_HUMAN_<model>.tsv tables (default: update the tables in --tables-dir)')
+    parser.add_argument('--snpscan-dir', required = True, help = 'Directory with pwm_results_<subtype>/<TF>_HUMAN_<model>.perfectos')
+    parser.add_argument('--mixalime-dir', required = True, help = 'MixALiME directory with results_<model>/pvalues/<TF>.tsv')
+    parser.add_argument('--model', default = 'BetaNB', help = 'MixALiME model of the tables and of the raw p-values')
+    parser.add_argument('--tfs', help = 'File with TF names, one per line (default: every <TF>_HUMAN_<model>.tsv table)')
+    parser.add_argument('--jobs', type = int, default = 1, help = 'Number of TFs annotated in parallel')
+    parser.add_argument('--memory-gb', type = float, help = 'Memory budget of the TFs annotated at once (default: half of physical memory)')
+    parser.add_argument('--binary', choices = list(BINARY_FORMATS), help = 'Also write every annotated table as <name>.parquet or <name>.feather')
+    args = parser.parse_args()
+
+    output_dir = args.output_dir or args.tables_dir
+    os.makedirs(output_dir, exist_ok = True)
+    memory_budget = args.memory_gb * 2 ** 30 if args.memory_gb else physical_memory() // 2
+    jobs = []
+    for tf in find_tfs(args.tables_dir, args.tfs, args.model):
+        name = f'{tf}_HUMAN_{args.model}'
+        table_path = os.path.join(args.tables_dir, f'{name}.tsv')
+        hit_paths = sorted(glob.glob(os.path.join(args.snpscan_dir, 'pwm_results_*', f'{name}.perfectos')))
+        mixalime_path = os.path.join(args.mixalime_dir, f'results_{args.model}', 'pvalues', f'{tf}.tsv')
+        memory = estimate_memory([table_path, mixalime_path] + hit_paths)
+        output_path = os.path.join(output_dir, f'{name}.tsv')
+        jobs.append((tf, (tf, table_path, hit_paths, mixalime_path, output_path, args.binary), memory))
+    print(f'[INFO] {len(jobs)} TF tables to annotate, {args.jobs} workers, {memory_budget / 2 ** 30:.1f} GB budget', file = sys.stderr)
+
+    failed = 0
+    start = time.perf_counter()
+    for tf, future, seconds in run_budgeted(annotate_tf, jobs, args.jobs, memory_budget):
+        try:
+            rows, skipped = future.result()
+        except Exception as e:
+            failed += 1
+            print(f'[ERROR] {tf}: {type(e).__name__}: {e}', file = sys.stderr)
+            continue
+        if skipped:
+            print(f'[WARNING] {tf}: {skipped}, not annotated', file = sys.stderr)
+        else:
+            print(f'[INFO] {tf}: {rows[0]} rows in, {rows[1]} written, {seconds:.1f} s', file = sys.stderr)
+    print(f'[INFO] {len(jobs) - failed} TF tables in {time.perf_counter() - start:.1f} s', file = sys.stderr)
+    if failed:
+        sys.exit(f'{failed} of {len(jobs)} TF tables failed')
+
+if __name__ == '__main__':
+    main()
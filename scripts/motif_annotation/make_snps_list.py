@@ -1,34 +1,70 @@
 #!/usr/bin/env python3
+import os
 import sys
 import multiprocessing
 from collections import defaultdict
-from pyfaidx import Fasta
+import numpy as np
 import argparse
 
-def init_worker(genome_path):
-    global genome_global
-    genome_global = Fasta(genome_path)
-
-def process_chromosome(args):
-    chrom, records = args
-    chrom_seq = genome_global[chrom][:].seq
-    results = []
-    for rec in records:
-        _, end, variant_id, ref, alt = rec
-        left_seq = chrom_seq[end - 30 : end - 1]
-        right_seq = chrom_seq[end:end + 30]
-        result_line = f'{variant_id}\t{left_seq}[{ref}/{alt}]{right_seq}'
-        results.append(result_line)
-    return results
+FLANK = 30
+CHUNK_RECORDS = 20_000
+FLANK_CACHE = 'snp_flanks.tsv'
+FLANK_CACHE_HEADER = 'chr\tend\tid\tref\talt\tflank\n'
 
-def main():
-    parser = argparse.ArgumentParser()
-    parser.add_argument('--genome', required = True, help = 'Path to genome file')
-    parser.add_argument('--threads', type = int, default = 1, help = 'Number of threads to use')
-    parser.add_argument('--input', required = True, help = 'Input file with variants')
-    args = parser.parse_args()
+def pack_genome(genome_path, cache_path):
+    # FASTA sequences without line breaks, one byte per base, concatenated; the .idx lists name, offset and length
+    index = []
+    offset = 0
+    name = None
+    with open(genome_path, 'rb') as fa, open(cache_path + '.tmp', 'wb') as out:
+        for line in fa:
+            if line.startswith(b'>'):
+                if name is not None:
+                    index.append((name, start, offset - start))
+                name = line[1:].split()[0].decode()
+                start = offset
+            else:
+                seq = line.rstrip(b'\r\n')
+                out.write(seq)
+                offset += len(seq)
+        if name is not None:
+            index.append((name, start, offset - start))
+    with open(cache_path + '.idx.tmp', 'w') as f:
+        for name, start, length in index:
+            f.write(f'{name}\t{start}\t{length}\n')
+    os.replace(cache_path + '.tmp', cache_path)
+    os.replace(cache_path + '.idx.tmp', cache_path + '.idx')
+
+def ensure_genome_cache(genome_path, cache_path):
+    idx_path = cache_path + '.idx'
+    if not (os.path.exists(idx_path) and os.path.getmtime(idx_path) >= os.path.getmtime(genome_path)):
+        print(f'[INFO] Packing {genome_path} into {cache_path}', file = sys.stderr)
+        pack_genome(genome_path, cache_path)
+
+def init_worker(cache_path):
+    # The packed genome is memory-mapped, so every worker reads the same page cache instead of its own copy
+    global genome_global, chroms_global
+    genome_global = np.memmap(cache_path, dtype = np.uint8, mode = 'r')
+    chroms_global = {}
+    with open(cache_path + '.idx') as f:
+        for line in f:
+            name, start, length = line.rstrip('\n').split('\t')
+            chroms_global[name] = (int(start), int(length))
+
+def process_chunk(records):
+    flanks = []
+    for chrom, end, variant_id, ref, alt in records:
+        start, length = chroms_global[chrom]
+        chrom_seq = genome_global[start:start + length]
+        left_seq = chrom_seq[end - FLANK : end - 1].tobytes().decode()
+        right_seq = chrom_seq[end:end + FLANK].tobytes().decode()
+        flanks.append(f'{left_seq}[{ref}/{alt}]{right_seq}')
+    return flanks
+
+def read_records(path):
+    # Records grouped by chromosome in order of first appearance, as the output is ordered
     records_by_chrom = defaultdict(list)
-    with open(args.input, 'r') as f:
+    with open(path, 'r') as f:
         header = f.readline()
         for line in f:
             line = line.rstrip('\n')
@@ -39,22 +75,124 @@ def main():
                 continue
             chrom = fields[0]
             try:
-                start = int(fields[1])
+                int(fields[1])
                 end = int(fields[2])
             except ValueError:
                 continue
-            variant_id = fields[3]
-            ref = fields[4]
-            alt = fields[5]
-            records_by_chrom[chrom].append((start, end, variant_id, ref, alt))
-    tasks = list(records_by_chrom.items())
-    pool = multiprocessing.Pool(processes = args.threads, initializer = init_worker, initargs = (args.genome,))
-    results = pool.map(process_chromosome, tasks)
-    pool.close()
-    pool.join()
-    for chrom_results in results:
-        for line in chrom_results:
-            print(line)
+            records_by_chrom[chrom].append((chrom, end, fields[3], fields[4], fields[5]))
+    return [rec for records in records_by_chrom.values() for rec in records]
+
+def make_chunks(inputs, chunk_records):
+    # (input number, records) in output order; inputs are read one at a time as the pool reaches them
+    for i, path in enumerate(inputs):
+        records = read_records(path)
+        for start in range(0, len(records), chunk_records):
+            yield i, records[start:start + chunk_records]
+
+def process_task(task):
+    i, records = task
+    return i, ''.join(f'{rec[2]}\t{flank}\n' for rec, flank in zip(records, process_chunk(records)))
+
+def read_flank_cache(path, cache_path):
+    # Flanks of (chr, end, id, ref, alt) from earlier runs, unless the genome was packed again since
+    flanks = {}
+    if not os.path.exists(path) or os.path.getmtime(path) < os.path.getmtime(cache_path + '.idx'):
+        return flanks
+    with open(path) as f:
+        f.readline()
+        for line in f:
+            chrom, end, variant_id, ref, alt, flank = line.rstrip('\n').split('\t')
+            flanks[(chrom, int(end), variant_id, ref, alt)] = flank
+    return flanks
+
+def write_flank_cache(path, flanks):
+    with open(path + '.tmp', 'w') as f:
+        f.write(FLANK_CACHE_HEADER)
+        for (chrom, end, variant_id, ref, alt), flank in flanks.items():
+            f.write(f'{chrom}\t{end}\t{variant_id}\t{ref}\t{alt}\t{flank}\n')
+    os.replace(path + '.tmp', path)
+
+def write_tables(args, cache_path, pool):
+    '''
+    Writes <input name>.snps for every input as a view of one table of unique variants: the flank
+    of a variant is extracted once for all inputs, or taken from --flank-cache, and a variant
+    repeated within an input is written once. Prints how much work the sharing saved.
+    '''
+    flank_cache = args.flank_cache or os.path.join(args.output_dir, FLANK_CACHE)
+    flanks = read_flank_cache(flank_cache, cache_path)
+    cached = len(flanks)
+
+    total = 0
+    missing = {}
+    for path in args.input:
+        for rec in read_records(path):
+            total += 1
+            if rec not in flanks:
+                missing[rec] = None
+    missing = list(missing)
+    chunks = [missing[i:i + args.chunk_records] for i in range(0, len(missing), args.chunk_records)]
+    for records, chunk_flanks in zip(chunks, pool.imap(process_chunk, chunks) if pool else map(process_chunk, chunks)):
+        flanks.update(zip(records, chunk_flanks))
+    if missing:
+        write_flank_cache(flank_cache, flanks)
+
+    written = 0
+    for path in args.input:
+        seen = set()
+        with open(output_path(path, args.output_dir), 'w') as out:
+            for rec in read_records(path):
+                if rec not in seen:
+                    seen.add(rec)
+                    out.write(f'{rec[2]}\t{flanks[rec]}\n')
+            written += len(seen)
+
+    print(
+        f'[INFO] {total} variants in {len(args.input)} tables, {written} written without repeats within a table; '
+        f'{len(missing)} flanks extracted, {total - len(missing)} extractions saved '
+        f'({cached} flanks cached in {flank_cache})',
+        file = sys.stderr,
+    )
+
+def output_path(input_path, output_dir):
+    name = os.path.basename(input_path)
+    return os.path.join(output_dir, (name[:-len('.tsv')] if name.endswith('.tsv') else name) + '.snps')
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--genome', required = True, help = 'Path to genome file')
+    parser.add_argument('--genome-cache', help = 'Packed genome built from --genome on first use (default: <genome>.packed)')
+    parser.add_argument('--threads', type = int, default = 1, help = 'Number of threads to use')
+    parser.add_argument('--input', required = True, nargs = '+', help = 'Input file with variants; several with --output-dir')
+    parser.add_argument('--output-dir', help = 'Write <input name>.snps here for every input instead of printing one input to stdout')
+    parser.add_argument('--flank-cache', help = f'With --output-dir: flanks of every variant seen so far (default: <output-dir>/{FLANK_CACHE})')
+    parser.add_argument('--chunk-records', type = int, default = CHUNK_RECORDS, help = 'Variants per task')
+    args = parser.parse_args()
+    if len(args.input) > 1 and not args.output_dir:
+        parser.error('several --input files need --output-dir')
+
+    cache_path = args.genome_cache or args.genome + '.packed'
+    ensure_genome_cache(args.genome, cache_path)
+
+    args.chunk_records = max(1, args.chunk_records)
+    if args.threads > 1:
+        pool = multiprocessing.Pool(processes = args.threads, initializer = init_worker, initargs = (cache_path,))
+    else:
+        pool = None
+        init_worker(cache_path)
+
+    try:
+        if args.output_dir:
+            os.makedirs(args.output_dir, exist_ok = True)
+            write_tables(args, cache_path, pool)
+        else:
+            # Chunks come back in order, so the output is streamed as they are ready
+            tasks = make_chunks(args.input, args.chunk_records)
+            for _, text in (pool.imap(process_task, tasks) if pool else map(process_task, tasks)):
+                sys.stdout.write(text)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
 
 if __name__ == '__main__':
-    main()  
+    main()
@@ -1,43 +1,59 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from tqdm import tqdm
 import pandas as pd
+import numpy as np
+import argparse
 import warnings
+import glob
 import os
 
 warnings.simplefilter(action = 'ignore', category = Warning)
-folders = ['/home/subpolare/adastra-v7/SNPScan/pwm_results_0',
-           '/home/subpolare/adastra-v7/SNPScan/pwm_results_1',
-           '/home/subpolare/adastra-v7/SNPScan/pwm_results_2',
-           '/home/subpolare/adastra-v7/SNPScan/pwm_results_3']
-
-file_paths = dict()
-
-for folder in folders:
-    files = os.listdir(folder)
-    for file in files:
-        file_path = os.path.join(folder, file)
-        if file in file_paths:
-            file_paths[file].append(file_path)
-        else:
-            file_paths[file] = [file_path]
-
-for file, paths in tqdm(file_paths.items(), desc = 'Обработка файлов', colour = 'green'):
+
+def find_files(snpscan_dir):
+    # <factor>.perfectos of every pwm_results_<subtype> folder, in subtype order
+    file_paths = dict()
+    for folder in sorted(glob.glob(os.path.join(snpscan_dir, 'pwm_results_*'))):
+        for file in sorted(os.listdir(folder)):
+            file_paths.setdefault(file, []).append(os.path.join(folder, file))
+    return file_paths
+
+def read_result(path):
+    data = pd.read_csv(path, sep = '\t')
+    data['index'] = os.path.basename(os.path.dirname(path))[-1]
+    return data
+
+def merge_hits(paths):
     if len(paths) == 1:
-        data = pd.read_csv(paths[0], sep = '\t')
-        data['index'] = paths[0].split('/')[-2][-1]
-        data.to_csv('/home/subpolare/adastra-v7/SNPScan/merged_results/' + paths[0].split('/')[-1], sep = '\t', index = False)
-
-    else:
-        df = pd.DataFrame()
-        file_name = paths[0].split('/')[-1]
-        for i, path in enumerate(paths):
-            data = pd.read_csv(path, sep = '\t')
-            data['index'] = paths[i].split('/')[-2][-1]
-            df = pd.concat([df, data])
-        df['Abs fold change'] = df['Fold change'].abs()
-        df['min_P_value'] = df[['P-value 1', 'P-value 2']].min(axis = 1)
-        df['round_P_value'] = df['min_P_value'].apply(lambda x: 0.001 if x < 0.001 else x)
-        df = df.sort_values(by = ['SNP name', 'round_P_value', 'Abs fold change'], ascending = [True, True, False])
-        df['UniqID'] = df['SNP name'] + df['allele 1/allele 2'].str.split('/').str[0] + df['allele 1/allele 2'].str.split('/').str[1]
-        df.drop_duplicates(subset = ['UniqID'], keep = 'first', inplace = True)
-        df.drop(columns = ['UniqID', 'Abs fold change', 'min_P_value', 'round_P_value'], inplace = True)
-        df.to_csv('/home/subpolare/adastra-v7/SNPScan/merged_results/' + file_name, sep = '\t', index = False)
+        return read_result(paths[0])
+
+    # Best hit of every SNP and allele pair over the subtypes: the lowest P-value, at most down to 0.001,
+    # then the largest fold change; ties keep the lower subtype
+    df = pd.concat([read_result(path) for path in paths], ignore_index = True)
+    df['Abs fold change'] = df['Fold change'].abs()
+    df['round_P_value'] = np.clip(df[['P-value 1', 'P-value 2']].min(axis = 1), 0.001, None)
+    df = df.sort_values(by = ['SNP name', 'round_P_value', 'Abs fold change'], ascending = [True, True, False])
+    uniq_id = df['SNP name'] + df['allele 1/allele 2'].str.replace('/', '', n = 1, regex = False)
+    df = df[~uniq_id.duplicated(keep = 'first')]
+    return df.drop(columns = ['Abs fold change', 'round_P_value'])
+
+def merge_file(file, paths, output_dir):
+    merge_hits(paths).to_csv(os.path.join(output_dir, file), sep = '\t', index = False)
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Merge SNPScan results of all PWM subtypes into one table per factor, keeping the best hit per SNP.')
+    parser.add_argument('--snpscan-dir', default = '/home/subpolare/adastra-v7/SNPScan', help = 'Directory with pwm_results_<subtype> folders')
+    parser.add_argument('--output-dir', help = 'Directory for merged tables (default: <snpscan-dir>/merged_results)')
+    parser.add_argument('--jobs', type = int, default = 1, help = 'Number of factors merged in parallel')
+    args = parser.parse_args()
+
+    output_dir = args.output_dir or os.path.join(args.snpscan_dir, 'merged_results')
+    os.makedirs(output_dir, exist_ok = True)
+    file_paths = find_files(args.snpscan_dir)
+
+    with ProcessPoolExecutor(max_workers = max(1, args.jobs)) as executor:
+        futures = [executor.submit(merge_file, file, paths, output_dir) for file, paths in file_paths.items()]
+        for future in tqdm(as_completed(futures), total = len(futures), desc = 'Обработка файлов', colour = 'green'):
+            future.result()
+
+if __name__ == '__main__':
+    main()
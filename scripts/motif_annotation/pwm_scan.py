@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+import os
+import sys
+import glob
+import argparse
+import numpy as np
+import pandas as pd
+from decimal import Decimal
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# Scores and P-values as in `SNPScan <pwm> <snps> --single-motif -F 1 -P 1 -d 1000` of ape-3.0.6.jar
+SNPSCAN_COLUMNS = [
+    'SNP name', 'motif', 'position 1', 'orientation 1', 'word 1', 'position 2', 'orientation 2', 'word 2',
+    'allele 1/allele 2', 'P-value 1', 'P-value 2', 'Fold change',
+]
+DISCRETIZATION = 1000
+SUBTYPES = ['0', '1', '2', '3']
+
+# A, C, G, T and N (any other letter); N scores the mean of the PWM column
+CODES = np.full(256, 4, dtype = np.int8)
+for i, letter in enumerate('ACGT'):
+    CODES[ord(letter)] = CODES[ord(letter.lower())] = i
+COMPLEMENT_CODES = np.array([3, 2, 1, 0, 4], dtype = np.int8)
+COMPLEMENT = bytes.maketrans(b'acgtnACGTN', b'tgcanTGCAN')
+
+
+class Motif:
+    '''
+    A PWM with the exact distribution of its discretized scores over all words under a uniform
+    background, kept as a table from score threshold to P-value. A word score is looked up as
+    ceil(score * discretization), which is how SNPScan turns a score into a P-value.
+    '''
+
+    def __init__(self, name, matrix, discretization = DISCRETIZATION):
+        self.name = name
+        self.length = len(matrix)
+        self.discretization = discretization
+        n_column = (matrix[:, 0] + matrix[:, 1] + matrix[:, 2] + matrix[:, 3]) / 4
+        self.matrix = np.column_stack([matrix, n_column])
+        self.revcomp_matrix = self.matrix[:, COMPLEMENT_CODES]
+
+        # Probability of every discretized score, one column at a time; sums of powers of 1/4 stay exact
+        # as long as 4^length fits a double mantissa, i.e. up to length 26
+        discrete = np.ceil(matrix * discretization).astype(np.int64)
+        probs = np.ones(1)
+        self.min_score = 0
+        for column in discrete:
+            low = column.min()
+            spread = np.zeros(len(probs) + column.max() - low)
+            for value in column:
+                spread[value - low:value - low + len(probs)] += probs * 0.25
+            probs = spread
+            self.min_score += low
+        self.tail = np.append(np.cumsum(probs[::-1])[::-1], 0.0)
+
+    def pvalues(self, scores):
+        index = np.ceil(scores * self.discretization).astype(np.int64) - self.min_score
+        return self.tail[np.clip(index, 0, len(self.tail) - 1)]
+
+
+def load_motif(path, discretization = DISCRETIZATION):
+    # A '>name' header line is optional, as in APE; without it the motif is named after the file
+    name = os.path.splitext(os.path.basename(path))[0]
+    rows = []
+    with open(path) as f:
+        for line in f:
+            if line.startswith('>'):
+                name = line[1:].strip()
+            elif line.strip():
+                rows.append([float(x) for x in line.split()])
+    return Motif(name, np.array(rows, dtype = np.float64), discretization)
+
+
+def read_snps(path):
+    '''
+    id, left flank, alleles and right flank of every `id<TAB>left[A/B]right` line. Lines whose
+    alleles are not single nucleotides are skipped: SNPScan stops at them instead.
+    '''
+    names, lefts, alleles_1, alleles_2, rights = [], [], [], [], []
+    skipped = 0
+    with open(path) as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) < 2:
+                continue
+            left, bracket, rest = parts[1].partition('[')
+            alleles, _, right = rest.partition(']')
+            allele_1, _, allele_2 = alleles.partition('/')
+            if not bracket or len(allele_1) != 1 or len(allele_2) != 1:
+                skipped += 1
+                continue
+            names.append(parts[0])
+            lefts.append(left)
+            alleles_1.append(allele_1.upper())
+            alleles_2.append(allele_2.upper())
+            rights.append(right)
+    return (names, lefts, alleles_1, alleles_2, rights), skipped
+
+
+def best_sites(motif, seqs, center):
+    '''
+    Best scoring window overlapping column center, over both strands. Windows are tried from the leftmost
+    one, direct before revcomp, and the first best one is kept, as in SNPScan.
+    '''
+    codes = CODES[seqs]
+    n, length = len(seqs), motif.length
+    first = center - (length - 1)
+    direct = np.zeros((n, length))
+    revcomp = np.zeros((n, length))
+    for k in range(length):
+        direct += motif.matrix[k][codes[:, first + k:first + k + length]]
+        revcomp += motif.revcomp_matrix[k][codes[:, center - k:center - k + length]]
+    scores = np.stack([direct, revcomp], axis = 2).reshape(n, 2 * length)
+    best = scores.argmax(axis = 1)
+    return best // 2, best % 2, scores[np.arange(n), best]
+
+
+def words(seqs, starts, is_revcomp, length):
+    picked = seqs[np.arange(len(seqs))[:, None], starts[:, None] + np.arange(length)]
+    as_bytes = picked.copy().view(f'S{length}').ravel()
+    return [
+        w[::-1].translate(COMPLEMENT).decode() if rc else w.decode()
+        for w, rc in zip(as_bytes, is_revcomp)
+    ]
+
+
+def scan(motif, snps):
+    '''SNPScan columns for every SNP of read_snps, with numeric P-values and fold change.'''
+    names, lefts, alleles_1, alleles_2, rights = snps
+    if not names:
+        return pd.DataFrame(columns = SNPSCAN_COLUMNS)
+
+    # Flanks padded with N to the same width, at least a motif length minus one on each side
+    width = max(motif.length - 1, max(map(len, lefts)), max(map(len, rights)))
+    rows = [
+        left.lower().rjust(width, 'n') + 'N' + right.lower().ljust(width, 'n')
+        for left, right in zip(lefts, rights)
+    ]
+    seqs = np.frombuffer(''.join(rows).encode(), dtype = np.uint8).reshape(len(rows), 2 * width + 1).copy()
+
+    result = {'SNP name': names, 'motif': motif.name}
+    pvalues = []
+    for i, alleles in ((1, alleles_1), (2, alleles_2)):
+        seqs[:, width] = np.frombuffer(''.join(alleles).encode(), dtype = np.uint8)
+        offset, is_revcomp, score = best_sites(motif, seqs, width)
+        result[f'position {i}'] = offset - (motif.length - 1)
+        result[f'orientation {i}'] = np.where(is_revcomp == 1, 'revcomp', 'direct')
+        result[f'word {i}'] = words(seqs, width - (motif.length - 1) + offset, is_revcomp, motif.length)
+        pvalues.append(motif.pvalues(score))
+    result['allele 1/allele 2'] = [f'{a}/{b}' for a, b in zip(alleles_1, alleles_2)]
+    result['P-value 1'], result['P-value 2'] = pvalues
+    result['Fold change'] = pvalues[0] / pvalues[1]
+    return pd.DataFrame(result, columns = SNPSCAN_COLUMNS)
+
+
+def java_double(x):
+    # Double.toString: plain notation from 1e-3 to 1e7, otherwise d.dddE<exp>, with the shortest round-trip digits
+    if np.isnan(x):
+        return 'NaN'
+    if np.isinf(x):
+        return 'Infinity' if x > 0 else '-Infinity'
+    if x == 0 or 1e-3 <= abs(x) < 1e7:
+        return repr(float(x))
+    sign, digits, exponent = Decimal(repr(float(x))).normalize().as_tuple()
+    digits = ''.join(map(str, digits))
+    return ('-' if sign else '') + digits[0] + '.' + (digits[1:] or '0') + f'E{exponent + len(digits) - 1}'
+
+
+def write_perfectos(df, path):
+    # SNPScan output with its header line, after run.sh has dropped the leading '# '
+    with open(path, 'w') as f:
+        f.write('\t'.join(SNPSCAN_COLUMNS) + '\n')
+        columns = [df[c].astype(str).tolist() for c in SNPSCAN_COLUMNS[:9]]
+        columns += [[java_double(x) for x in df[c]] for c in SNPSCAN_COLUMNS[9:]]
+        for row in zip(*columns):
+            f.write('\t'.join(row) + '\n')
+
+
+def scan_file(pwm_path, snps_path, output_path):
+    snps, skipped = read_snps(snps_path)
+    df = scan(load_motif(pwm_path), snps)
+    write_perfectos(df, output_path)
+    return len(df), skipped
+
+
+def motif_factor(factor):
+    # SNPs of a <TF>_HUMAN_<model> table are scanned with the <TF>_HUMAN motifs
+    head, sep, _ = factor.rpartition('_HUMAN_')
+    return head + '_HUMAN' if sep else factor
+
+
+def find_jobs(snps_dir, pwm_dir, output_dir, subtypes):
+    # <factor>.snps is scanned with <factor>.H12RSNP.<subtype>.*.pwm into pwm_results_<subtype>/<factor>.perfectos
+    jobs = []
+    for snps_path in sorted(glob.glob(os.path.join(snps_dir, '*.snps'))):
+        factor = os.path.basename(snps_path).split('.')[0]
+        for subtype in subtypes:
+            pwms = sorted(glob.glob(os.path.join(pwm_dir, f'{motif_factor(factor)}.H12RSNP.{subtype}.*.pwm')))
+            if len(pwms) > 1:
+                print(f'[WARNING] {factor}: {len(pwms)} PWMs of subtype {subtype}, scanning {pwms[0]}', file = sys.stderr)
+            if pwms:
+                output_path = os.path.join(output_dir, f'pwm_results_{subtype}', f'{factor}.perfectos')
+                jobs.append((pwms[0], snps_path, output_path))
+    return jobs
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description = 'Score SNPs of every <factor>.snps with the factor PWMs of every subtype, writing SNPScan-compatible '
+                      'pwm_results_<subtype>/<factor>.perfectos tables in one process pool.'
+    )
+    parser.add_argument('--snps-dir', required = True, help = 'Directory with <factor>.snps files from make_snps_list.py')
+    parser.add_argument('--pwm-dir', required = True, help = 'Directory with <TF>_HUMAN.H12RSNP.<subtype>.*.pwm files, also used for <TF>_HUMAN_<model>.snps')
+    parser.add_argument('--output-dir', required = True, help = 'Directory for pwm_results_<subtype> folders')
+    parser.add_argument('--subtypes', nargs = '+', default = SUBTYPES, help = 'PWM subtypes to scan (default: 0 1 2 3)')
+    parser.add_argument('--jobs', type = int, default = 1, help = 'Number of (factor, subtype) pairs scanned in parallel')
+    args = parser.parse_args()
+
+    jobs = find_jobs(args.snps_dir, args.pwm_dir, args.output_dir, args.subtypes)
+    for subtype in args.subtypes:
+        os.makedirs(os.path.join(args.output_dir, f'pwm_results_{subtype}'), exist_ok = True)
+    print(f'[INFO] {len(jobs)} (factor, subtype) pairs to scan', file = sys.stderr)
+    failed = 0
+    with ProcessPoolExecutor(max_workers = max(1, args.jobs)) as ex:
+        futures = {ex.submit(scan_file, *job): job for job in jobs}
+        for future in as_completed(futures):
+            pwm_path, snps_path, output_path = futures[future]
+            try:
+                n, skipped = future.result()
+            except Exception as e:
+                failed += 1
+                print(f'[ERROR] {os.path.basename(pwm_path)}: {e}', file = sys.stderr)
+                continue
+            if skipped:
+                print(f'[WARNING] {output_path}: {skipped} lines without a single nucleotide substitution skipped', file = sys.stderr)
+    if failed:
+        sys.exit(f'{failed} of {len(jobs)} scans failed')
+
+
+if __name__ == '__main__':
+    main()
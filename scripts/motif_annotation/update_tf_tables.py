@@ -3,16 +3,19 @@ import pandas as pd
 import numpy as np
 import warnings
 import shutil
+import argparse
+import time
 import sys
 import os
-from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'create_tables'))
+from tf_table_io import BINARY_FORMATS, read_table, write_table
 warnings.simplefilter(action = 'ignore', category = Warning)
 
-def process_file(file):
-    tf = pd.read_csv(f'/home/subpolare/adastra-v7/new-version/TF/{file.split(".")[0]}_HUMAN.tsv', sep = '\t')
+def annotate_motifs(tf, my):
+    # Motif columns of a TF table from the best SNPScan hit of each of its SNPs; SNPs without a hit are dropped
     tf['UniqID_1'] = tf['ID'] + tf['ref'] + tf['alt']
-
-    my = pd.read_csv(f'/home/subpolare/adastra-v7/SNPScan/merged_results/{file}', sep = '\t')
     my['UniqID_2'] = my['SNP name'] + my['allele 1/allele 2'].str.split('/').str[0] + my['allele 1/allele 2'].str.split('/').str[1]
 
     merged = pd.merge(tf, my, left_on = 'UniqID_1', right_on = 'UniqID_2', how = 'inner')
@@ -52,9 +55,85 @@ def process_file(file):
                          'position 2', 'orientation 2', 'word 2', 'allele 1/allele 2', 
                          'P-value 1', 'P-value 2', 'Fold change', 'index', 'UniqID_1', 
                          'UniqID_2'], inplace = True)
-    merged = merged.sort_values(by = ['chr', 'start'])
-    merged.to_csv(f'/home/subpolare/adastra-v7/new-version/TF/{file.split(".")[0]}_HUMAN.tsv', sep = '\t', index = False)
+    return merged.sort_values(by = ['chr', 'start'])
+
+# Peak memory of reading, merging and writing a TSV table, per byte of the input files
+MEMORY_PER_BYTE = 10
+
+def estimate_memory(paths):
+    return MEMORY_PER_BYTE * sum(os.path.getsize(path) for path in paths if os.path.exists(path))
+
+def physical_memory():
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+def run_budgeted(run, jobs, workers, memory_budget):
+    '''
+    Runs run(*args) for every (name, args, memory) job in a process pool and yields (name, future, seconds)
+    as jobs finish. The largest jobs start first, and a job only starts while the estimated memory of the
+    running ones leaves room for it, so big tables do not run side by side; one job always runs, however big.
+    '''
+    pending = sorted(jobs, key = lambda job: job[2], reverse = True)
+    running = {}
+    free = memory_budget
+    with ProcessPoolExecutor(max_workers = max(1, workers)) as executor:
+        while pending or running:
+            i = 0
+            while i < len(pending) and len(running) < max(1, workers):
+                name, args, memory = pending[i]
+                if memory <= free or not running:
+                    del pending[i]
+                    running[executor.submit(run, *args)] = (name, memory, time.perf_counter())
+                    free -= memory
+                else:
+                    i += 1
+
+            finished, _ = wait(running, return_when = FIRST_COMPLETED)
+            for future in finished:
+                name, memory, start = running.pop(future)
+                free += memory
+                yield name, future, time.perf_counter() - start
+
+def process_file(table_path, merged_path, binary = None):
+    tf = read_table(table_path)
+    my = pd.read_csv(merged_path, sep = '\t')
+    merged = annotate_motifs(tf, my)
+    write_table(merged, table_path, binary)
+    return len(tf), len(merged)
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Add motif columns from merged SNPScan results to the <TF>_HUMAN.tsv tables.')
+    parser.add_argument('--tables-dir', default = '/home/subpolare/adastra-v7/new-version/TF', help = 'Directory with <TF>_HUMAN.tsv tables')
+    parser.add_argument('--merged-dir', default = '/home/subpolare/adastra-v7/SNPScan/merged_results', help = 'Directory with <TF>_HUMAN.perfectos from merge_snpscan_results.py')
+    parser.add_argument('--workers', type = int, default = os.cpu_count(), help = 'Number of tables updated in parallel')
+    parser.add_argument('--memory-gb', type = float, help = 'Memory budget of the tables running at once (default: half of physical memory)')
+    parser.add_argument('--binary', choices = list(BINARY_FORMATS), help = 'Also write every table as <name>.parquet or <name>.feather')
+    args = parser.parse_args()
+
+    memory_budget = args.memory_gb * 2 ** 30 if args.memory_gb else physical_memory() // 2
+    jobs = []
+    for file in sorted(os.listdir(args.merged_dir)):
+        if file.startswith('.'):
+            continue
+        table_path = os.path.join(args.tables_dir, f'{file.split(".")[0]}.tsv')
+        merged_path = os.path.join(args.merged_dir, file)
+        jobs.append((file.split('.')[0], (table_path, merged_path, args.binary), estimate_memory([table_path, merged_path])))
+    print(f'[INFO] {len(jobs)} tables, {args.workers} workers, {memory_budget / 2 ** 30:.1f} GB budget', file = sys.stderr)
+
+    failed = 0
+    rows = 0
+    start = time.perf_counter()
+    for name, future, seconds in run_budgeted(process_file, jobs, args.workers, memory_budget):
+        try:
+            n_in, n_out = future.result()
+        except Exception as e:
+            failed += 1
+            print(f'[ERROR] {name}: {type(e).__name__}: {e}', file = sys.stderr)
+            continue
+        rows += n_out
+        print(f'[INFO] {name}: {n_in} rows, {n_out} with a motif hit, {seconds:.1f} s', file = sys.stderr)
+    print(f'[INFO] {len(jobs) - failed} tables, {rows} rows in {time.perf_counter() - start:.1f} s', file = sys.stderr)
+    if failed:
+        sys.exit(f'{failed} of {len(jobs)} tables failed')
 
-files = [file for file in os.listdir('/home/subpolare/adastra-v7/SNPScan/merged_results/') if not file.startswith('.')]
-with ProcessPoolExecutor(max_workers = 50) as executor:
-    executor.map(process_file, files)
+if __name__ == '__main__':
+    main()
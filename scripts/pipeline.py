@@ -0,0 +1,506 @@
+#!/usr/bin/env python3
+
+import argparse, fnmatch, glob, hashlib, json, os, subprocess, sys, threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime
+
+SCRIPTS = os.path.dirname(os.path.abspath(__file__))
+HASH_CHUNK = 1 << 20
+
+
+class Task:
+    '''
+    One pipeline step: a bash command run with $home, $scripts and $threads set, plus the
+    files it reads and writes. A task reruns only if its command or the content of its
+    inputs changed since its last success, or if one of its outputs is missing.
+
+    inputs are paths, glob patterns, or '@list' for a list file together with every path in it.
+    A task with expand instead of cmd is a stage: once its dependencies are done, expand()
+    lists its subtasks from the files that exist at that point, and the stage is done when
+    all of them are.
+    '''
+
+    def __init__(self, name, cmd=None, inputs=(), outputs=(), after=(), threads=1, expand=None, always=False):
+        self.name = name
+        self.cmd = cmd
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.after = list(after)
+        self.threads = threads
+        self.expand = expand
+        self.always = always
+
+
+class ContentHashes:
+    '''File digests cached by (size, mtime), so unchanged files are read only once.'''
+
+    def __init__(self, cache):
+        self.cache = cache
+        self.lock = threading.Lock()
+
+    def file(self, path):
+        st = os.stat(path)
+        with self.lock:
+            cached = self.cache.get(path)
+        if cached and cached[0] == st.st_size and cached[1] == st.st_mtime_ns:
+            return cached[2]
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNK), b''):
+                digest.update(chunk)
+        with self.lock:
+            self.cache[path] = [st.st_size, st.st_mtime_ns, digest.hexdigest()]
+        return digest.hexdigest()
+
+    def path(self, path):
+        if os.path.isdir(path):
+            digest = hashlib.sha256()
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    p = os.path.join(root, name)
+                    digest.update(f'{os.path.relpath(p, path)}\t{self.file(p)}\n'.encode())
+            return digest.hexdigest()
+        if os.path.exists(path):
+            return self.file(path)
+        return 'missing'
+
+
+def resolve_inputs(specs):
+    # '@list' is a file list and its entries, '!pattern' drops the paths matched so far
+    paths = []
+    for spec in specs:
+        if spec.startswith('!'):
+            paths = [p for p in paths if not fnmatch.fnmatch(p, spec[1:])]
+        elif spec.startswith('@'):
+            paths.append(spec[1:])
+            if os.path.exists(spec[1:]):
+                with open(spec[1:]) as f:
+                    paths.extend(line.strip() for line in f if line.strip())
+        elif glob.has_magic(spec):
+            paths.extend(sorted(glob.glob(spec)))
+        else:
+            paths.append(spec)
+    return paths
+
+
+class Pipeline:
+    def __init__(self, tasks, env, threads, state_path, log_dir, force=(), dry_run=False):
+        self.tasks = {t.name: t for t in tasks}
+        self.env = env
+        self.threads = threads
+        self.state_path = state_path
+        self.log_dir = log_dir
+        self.force = list(force)
+        self.dry_run = dry_run
+
+        self.state = {'tasks': {}, 'hashes': {}}
+        if os.path.exists(state_path):
+            with open(state_path) as f:
+                self.state = json.load(f)
+        self.hashes = ContentHashes(self.state['hashes'])
+
+    def save_state(self):
+        tmp = self.state_path + '.tmp'
+        with self.hashes.lock:
+            with open(tmp, 'w') as f:
+                json.dump(self.state, f)
+        os.replace(tmp, self.state_path)
+
+    def log(self, level, message):
+        print(f'[{level}] {datetime.now():%Y-%m-%d %H:%M:%S} {message}', file=sys.stderr, flush=True)
+
+    def signature(self, task):
+        inputs = {p: self.hashes.path(p) for p in resolve_inputs(task.inputs)}
+        payload = json.dumps({'cmd': task.cmd, 'inputs': inputs}, sort_keys=True)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def is_stale(self, task, signature):
+        if task.always or any(fnmatch.fnmatch(task.name, p) for p in self.force):
+            return True
+        if self.state['tasks'].get(task.name) != signature:
+            return True
+        return not all(os.path.exists(p) for p in task.outputs)
+
+    def run_task(self, task):
+        # Runs in a worker thread; returns (status, signature)
+        signature = self.signature(task)
+        if not self.is_stale(task, signature):
+            return 'fresh', signature
+        if self.dry_run:
+            return 'stale', signature
+
+        log_path = os.path.join(self.log_dir, task.name.replace('/', '_').replace(':', '_') + '.log')
+        with open(log_path, 'w') as log:
+            result = subprocess.run(
+                ['bash', '-c', 'set -eo pipefail\n' + task.cmd],
+                env=self.env, stdout=log, stderr=subprocess.STDOUT,
+            )
+        if result.returncode != 0:
+            raise RuntimeError(f'exit code {result.returncode}, see {log_path}')
+        return 'done', signature
+
+    def run(self):
+        pending = dict(self.tasks)
+        done = set()
+        failed = set()
+        # Dry run: tasks that would run, so every task after them would run too
+        stale = set()
+        children = {}
+        parent_of = {}
+        running = {}
+        used = 0
+
+        def finish(name, ok):
+            (done if ok else failed).add(name)
+            parent = parent_of.get(name)
+            if parent is not None:
+                if name in stale:
+                    stale.add(parent)
+                children[parent].discard(name)
+                if not ok:
+                    failed.add(parent)
+                elif not children[parent] and parent not in failed:
+                    done.add(parent)
+                    self.log('INFO', f'{parent}: stage done')
+
+        with ThreadPoolExecutor(max_workers=max(1, self.threads)) as pool:
+            while pending or running:
+                progressed = False
+                for name, task in list(pending.items()):
+                    if any(a in failed for a in task.after):
+                        del pending[name]
+                        finish(name, False)
+                        self.log('WARN', f'{name}: skipped, a dependency failed')
+                        progressed = True
+                        continue
+                    if not all(a in done for a in task.after):
+                        continue
+                    upstream_stale = any(a in stale for a in task.after) or parent_of.get(name) in stale
+
+                    if task.expand is not None:
+                        del pending[name]
+                        if upstream_stale:
+                            stale.add(name)
+                        subtasks = task.expand()
+                        children[name] = {t.name for t in subtasks}
+                        for t in subtasks:
+                            parent_of[t.name] = name
+                            pending[t.name] = t
+                        if not subtasks:
+                            finish(name, True)
+                        self.log('INFO', f'{name}: {len(subtasks)} tasks')
+                        progressed = True
+                        continue
+
+                    if self.dry_run and upstream_stale:
+                        del pending[name]
+                        stale.add(name)
+                        self.log('INFO', f'{name}: stale, a dependency is stale')
+                        finish(name, True)
+                        progressed = True
+                        continue
+
+                    cost = min(task.threads, self.threads)
+                    if used and used + cost > self.threads:
+                        continue
+                    del pending[name]
+                    running[pool.submit(self.run_task, task)] = (name, cost)
+                    used += cost
+                    progressed = True
+
+                if progressed:
+                    continue
+                if not running:
+                    for name in pending:
+                        self.log('ERROR', f'{name}: waits for tasks that never ran')
+                        failed.add(name)
+                    break
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name, cost = running.pop(future)
+                    used -= cost
+                    try:
+                        status, signature = future.result()
+                    except Exception as e:
+                        self.log('ERROR', f'{name}: {e}')
+                        finish(name, False)
+                        continue
+                    if status == 'done':
+                        self.state['tasks'][name] = signature
+                        self.save_state()
+                    elif status == 'stale':
+                        stale.add(name)
+                    if status != 'fresh' or name not in parent_of:
+                        self.log('INFO', f'{name}: {status}')
+                    finish(name, True)
+
+        self.save_state()
+        return not failed
+
+
+def read_list(path):
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def build_tasks(args):
+    home = args.home
+    vcfs = os.path.join(home, 'VCFs')
+    beds = os.path.join(home, 'BEDs')
+    bads = os.path.join(home, 'BADs')
+    clustering = os.path.join(home, 'clustering')
+    lists = os.path.join(home, 'mixalime', 'file_lists')
+    groups = os.path.join(home, 'mixalime', 'groups')
+    store = os.path.join(beds, 'snp_store')
+    script = lambda path: os.path.join(SCRIPTS, path)
+
+    def tf_table_tasks():
+        tasks = []
+        for tf in read_list(os.path.join(groups, 'factors.list')):
+            pairs = [
+                (os.path.join(home, 'mixalime', f'results_{model}', 'pvalues', f'{tf}.tsv'),
+                 os.path.join(home, 'new-version', 'TF', f'{tf}_HUMAN_{model}.tsv'))
+                for model in ['MCNB', 'NB', 'BetaNB']
+            ]
+            tasks.append(Task(
+                f'tf_table:{tf}',
+                cmd=f'mkdir -p {home}/new-version/TF\n'
+                    f'python3 ${{scripts}}/create_tables/create_tf_tables.py --bed "{beds}/{tf}*.with_bad.bed" --store {store} '
+                    + ' '.join(f'--mixalime {m} --output {o}' for m, o in pairs),
+                inputs=[m for m, _ in pairs] + [
+                    os.path.join(beds, f'{tf}*.with_bad.bed'), os.path.join(store, '*.npy'),
+                    script('create_tables/create_tf_tables.py'), script('create_tables/snp_store.py'),
+                    script('create_tables/tf_table_io.py'),
+                ],
+                outputs=[o for _, o in pairs],
+            ))
+        return tasks
+
+    return [
+        Task(
+            'renamer',
+            cmd='python3 ${scripts}/clustering/renamer.py',
+            always=True,
+        ),
+        Task(
+            'preprocess',
+            cmd='python3 ${scripts}/clustering/preprocess_vcfs.py --work ${home} --jobs ${threads} --skip-existing',
+            inputs=[
+                os.path.join(vcfs, '*_*_*_*.vcf.gz'), '!' + os.path.join(vcfs, '*.without_MAF.vcf.gz'),
+                script('clustering/preprocess_vcfs.py'), script('clustering/vcf_columns.py'),
+            ],
+            outputs=[os.path.join(clustering, f) for f in ['merged.list', 'samples.meta.tsv', 'merged.min100.list']],
+            after=['renamer'], threads=args.threads,
+        ),
+        Task(
+            'merge',
+            cmd='bcftools merge -l ${home}/clustering/merged.min100.list --missing-to-ref '
+                '-Oz -o ${home}/VCFs/merged.min100.vcf.gz --threads ${threads} -m none\n'
+                'bcftools index --threads ${threads} -f ${home}/VCFs/merged.min100.vcf.gz',
+            inputs=['@' + os.path.join(clustering, 'merged.min100.list')],
+            outputs=[os.path.join(vcfs, 'merged.min100.vcf.gz')],
+            after=['preprocess'], threads=args.threads,
+        ),
+        Task(
+            'king',
+            cmd='plink2 --vcf ${home}/VCFs/merged.min100.vcf.gz --allow-extra-chr --threads ${threads} '
+                '--make-king square bin4 --out ${home}/clustering/king_min100',
+            inputs=[os.path.join(vcfs, 'merged.min100.vcf.gz')],
+            outputs=[os.path.join(clustering, 'king_min100.king.bin'), os.path.join(clustering, 'king_min100.king.id')],
+            after=['merge'], threads=args.threads,
+        ),
+        Task(
+            'kinship_store',
+            cmd='python3 ${scripts}/clustering/kinship_store.py init --store ${home}/clustering/kinship_store '
+                '--king ${home}/clustering/king_min100.king.bin --king-id ${home}/clustering/king_min100.king.id',
+            inputs=[
+                os.path.join(clustering, 'king_min100.king.bin'), os.path.join(clustering, 'king_min100.king.id'),
+                script('clustering/kinship_store.py'),
+            ],
+            outputs=[os.path.join(clustering, 'kinship_store')],
+            after=['king'],
+        ),
+        Task(
+            'clustering',
+            cmd='python3 ${scripts}/clustering/clustering.py --king ${home}/clustering/king_min100.king.bin '
+                '--king-id ${home}/clustering/king_min100.king.id --meta ${home}/clustering/samples.meta.tsv '
+                '--out ${home}/clustering/metadata.clustered.tsv --floor 0.0 --thr 0.8877 --method complete',
+            inputs=[
+                os.path.join(clustering, 'king_min100.king.bin'), os.path.join(clustering, 'king_min100.king.id'),
+                os.path.join(clustering, 'samples.meta.tsv'), script('clustering/clustering.py'),
+            ],
+            outputs=[os.path.join(clustering, 'metadata.clustered.tsv')],
+            after=['king'],
+        ),
+        Task(
+            'bed_clusters',
+            cmd='python3 ${scripts}/clustering/create_bed_clusters.py --metadata ${home}/clustering/metadata.clustered.tsv '
+                '--work ${home} --jobs ${threads}\n'
+                'find ${home}/BEDs -type f -name "INDIV_*.bed" ! -name "*.with_bad.bed" '
+                '-exec sh -c \'for f do [ "$(wc -l < "$f")" -eq 1 ] && rm "$f"; done; true\' sh {} +',
+            inputs=[
+                os.path.join(clustering, 'metadata.clustered.tsv'), os.path.join(vcfs, '*_*_*_*.vcf.gz'),
+                script('clustering/create_bed_clusters.py'), script('clustering/vcf_columns.py'),
+            ],
+            outputs=[beds],
+            after=['clustering'], threads=args.threads,
+        ),
+        Task(
+            'babachi',
+            cmd='python3 ${scripts}/babachi/run_babachi.py --bed-dir ${home}/BEDs --bad-dir ${home}/BADs '
+                '--cores ${threads} --skip-existing --timing ${home}/logs/babachi_timing.tsv',
+            inputs=[
+                os.path.join(beds, 'INDIV_*.bed'), script('babachi/run_babachi.py'), script('babachi/add_bad_to_bed.py'),
+            ],
+            outputs=[bads],
+            after=['bed_clusters'], threads=args.threads,
+        ),
+        Task(
+            'snp_store',
+            cmd='python3 ${scripts}/create_tables/snp_store.py build --store ${home}/BEDs/snp_store '
+                '--bed "${home}/BEDs/*.with_bad.bed" --jobs ${threads}',
+            inputs=[os.path.join(beds, '*.with_bad.bed'), script('create_tables/snp_store.py')],
+            outputs=[store],
+            after=['babachi'], threads=args.threads,
+        ),
+        Task(
+            'file_lists',
+            cmd=FILE_LISTS_CMD,
+            inputs=[
+                os.path.join(clustering, 'metadata.clustered.tsv'), args.meta6, args.qc,
+                os.path.join(beds, 'INDIV_*.with_bad.bed'), script('mixalime/bed_index.py'),
+            ],
+            outputs=[
+                os.path.join(lists, 'halfmillions.filtered.txt'), os.path.join(lists, 'cells_500K.list'),
+                os.path.join(groups, 'factors.list'),
+            ],
+            after=['babachi'], threads=args.threads,
+        ),
+        Task(
+            'limiter',
+            cmd='python3 ${scripts}/mixalime/run_projects.py limiter --home ${home} --threads ${threads}',
+            always=True, after=['file_lists'], threads=args.threads,
+        ),
+        Task(
+            'indivs_slices',
+            cmd=f'python3 ${{scripts}}/mixalime/indivs_sclices.py --home ${{home}} --meta ${{home}}/meta.tsv --cells-meta {args.cells_meta}',
+            always=True, after=['limiter'],
+        ),
+        Task(
+            'cells_slices',
+            cmd=f'python3 ${{scripts}}/mixalime/cells_sclices.py --home ${{home}} --cells-meta {args.cells_meta}',
+            always=True, after=['limiter'],
+        ),
+        Task(
+            'rest_slices',
+            cmd='python3 ${scripts}/mixalime/lessthan500k_sclices.py --home ${home}',
+            always=True, after=['limiter'],
+        ),
+        Task(
+            'multiple_combine',
+            cmd='python3 ${scripts}/mixalime/run_projects.py combine --home ${home} --threads ${threads}',
+            always=True, after=['indivs_slices', 'cells_slices', 'rest_slices'], threads=args.threads,
+        ),
+        Task('tf_tables', expand=tf_table_tasks, after=['multiple_combine', 'snp_store']),
+        Task(
+            'snps_lists',
+            cmd=f'python3 ${{scripts}}/motif_annotation/make_snps_list.py --genome {args.genome} --threads ${{threads}} '
+                '--input ${home}/new-version/TF/*_HUMAN_BetaNB.tsv --output-dir ${home}/SNPs',
+            inputs=[
+                os.path.join(home, 'new-version', 'TF', '*_HUMAN_BetaNB.tsv'), args.genome, script('motif_annotation/make_snps_list.py'),
+            ],
+            outputs=[os.path.join(home, 'SNPs')],
+            after=['tf_tables'], threads=args.threads,
+        ),
+        Task(
+            'snpscan',
+            cmd=f'python3 ${{scripts}}/motif_annotation/pwm_scan.py --snps-dir ${{home}}/SNPs --pwm-dir {args.pwm_dir} '
+                '--output-dir ${home}/SNPScan --jobs ${threads}',
+            inputs=[
+                os.path.join(home, 'SNPs', '*.snps'), os.path.join(args.pwm_dir, '*.H12RSNP.*.pwm'),
+                script('motif_annotation/pwm_scan.py'),
+            ],
+            outputs=[os.path.join(home, 'SNPScan')],
+            after=['snps_lists'], threads=args.threads,
+        ),
+        Task(
+            'motif_tables',
+            cmd='python3 ${scripts}/motif_annotation/annotate_tf_tables.py --tables-dir ${home}/new-version/TF '
+                '--output-dir ${home}/new-version/TF_annotated '
+                '--snpscan-dir ${home}/SNPScan --mixalime-dir ${home}/mixalime --model BetaNB '
+                '--tfs ${home}/mixalime/groups/factors.list --jobs ${threads}',
+            inputs=[
+                os.path.join(home, 'new-version', 'TF', '*_HUMAN_BetaNB.tsv'),
+                os.path.join(home, 'SNPScan', 'pwm_results_*'),
+                os.path.join(home, 'mixalime', 'results_BetaNB', 'pvalues', '*.tsv'),
+                os.path.join(groups, 'factors.list'),
+                script('motif_annotation/annotate_tf_tables.py'), script('motif_annotation/merge_snpscan_results.py'),
+                script('motif_annotation/update_tf_tables.py'), script('motif_annotation/add_raw_pvalue.py'),
+                script('create_tables/tf_table_io.py'),
+            ],
+            outputs=[os.path.join(home, 'new-version', 'TF_annotated')],
+            after=['snpscan'], threads=args.threads,
+        ),
+    ]
+
+
+FILE_LISTS_CMD = r'''
+mkdir -p ${home}/mixalime/file_lists/
+python3 ${scripts}/clustering/get_pooled_from_geo.py
+python3 ${scripts}/meta/join_meta.py \
+    --meta6 ${meta6} \
+    --qc ${qc} \
+    --clustered ${home}/clustering/GEO/metadata.clustered.pooled.tsv \
+    --out ${home}/meta.tsv
+python3 ${scripts}/mixalime/bed_index.py --home ${home} --jobs ${threads}
+'''
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Run the run.sh stages as cached tasks: only stale outputs are rebuilt, '
+                    'independent tasks run concurrently and a rerun resumes after a failure.'
+    )
+    parser.add_argument('--home', default='/sandbox/subpolare/adastra', help='Working directory (run.sh $home).')
+    parser.add_argument('--threads', type=int, default=50, help='Total thread budget shared by running tasks.')
+    parser.add_argument('--meta6', default='/home/subpolare/adastra-v7/meta/meta_6_may.tsv')
+    parser.add_argument('--qc', default='/home/subpolare/adastra-v7/meta/full_qc_table.tsv')
+    parser.add_argument('--cells-meta', default='/home/subpolare/adastra-v7/meta/meta_cells_and_tissues.tsv')
+    parser.add_argument('--genome', default='/home/subpolare/genome/GRCh38.primary_assembly.genome.fa')
+    parser.add_argument('--pwm-dir', default='/home/subpolare/adastra-v7/hocomoco/v12/pwm')
+    parser.add_argument(
+        '--force', action='append', default=[],
+        help='Rerun tasks whose name matches this glob even if fresh, e.g. "tf_table:*"; repeatable.'
+    )
+    parser.add_argument('--dry-run', action='store_true', help='Only report which tasks are stale.')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    home = os.path.abspath(args.home)
+    args.home = home
+
+    for d in ['VCFs', 'BEDs', 'clustering', 'BADs', 'SNPs', 'SNPScan', 'mixalime/groups', 'mixalime/file_lists', 'logs/pipeline']:
+        os.makedirs(os.path.join(home, d), exist_ok=True)
+
+    env = dict(
+        os.environ, home=home, scripts=SCRIPTS, threads=str(args.threads),
+        meta6=args.meta6, qc=args.qc,
+    )
+    pipeline = Pipeline(
+        build_tasks(args), env, args.threads,
+        state_path=os.path.join(home, 'logs', 'pipeline', 'state.json'),
+        log_dir=os.path.join(home, 'logs', 'pipeline'),
+        force=args.force, dry_run=args.dry_run,
+    )
+    if not pipeline.run():
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()